@@ -0,0 +1,169 @@
+import asyncio
+import math
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Optional
+from app.config import settings
+
+# Admission control, applied by AdmissionControlMiddleware before a request reaches its endpoint:
+# every route runs at most a fixed number of requests at once, a bounded number more wait for a slot
+# up to a deadline, and every authenticated user has a token bucket of requests. A request that can't
+# be admitted fails fast with 429 (rate limited) or 503 (route saturated) and a Retry-After, instead
+# of queueing behind the thread pool and the database pool until it times out.
+# The limits are per process, like the thread pool and the connection pool they protect.
+
+RATE_LIMITED = "rate_limited"
+QUEUE_FULL = "queue_full"
+QUEUE_TIMEOUT = "queue_timeout"
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, status_code: int, reason: str, detail: str, retry_after: float):
+        self.status_code = status_code
+        self.reason = reason
+        self.detail = detail
+        # Whole seconds, at least 1
+        self.retry_after = max(1, math.ceil(retry_after))
+
+
+class ConcurrencyLimiter:
+    """At most limit holders at once, queue_size more waiting in FIFO order for at most queue_timeout seconds.
+
+    Runs on the event loop only. A released slot is handed over to the oldest waiter directly.
+    """
+
+    def __init__(self, limit: int, queue_size: int, queue_timeout: float):
+        self.limit = limit
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.waiters = deque()
+
+    # Returns the seconds spent waiting for the slot
+    async def acquire(self) -> float:
+        if self.active < self.limit and not self.waiters:
+            self.active += 1
+            return 0.0
+        if len(self.waiters) >= self.queue_size:
+            raise AdmissionRejected(503, QUEUE_FULL, "Server busy, please retry", self.queue_timeout)
+
+        started = time.perf_counter()
+        waiter = asyncio.get_event_loop().create_future()
+        self.waiters.append(waiter)
+        try:
+            # asyncio.wait doesn't cancel the waiter on timeout, so a slot handed over meanwhile is not lost
+            await asyncio.wait({waiter}, timeout=self.queue_timeout)
+        except BaseException:
+            # The request was cancelled (client gone) while waiting
+            self._abandon(waiter)
+            raise
+        if not waiter.done():
+            self._abandon(waiter)
+            raise AdmissionRejected(503, QUEUE_TIMEOUT, "Server busy, please retry", self.queue_timeout)
+        return time.perf_counter() - started
+
+    def _abandon(self, waiter):
+        if waiter.done() and not waiter.cancelled():
+            # The slot was handed over just before, pass it on
+            self.release()
+            return
+        waiter.cancel()
+        try:
+            self.waiters.remove(waiter)
+        except ValueError:
+            pass
+
+    def release(self):
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+
+class TokenBucketLimiter:
+    """Token bucket per key: rate requests per second on average, bursts of up to burst requests.
+
+    Keeps the buckets of the max_keys most recently seen keys, an evicted key starts again with a full bucket.
+    """
+
+    def __init__(self, rate: float, burst: int, max_keys: int = 100000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self.lock = threading.Lock()
+        self.buckets = OrderedDict()
+
+    # Takes a token for key, or returns the seconds until the next one is available
+    def take(self, key: str) -> Optional[float]:
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated_at = self.buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated_at) * self.rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self.buckets[key] = (tokens, now)
+            if len(self.buckets) > self.max_keys:
+                self.buckets.popitem(last=False)
+        return None if allowed else (1 - tokens) / self.rate
+
+
+class AdmissionController:
+    """The concurrency limiters of the routes and the token buckets of the users, with their statistics."""
+
+    def __init__(self, max_concurrency: int, route_concurrency: dict, queue_size: int, queue_timeout: float,
+                 rate: float, burst: int, enabled: bool = True, rate_limit_enabled: bool = True):
+        self.max_concurrency = max_concurrency
+        # "METHOD /path" or "/path" (route templates) to the concurrency of the route
+        self.route_concurrency = route_concurrency
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.enabled = enabled
+        self.limiters = {}
+        self.rate_limiter = TokenBucketLimiter(rate, burst) if rate_limit_enabled else None
+        self.lock = threading.Lock()
+        self.rejections = {}
+
+    def limiter(self, method: str, path: str) -> ConcurrencyLimiter:
+        key = f"{method} {path}"
+        limiter = self.limiters.get(key)
+        if limiter is None:
+            limit = self.route_concurrency.get(key, self.route_concurrency.get(path, self.max_concurrency))
+            limiter = self.limiters[key] = ConcurrencyLimiter(limit, self.queue_size, self.queue_timeout)
+        return limiter
+
+    def check_rate(self, user_key: Optional[str]):
+        if self.rate_limiter is None or user_key is None:
+            return
+        retry_after = self.rate_limiter.take(user_key)
+        if retry_after is not None:
+            raise AdmissionRejected(429, RATE_LIMITED, "Too many requests, please slow down", retry_after)
+
+    def count_rejection(self, method: str, path: str, reason: str):
+        with self.lock:
+            self.rejections[(method, path, reason)] = self.rejections.get((method, path, reason), 0) + 1
+
+    def stats(self) -> dict:
+        with self.lock:
+            rejections = dict(self.rejections)
+        limiters = list(self.limiters.items())
+        return {
+            "rejections": rejections,
+            "active": {tuple(key.split(" ", 1)): limiter.active for key, limiter in limiters},
+            "queued": {tuple(key.split(" ", 1)): len(limiter.waiters) for key, limiter in limiters},
+        }
+
+
+admission_controller = AdmissionController(
+    max_concurrency=settings.ADMISSION_MAX_CONCURRENCY,
+    route_concurrency=settings.ADMISSION_ROUTE_CONCURRENCY,
+    queue_size=settings.ADMISSION_QUEUE_SIZE,
+    queue_timeout=settings.ADMISSION_QUEUE_TIMEOUT_SECONDS,
+    rate=settings.RATE_LIMIT_PER_SECOND,
+    burst=settings.RATE_LIMIT_BURST,
+    enabled=settings.ADMISSION_CONTROL_ENABLED,
+    rate_limit_enabled=settings.RATE_LIMIT_ENABLED,
+)
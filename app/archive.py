@@ -0,0 +1,135 @@
+import threading
+from datetime import datetime, timedelta
+from typing import Iterable, Optional
+from sqlalchemy import delete, func, insert, select, text, union_all
+from app.config import settings
+from app.database import engine
+from app.log import get_logger
+from app.models import Borrow, BorrowHistory, Copy
+
+logger = get_logger(__name__)
+
+# Hot/cold split of the loans. borrows is the hot table: the borrows, returns, borrow limits, borrow lists and the
+# overdue report only read its open borrows, and the archiver moves the returned ones to borrow_history
+# (partitioned by month of borrow_date on Postgres), so borrows stays the size of the loans in progress however
+# long the history gets. The archiver moves BORROW_ARCHIVE_BATCH_SIZE borrows per transaction, at most
+# BORROW_ARCHIVE_MAX_BATCHES per run, every BORROW_ARCHIVE_INTERVAL_SECONDS in a thread of every worker
+# (one worker at a time on Postgres, through an advisory lock), or all of them with
+# `python -m app.manage archive-borrows`.
+
+# Key of the Postgres advisory lock held by the transaction of an archiver batch
+ARCHIVE_LOCK_KEY = 72317002
+
+
+# Every borrow, open or returned, archived or not, with the columns of borrow_history
+def all_borrows():
+    return union_all(
+        select(Borrow.id, Borrow.borrow_date, Borrow.user_id, Borrow.copy_id, Copy.book_id, Borrow.return_date)
+        .join(Copy, Borrow.copy_id == Copy.id),
+        select(BorrowHistory.id, BorrowHistory.borrow_date, BorrowHistory.user_id, BorrowHistory.copy_id,
+               BorrowHistory.book_id, BorrowHistory.return_date),
+    ).subquery("all_borrows")
+
+
+# Creates the monthly partitions of borrow_history that hold these borrow dates (Postgres)
+def ensure_history_partitions(conn, borrow_dates: Iterable[datetime]):
+    months = {borrow_date.replace(day=1, hour=0, minute=0, second=0, microsecond=0) for borrow_date in borrow_dates}
+    for month in sorted(months):
+        name = f"borrow_history_y{month:%Y}m{month:%m}"
+        if conn.execute(text("SELECT to_regclass(:name)"), {"name": name}).scalar() is not None:
+            continue
+        end = (month + timedelta(days=32)).replace(day=1)
+        conn.execute(text(f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF borrow_history "
+                          f"FOR VALUES FROM ('{month.isoformat()}') TO ('{end.isoformat()}')"))
+
+
+class BorrowArchiver:
+    """Moves the returned borrows from borrows to borrow_history in bounded batches, in the background or on demand."""
+
+    def __init__(self, engine, batch_size: int, max_batches: Optional[int], interval_seconds: float):
+        self.engine = engine
+        self.batch_size = batch_size
+        self.max_batches = max_batches
+        self.interval_seconds = interval_seconds
+        self.lock = threading.Lock()
+        self.archived = 0
+        self.runs = 0
+        self.errors = 0
+        self.stopped = threading.Event()
+        self.thread = None
+
+    # One batch in the caller's transaction, returns the number of borrows archived
+    def archive_batch(self, conn) -> int:
+        rows = conn.execute(
+            select(Borrow.id, func.coalesce(Borrow.borrow_date, Borrow.return_date).label("borrow_date"),
+                   Borrow.user_id, Borrow.copy_id, Copy.book_id, Borrow.return_date)
+            .join(Copy, Borrow.copy_id == Copy.id)
+            # SQLite gives a new row the highest rowid + 1: the last borrow stays, so its id is never reused
+            .filter(Borrow.return_date.isnot(None), Borrow.id < select(func.max(Borrow.id)).scalar_subquery())
+            .order_by(Borrow.id)
+            .limit(self.batch_size)
+        ).all()
+        if not rows:
+            return 0
+        if conn.dialect.name == "postgresql":
+            ensure_history_partitions(conn, [row.borrow_date for row in rows])
+        conn.execute(insert(BorrowHistory), [row._asdict() for row in rows])
+        conn.execute(delete(Borrow).where(Borrow.id.in_([row.id for row in rows])))
+        return len(rows)
+
+    # Archives batches until no returned borrow is left or max_batches, returns the number of borrows archived
+    def run(self, max_batches: Optional[int] = None) -> int:
+        archived, batches = 0, 0
+        while max_batches is None or batches < max_batches:
+            with self.engine.begin() as conn:
+                if conn.dialect.name == "postgresql" and not conn.execute(
+                        select(func.pg_try_advisory_xact_lock(ARCHIVE_LOCK_KEY))).scalar():
+                    # Another worker is archiving
+                    break
+                count = self.archive_batch(conn)
+            archived += count
+            batches += 1
+            with self.lock:
+                self.archived += count
+            if count < self.batch_size:
+                break
+        with self.lock:
+            self.runs += 1
+        if archived:
+            logger.info("Borrows archived", extra={"borrows": archived, "batches": batches})
+        return archived
+
+    def start(self):
+        if self.interval_seconds <= 0 or self.thread is not None:
+            return
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self._loop, name="borrow-archiver", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.stopped.set()
+        self.thread.join()
+        self.thread = None
+
+    def _loop(self):
+        while not self.stopped.wait(self.interval_seconds):
+            try:
+                self.run(self.max_batches)
+            except Exception as e:
+                with self.lock:
+                    self.errors += 1
+                logger.error("Borrow archival failed", exc_info=e)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"archived": self.archived, "runs": self.runs, "errors": self.errors}
+
+
+borrow_archiver = BorrowArchiver(
+    engine,
+    batch_size=settings.BORROW_ARCHIVE_BATCH_SIZE,
+    max_batches=settings.BORROW_ARCHIVE_MAX_BATCHES,
+    interval_seconds=settings.BORROW_ARCHIVE_INTERVAL_SECONDS,
+)
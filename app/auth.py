@@ -1,12 +1,22 @@
-from fastapi import HTTPException, Depends
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from fastapi import HTTPException, Depends, Request
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, make_transient_to_detached
 from jose import jwt, JWTError
 from datetime import datetime, timedelta
+from app.config import settings
 from app.models import User, Book
-from app.database import get_db
+from app.database import get_db, get_async_db
 from fastapi.responses import JSONResponse
-from app.crypto import verify_password
+from app.crypto import verify_and_update_password, verify_and_update_password_async
+from app.log import get_logger
+from app.replicas import recent_writers
+
+logger = get_logger(__name__)
 
 security = HTTPBearer()
 
@@ -17,13 +27,33 @@ ACCESS_TOKEN_EXPIRE_MINUTES = 300
 
 
 # Function to authenticate user and generate access token
-async def  authenticate_user(username: str, password: str, db: Session):
+def authenticate_user(username: str, password: str, db: Session):
     user = db.query(User).filter(User.username == username).first()
     if user:
-        print("Found user for username {0}".format(username))
-    if user and verify_password(password, user.password):
-        return user
-    return None
+        logger.debug("Found user for username %s", username)
+    if not user:
+        return None
+    valid, new_hash = verify_and_update_password(password, user.password)
+    if not valid:
+        return None
+    # The stored hash uses another cost factor than BCRYPT_ROUNDS, replace it while we know the password
+    if new_hash:
+        user.password = new_hash
+        db.commit()
+    return user
+
+# Same as authenticate_user on the async session, bcrypt runs on the hash executor to keep the event loop free
+async def authenticate_user_async(username: str, password: str, db: AsyncSession):
+    user = (await db.execute(select(User).filter(User.username == username))).scalars().first()
+    if not user:
+        return None
+    valid, new_hash = await verify_and_update_password_async(password, user.password)
+    if not valid:
+        return None
+    if new_hash:
+        user.password = new_hash
+        await db.commit()
+    return user
 
 # Function to create access token
 def create_access_token(username: str):
@@ -33,26 +63,126 @@ def create_access_token(username: str):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
+class PrincipalCache:
+    """Bounded LRU cache of authenticated users keyed by access token.
+
+    An entry lives for at most ttl_seconds and never past the expiry of its token,
+    so a hit can skip both the token decoding and the users lookup.
+    """
+
+    def __init__(self, max_size: int, ttl_seconds: int, enabled: bool = True):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.tokens_by_user = defaultdict(set)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, token: str):
+        if not self.enabled:
+            return None
+        with self.lock:
+            entry = self.entries.get(token)
+            if entry is None or entry[1] <= time.time():
+                if entry is not None:
+                    self._remove(token)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(token)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, token: str, user: User, token_expires_at: float):
+        if not self.enabled:
+            return
+        # Keep a detached copy of the user's columns, the cached instance must not belong to any session
+        snapshot = User(id=user.id, username=user.username, email=user.email, is_admin=user.is_admin)
+        make_transient_to_detached(snapshot)
+        expires_at = min(time.time() + self.ttl_seconds, token_expires_at)
+        with self.lock:
+            self._remove(token)
+            self.entries[token] = (snapshot, expires_at)
+            self.tokens_by_user[user.id].add(token)
+            while len(self.entries) > self.max_size:
+                self._remove(next(iter(self.entries)))
+
+    # Drop every cached token of a user, called when the user's username, password or role changes
+    def invalidate_user(self, user_id: int):
+        with self.lock:
+            for token in list(self.tokens_by_user.get(user_id, ())):
+                self._remove(token)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.tokens_by_user.clear()
+
+    def _remove(self, token: str):
+        entry = self.entries.pop(token, None)
+        if entry is not None:
+            tokens = self.tokens_by_user[entry[0].id]
+            tokens.discard(token)
+            if not tokens:
+                del self.tokens_by_user[entry[0].id]
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"enabled": self.enabled, "size": len(self.entries), "hits": self.hits, "misses": self.misses}
+
+
+principal_cache = PrincipalCache(
+    max_size=settings.PRINCIPAL_CACHE_SIZE,
+    ttl_seconds=settings.PRINCIPAL_CACHE_TTL_SECONDS,
+    enabled=settings.PRINCIPAL_CACHE_ENABLED,
+)
+
+
 def remove_bearer_prefix(token: str) -> str:
     if token.startswith("Bearer "):
         return token[len("Bearer "):]
     return token
 
 # Function to get current user based on access token
-def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security), db: Session = Depends(get_db)):
+def get_current_user(request: Request, credentials: HTTPAuthorizationCredentials = Depends(security), db: Session = Depends(get_db)):
     try:
-        print("Enter get_current_user")
         token = remove_bearer_prefix(credentials.credentials)
-        print("Token is:{0}".format(token))
+        # The reads with this token stay on the primary for a while after a write, see app/replicas.py
+        if request.method not in ("GET", "HEAD", "OPTIONS"):
+            db.info["writer_token"] = token
+            recent_writers.mark(token)
+        cached_user = principal_cache.get(token)
+        if cached_user is not None:
+            # Attach a copy of the cached user to this request's session without querying the database
+            return db.merge(cached_user, load=False)
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        print("GET CURRENT USER EXTRACT USERNAME FROM TOKEN:{0}",payload)
         username = payload.get("sub")
         if username is None:
             raise HTTPException(status_code=401, detail="Invalid authentication token")
         user = db.query(User).filter(User.username == username).first()
         if user is None:
             raise HTTPException(status_code=401, detail="Invalid user")
+        principal_cache.put(token, user, payload.get("exp", 0))
+    except JWTError:
+        raise HTTPException(status_code=401, detail="Invalid authentication token")
+    return user
+
+# Same as get_current_user on the async session
+async def get_current_user_async(credentials: HTTPAuthorizationCredentials = Depends(security), db: AsyncSession = Depends(get_async_db)):
+    token = remove_bearer_prefix(credentials.credentials)
+    cached_user = principal_cache.get(token)
+    if cached_user is not None:
+        return await db.merge(cached_user, load=False)
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
     except JWTError:
         raise HTTPException(status_code=401, detail="Invalid authentication token")
-    print("Get current user succeeded!")
-    return user
\ No newline at end of file
+    username = payload.get("sub")
+    if username is None:
+        raise HTTPException(status_code=401, detail="Invalid authentication token")
+    user = (await db.execute(select(User).filter(User.username == username))).scalars().first()
+    if user is None:
+        raise HTTPException(status_code=401, detail="Invalid user")
+    principal_cache.put(token, user, payload.get("exp", 0))
+    return user
@@ -0,0 +1,213 @@
+import json
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from typing import Dict, Iterable, Optional, Tuple
+from fastapi import Request, Response
+from fastapi.encoders import jsonable_encoder
+from app.config import settings
+from app.serialization import dumps
+
+# Read-through cache of catalog responses (GET /books, GET /books/{book_id}).
+# Entries are the serialized JSON bodies with their validator headers (ETag, Last-Modified), tagged with what
+# they were built from ("books" for every list page, "books:available" for the pages filtered on availability,
+# "book:{id}" for a book's details), so writes invalidate only the responses they can change. The in-process backend is per worker: another worker
+# serves its entries until they expire (RESPONSE_CACHE_TTL_SECONDS), or until invalidated if it shares a store.
+
+LIST_TAG = "books"
+AVAILABILITY_TAG = "books:available"
+
+
+def book_tag(book_id: int) -> str:
+    return f"book:{book_id}"
+
+
+class CacheBackend:
+    """Storage interface of the response cache. A shared store (e.g. Redis) implements the same methods.
+
+    Every tag has a version, bumped by invalidate_tags. set() only stores the value if the versions of its tags
+    are still the ones read before the response was built, so a response computed from data that changed
+    meanwhile is never cached.
+    """
+
+    def get(self, key: str) -> Optional[bytes]:
+        raise NotImplementedError
+
+    def tag_versions(self, tags: Iterable[str]) -> Tuple[int, ...]:
+        raise NotImplementedError
+
+    def set(self, key: str, value: bytes, tags: Tuple[str, ...], versions: Tuple[int, ...], ttl_seconds: int):
+        raise NotImplementedError
+
+    def invalidate_tags(self, tags: Iterable[str]):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def size(self) -> int:
+        raise NotImplementedError
+
+
+class MemoryCacheBackend(CacheBackend):
+    """Bounded LRU with a TTL per entry, in the memory of the process."""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.keys_by_tag = defaultdict(set)
+        # Only the invalidated tags have a version (0 otherwise): reads don't add one per tag looked up.
+        # A version is never dropped, or a response built before its invalidation could be stored after it.
+        self.versions = {}
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] <= time.monotonic():
+                self._remove(key)
+                return None
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def tag_versions(self, tags: Iterable[str]) -> Tuple[int, ...]:
+        with self.lock:
+            return tuple(self.versions.get(tag, 0) for tag in tags)
+
+    def set(self, key: str, value: bytes, tags: Tuple[str, ...], versions: Tuple[int, ...], ttl_seconds: int):
+        with self.lock:
+            if tuple(self.versions.get(tag, 0) for tag in tags) != versions:
+                return
+            self._remove(key)
+            self.entries[key] = (value, time.monotonic() + ttl_seconds, tags)
+            for tag in tags:
+                self.keys_by_tag[tag].add(key)
+            while len(self.entries) > self.max_size:
+                self._remove(next(iter(self.entries)))
+
+    def invalidate_tags(self, tags: Iterable[str]):
+        with self.lock:
+            for tag in tags:
+                self.versions[tag] = self.versions.get(tag, 0) + 1
+                for key in list(self.keys_by_tag.get(tag, ())):
+                    self._remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.keys_by_tag.clear()
+
+    def size(self) -> int:
+        with self.lock:
+            return len(self.entries)
+
+    def _remove(self, key: str):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        for tag in entry[2]:
+            keys = self.keys_by_tag.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.keys_by_tag[tag]
+
+
+HIT = "hit"
+MISS = "miss"
+BYPASS = "bypass"
+
+
+class CacheLookup:
+    """One cacheable request: holds the cached response on a hit, stores the computed one on a miss."""
+
+    def __init__(self, cache, route: str, key: str, tags: Tuple[str, ...], mode: str):
+        self.cache = cache
+        self.route = route
+        self.key = key
+        self.tags = tags
+        self.mode = mode
+        self.response = None
+        self.versions = None
+
+    # content is a response model, or its already encoded JSON body. A response read from a possibly stale
+    # source (cacheable=False) is only returned.
+    def store(self, content, headers: Dict[str, str] = None, cacheable: bool = True) -> Response:
+        headers = headers or {}
+        body = content if isinstance(content, bytes) else dumps(jsonable_encoder(content))
+        if cacheable and self.mode != "no-store":
+            # Stored as one value: the headers as a JSON line, then the body
+            value = json.dumps(headers).encode() + b"\n" + body
+            self.cache.backend.set(self.key, value, self.tags, self.versions, self.cache.ttl_seconds)
+        return Response(body, media_type="application/json",
+                        headers={**headers, "X-Cache": MISS if self.mode is None else BYPASS})
+
+
+class ResponseCache:
+    def __init__(self, backend: CacheBackend, ttl_seconds: int, enabled: bool = True):
+        self.backend = backend
+        self.ttl_seconds = ttl_seconds
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.results = defaultdict(int)
+        self.invalidations = 0
+
+    # Bypass per request with "Cache-Control: no-cache" (don't read the cache, refresh the entry)
+    # or "Cache-Control: no-store" (don't read nor write it)
+    @staticmethod
+    def _bypass_mode(request: Request) -> Optional[str]:
+        directives = {directive.strip().lower() for directive in request.headers.get("cache-control", "").split(",")}
+        if "no-store" in directives:
+            return "no-store"
+        if "no-cache" in directives:
+            return "no-cache"
+        return None
+
+    # params are the normalized inputs of the response, None values are left out of the key
+    def lookup(self, request: Request, route: str, params: Dict, tags: Iterable[str]) -> CacheLookup:
+        key = route + "?" + json.dumps({name: value for name, value in params.items() if value is not None}, sort_keys=True)
+        mode = self._bypass_mode(request) if self.enabled else "no-store"
+        lookup = CacheLookup(self, route, key, tuple(tags), mode)
+        # Versions are read before the response is built, see CacheBackend
+        lookup.versions = self.backend.tag_versions(lookup.tags)
+        if mode is None:
+            value = self.backend.get(key)
+            if value is not None:
+                headers, _, body = value.partition(b"\n")
+                lookup.response = Response(body, media_type="application/json",
+                                           headers={**json.loads(headers), "X-Cache": HIT})
+        if self.enabled:
+            self._count(route, HIT if lookup.response is not None else MISS if mode is None else BYPASS)
+        return lookup
+
+    # Called after the write is committed
+    def invalidate(self, *tags: str):
+        if not tags:
+            return
+        self.backend.invalidate_tags(tags)
+        with self.lock:
+            self.invalidations += 1
+
+    def _count(self, route: str, result: str):
+        with self.lock:
+            self.results[(route, result)] += 1
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"enabled": self.enabled, "size": self.backend.size(), "results": dict(self.results),
+                    "invalidations": self.invalidations}
+
+
+def create_cache_backend(name: str) -> CacheBackend:
+    if name == "memory":
+        return MemoryCacheBackend(settings.RESPONSE_CACHE_SIZE)
+    raise ValueError("Unknown RESPONSE_CACHE_BACKEND: {0}".format(name))
+
+
+response_cache = ResponseCache(
+    create_cache_backend(settings.RESPONSE_CACHE_BACKEND),
+    ttl_seconds=settings.RESPONSE_CACHE_TTL_SECONDS,
+    enabled=settings.RESPONSE_CACHE_ENABLED,
+)
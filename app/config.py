@@ -1,4 +1,6 @@
 from pydantic import BaseSettings
+from pydantic.types import Optional
+from typing import Dict, List
 
 
 class Settings(BaseSettings):
@@ -9,9 +11,104 @@ class Settings(BaseSettings):
     POSTGRES_HOST: str
     POSTGRES_HOSTNAME: str
 
+    # Full SQLAlchemy URL, overrides the POSTGRES_* settings when set (e.g. sqlite:///./library.db)
+    DATABASE_URL: Optional[str] = None
+    # Log every SQL statement through SQLAlchemy (costly, for debugging only)
+    SQL_ECHO: bool = False
+
+    # Read replicas of the read-only endpoints as a JSON list of URLs, how long one that failed is skipped,
+    # and how long the reads of a user who wrote stay on the primary (0 turns it off)
+    DATABASE_REPLICA_URLS: List[str] = []
+    REPLICA_RETRY_SECONDS: float = 10.0
+    READ_YOUR_WRITES_SECONDS: float = 5.0
+
+    # Level of the app.* loggers and how many records one log call site may emit per minute
+    LOG_LEVEL: str = "INFO"
+    LOG_RATE_LIMIT_PER_MINUTE: int = 60
+
+    # Serve the read endpoints and login from an asyncio engine (asyncpg / aiosqlite driver).
+    # ASYNC_DATABASE_URL defaults to DATABASE_URL with the async driver.
+    ASYNC_DATABASE: bool = False
+    ASYNC_DATABASE_URL: Optional[str] = None
+
+    # Borrowing rules: open borrows per user, loan period in days and the fine per overdue day
+    MAX_BORROWS: int = 10
+    MAX_BORROW_TIME: int = 14
+    BORROW_FINE_PER_OVERDUE_DAY: float = 0.10
+
+    # Archival of the returned borrows to borrow_history (app/archive.py): borrows moved per transaction,
+    # transactions per run and the interval of the background runs (0 turns them off)
+    BORROW_ARCHIVE_BATCH_SIZE: int = 1000
+    BORROW_ARCHIVE_MAX_BATCHES: int = 10
+    BORROW_ARCHIVE_INTERVAL_SECONDS: float = 60.0
+
+    # Number of rows resolved and inserted per transaction by the bulk book ingestion
+    INGEST_CHUNK_SIZE: int = 500
+
+    # Rows fetched per round trip of the server-side cursor, and encoded per chunk, by GET /books/export
+    EXPORT_BATCH_SIZE: int = 1000
+
+    # Book search: "auto" uses pg_trgm on Postgres and the in-process trigram index otherwise
+    SEARCH_BACKEND: str = "auto"
+    SEARCH_MIN_SIMILARITY: float = 0.3
+    SEARCH_INDEX_MAX_AGE_SECONDS: int = 300
+
+    # Cache of authenticated users per access token, used by get_current_user
+    PRINCIPAL_CACHE_ENABLED: bool = True
+    PRINCIPAL_CACHE_SIZE: int = 10000
+    PRINCIPAL_CACHE_TTL_SECONDS: int = 60
+
+    # Read-through cache of GET /books and GET /books/{book_id} responses, invalidated by the catalog writes
+    RESPONSE_CACHE_ENABLED: bool = True
+    RESPONSE_CACHE_BACKEND: str = "memory"
+    RESPONSE_CACHE_SIZE: int = 10000
+    RESPONSE_CACHE_TTL_SECONDS: int = 30
+
+    # Admission control (app/admission.py): requests running at once per route, with overrides per route
+    # template as JSON ({"GET /books/export": 4} or {"/books/export": 4}), how many more may wait and for how long,
+    # and the routes left out of it
+    ADMISSION_CONTROL_ENABLED: bool = True
+    ADMISSION_MAX_CONCURRENCY: int = 32
+    ADMISSION_ROUTE_CONCURRENCY: Dict[str, int] = {"GET /books/export": 4, "GET /reports/overdue": 4,
+                                                   "GET /reports/overdue/users": 4}
+    ADMISSION_QUEUE_SIZE: int = 64
+    ADMISSION_QUEUE_TIMEOUT_SECONDS: float = 1.0
+    ADMISSION_EXEMPT_ROUTES: List[str] = ["/metrics", "/books/availability/stream"]
+    # Token bucket of every authenticated user: sustained requests per second and burst
+    RATE_LIMIT_ENABLED: bool = True
+    RATE_LIMIT_PER_SECOND: float = 50.0
+    RATE_LIMIT_BURST: int = 100
+
+    # Availability streams (app/notifications.py): pub/sub backend, open streams per worker, how long a burst of
+    # changes is collected into one send, the keep-alive interval and how long a stream may stay unread
+    NOTIFICATIONS_BACKEND: str = "memory"
+    NOTIFICATIONS_MAX_SUBSCRIBERS: int = 10000
+    NOTIFICATIONS_COALESCE_SECONDS: float = 0.25
+    NOTIFICATIONS_KEEPALIVE_SECONDS: float = 15.0
+    NOTIFICATIONS_SEND_TIMEOUT_SECONDS: float = 30.0
+
+    # Idempotency-Key of the write requests (app/idempotency.py): keys remembered per worker and for how long
+    IDEMPOTENCY_ENABLED: bool = True
+    IDEMPOTENCY_BACKEND: str = "memory"
+    IDEMPOTENCY_MAX_KEYS: int = 10000
+    IDEMPOTENCY_TTL_SECONDS: int = 86400
+
+    # Request profiling (app/profiling.py): admins' requests with "X-Profile: 1" and this share of all the requests
+    # are profiled to PROFILING_DIR, which keeps the newest PROFILING_MAX_PROFILES, with at most PROFILING_MAX_STATEMENTS
+    # SQL statements each
+    PROFILING_ENABLED: bool = True
+    PROFILING_SAMPLE_RATE: float = 0.0
+    PROFILING_DIR: str = "./profiles"
+    PROFILING_MAX_PROFILES: int = 200
+    PROFILING_MAX_STATEMENTS: int = 500
+
+    # Password hashing: bcrypt cost factor, dedicated hashing threads and how many hashes may wait for them
+    BCRYPT_ROUNDS: int = 12
+    HASH_WORKERS: int = 4
+    HASH_QUEUE_LIMIT: int = 64
+
     class Config:
         env_file = './.env'
 
 
 settings = Settings()
-
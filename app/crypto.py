@@ -1,15 +1,100 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from fastapi import HTTPException
 from passlib.context import CryptContext
+from app.config import settings
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
-print("PASSWORD CONTEXT CREATED")
+# Hashes made with another cost factor than BCRYPT_ROUNDS report needs_update and are rehashed on login
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=settings.BCRYPT_ROUNDS)
+
+
+class HashExecutor:
+    """Runs bcrypt on a dedicated, bounded thread pool.
+
+    At most workers hashes run at once and queue_limit more may wait. Beyond that the call
+    fails fast with 503 instead of piling up (bcrypt releases the GIL, so threads are enough).
+    """
+
+    def __init__(self, workers: int, queue_limit: int):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="password-hash")
+        self.slots = threading.BoundedSemaphore(workers + queue_limit)
+        self.lock = threading.Lock()
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.rejected = 0
+        self.wait_seconds_total = 0.0
+        self.hash_seconds_total = 0.0
+        self.hash_seconds_max = 0.0
+
+    def submit(self, fn, *args):
+        if not self.slots.acquire(blocking=False):
+            with self.lock:
+                self.rejected += 1
+            raise HTTPException(status_code=503, detail="Too many concurrent logins, please retry",
+                                headers={"Retry-After": "1"})
+        with self.lock:
+            self.queued += 1
+        return self.executor.submit(self._timed, time.perf_counter(), fn, *args)
+
+    def _timed(self, submitted_at, fn, *args):
+        started = time.perf_counter()
+        with self.lock:
+            self.queued -= 1
+            self.running += 1
+        try:
+            return fn(*args)
+        finally:
+            finished = time.perf_counter()
+            with self.lock:
+                self.running -= 1
+                self.completed += 1
+                self.wait_seconds_total += started - submitted_at
+                self.hash_seconds_total += finished - started
+                self.hash_seconds_max = max(self.hash_seconds_max, finished - started)
+            self.slots.release()
+
+    # For sync endpoints, which already run in the request thread pool
+    def call(self, fn, *args):
+        return self.submit(fn, *args).result()
+
+    # For async endpoints, the event loop is free while the hash runs
+    async def run(self, fn, *args):
+        return await asyncio.wrap_future(self.submit(fn, *args))
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "queue_depth": self.queued,
+                "running": self.running,
+                "completed": self.completed,
+                "rejected": self.rejected,
+                "wait_seconds_total": self.wait_seconds_total,
+                "hash_seconds_total": self.hash_seconds_total,
+                "hash_seconds_max": self.hash_seconds_max,
+            }
+
+
+hash_executor = HashExecutor(workers=settings.HASH_WORKERS, queue_limit=settings.HASH_QUEUE_LIMIT)
 
 
 # Function to verify password
 def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+    return hash_executor.call(pwd_context.verify, plain_password, hashed_password)
+
+
+# Function to verify password, returns (valid, new_hash) where new_hash is set when the stored hash
+# uses another cost factor and should be replaced
+def verify_and_update_password(plain_password, hashed_password):
+    return hash_executor.call(pwd_context.verify_and_update, plain_password, hashed_password)
+
+
+async def verify_and_update_password_async(plain_password, hashed_password):
+    return await hash_executor.run(pwd_context.verify_and_update, plain_password, hashed_password)
 
 
 # Function to hash password
 def get_password_hash(password):
-    return pwd_context.hash(password)
-
+    return hash_executor.call(pwd_context.hash, password)
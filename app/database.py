@@ -3,25 +3,63 @@ from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from fastapi_utils.guid_type import setup_guids_postgresql
 from .config import settings
+from .log import get_logger
+from .metrics import instrument_engine
+
+logger = get_logger(__name__)
 
 
 # Construct the PostgreSQL database connection URL with the variables stored in the .env file and
 POSTGRES_URL = f"postgresql://{settings.POSTGRES_USER}:{settings.POSTGRES_PASSWORD}@{settings.POSTGRES_HOSTNAME}:{settings.DATABASE_PORT}/{settings.POSTGRES_DB}"
 
+# DATABASE_URL lets benchmarks and local runs point the app at another database (e.g. SQLite)
+DATABASE_URL = settings.DATABASE_URL or POSTGRES_URL
+
+connect_args = {}
+if DATABASE_URL.startswith("sqlite"):
+    # FastAPI runs sync endpoints in a thread pool, so connections are shared across threads
+    connect_args = {"check_same_thread": False}
+
 engine = create_engine(
-    POSTGRES_URL, echo=True
+    DATABASE_URL, echo=settings.SQL_ECHO, connect_args=connect_args
 )
 
-print("The postgres url is:{0}".format(POSTGRES_URL))
+logger.info("Database engine created", extra={"database_url": repr(engine.url)})
 
 # The UUIDs can only be generated if the pgcrypto extension is installed on the Postgres instance, 
 # so the setup_guids_postgresql() function will tell Postgres to install the extension if it doesn’t exist.
-setup_guids_postgresql(engine)
+if engine.dialect.name == "postgresql":
+    setup_guids_postgresql(engine)
+
+instrument_engine(engine)
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 Base = declarative_base()
 
+
+# Same database through the asyncio drivers
+def async_database_url(url: str) -> str:
+    for sync_prefix, async_prefix in (("postgresql://", "postgresql+asyncpg://"), ("sqlite://", "sqlite+aiosqlite://")):
+        if url.startswith(sync_prefix):
+            return async_prefix + url[len(sync_prefix):]
+    return url
+
+
+async_engine = None
+AsyncSessionLocal = None
+if settings.ASYNC_DATABASE:
+    from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+
+    async_engine = create_async_engine(
+        settings.ASYNC_DATABASE_URL or async_database_url(DATABASE_URL), echo=settings.SQL_ECHO
+    )
+    # Objects stay usable after commit, an async session cannot lazy load expired attributes
+    instrument_engine(async_engine.sync_engine)
+    AsyncSessionLocal = sessionmaker(
+        bind=async_engine, class_=AsyncSession, autocommit=False, autoflush=False, expire_on_commit=False
+    )
+
 def get_db():
     db = SessionLocal()
     try:
@@ -29,3 +67,8 @@ def get_db():
     finally:
         db.close()
 
+async def get_async_db():
+    if AsyncSessionLocal is None:
+        raise RuntimeError("ASYNC_DATABASE is not enabled")
+    async with AsyncSessionLocal() as db:
+        yield db
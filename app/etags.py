@@ -0,0 +1,99 @@
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import Iterable, Optional, Tuple
+from fastapi import Request, Response
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+from app.models import Book, CatalogVersion
+
+# Strong ETags and Last-Modified for the book endpoints, answered with 304 from the version counters alone.
+# A book's representation changes with books.version (bumped by every UPDATE of its row).
+# A GET /books page changes with the "books" scope of catalog_versions (books created, updated or deleted)
+# and, when filtered on availability, with the "availability" scope (copy counters).
+
+CATALOG_SCOPE = "books"
+AVAILABILITY_SCOPE = "availability"
+# Rows per scope in catalog_versions: every write increments one of them, chosen by book id,
+# and the version of a scope is their sum. Must match migration 0006.
+CATALOG_VERSION_SHARDS = 16
+
+Validators = Tuple[str, Optional[datetime]]
+
+
+# Called in the transaction of the write
+def bump_catalog_version(db: Session, scope: str, book_id: int = 0):
+    db.query(CatalogVersion).filter(
+        CatalogVersion.scope == scope, CatalogVersion.shard == book_id % CATALOG_VERSION_SHARDS
+    ).update(
+        {CatalogVersion.version: CatalogVersion.version + 1, CatalogVersion.updated_at: datetime.utcnow()},
+        synchronize_session=False
+    )
+
+
+def catalog_version_statement(scopes: Iterable[str]):
+    return (
+        select(CatalogVersion.scope, func.sum(CatalogVersion.version), func.max(CatalogVersion.updated_at))
+        .filter(CatalogVersion.scope.in_(list(scopes)))
+        .group_by(CatalogVersion.scope)
+        .order_by(CatalogVersion.scope)
+    )
+
+
+def catalog_validators(rows) -> Validators:
+    rows = list(rows)
+    etag = '"books-' + "-".join(f"{scope}.{version}" for scope, version, _ in rows) + '"'
+    last_modified = max((updated_at for _, _, updated_at in rows if updated_at is not None), default=None)
+    return etag, last_modified
+
+
+def book_version_statement(book_id: int):
+    return select(Book.version, Book.updated_at).filter(Book.id == book_id)
+
+
+# The details differ for admins (copy counters), so does the ETag
+def book_validators(book_id: int, version: int, updated_at: Optional[datetime], is_admin: bool) -> Validators:
+    return f'"book-{book_id}-{version}{"-admin" if is_admin else ""}"', updated_at
+
+
+def validator_headers(validators: Validators) -> dict:
+    etag, last_modified = validators
+    headers = {"ETag": etag}
+    if last_modified is not None:
+        headers["Last-Modified"] = format_datetime(last_modified.replace(tzinfo=timezone.utc, microsecond=0), usegmt=True)
+    return headers
+
+
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    candidates = {candidate.strip() for candidate in if_none_match.split(",")}
+    return "*" in candidates or etag in candidates or "W/" + etag in candidates
+
+
+# If-None-Match wins over If-Modified-Since, as RFC 7232 requires
+def is_not_modified(request: Request, etag: str, last_modified_header: Optional[str]) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        return _etag_matches(if_none_match, etag)
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since and last_modified_header:
+        try:
+            return parsedate_to_datetime(last_modified_header) <= parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+# 304 for the given validators, or None when the client's copy is outdated
+def not_modified_response(request: Request, validators: Validators) -> Optional[Response]:
+    headers = validator_headers(validators)
+    if is_not_modified(request, headers["ETag"], headers.get("Last-Modified")):
+        return Response(status_code=304, headers=headers)
+    return None
+
+
+# For a complete response (e.g. from the response cache) that carries its validators
+def conditional_response(request: Request, response: Response) -> Response:
+    etag = response.headers.get("etag")
+    if etag is not None and is_not_modified(request, etag, response.headers.get("last-modified")):
+        headers = {name: response.headers[name] for name in ("etag", "last-modified", "x-cache") if name in response.headers}
+        return Response(status_code=304, headers=headers)
+    return response
@@ -0,0 +1,54 @@
+import csv
+import io
+import json
+from typing import Iterator, List
+from sqlalchemy import select
+from app.config import settings
+from app.database import engine
+from app.models import Author, Book
+
+# Full catalog export with the copy counters, streamed in the order of the primary key.
+# Rows are plain column tuples read through a server-side cursor (stream_results), one batch at a time,
+# so memory stays flat whatever the size of the catalog and the first bytes leave after the first batch.
+
+EXPORT_COLUMNS = ("id", "title", "author", "isbn", "num_copies", "num_borrowed_copies", "num_available_copies")
+
+
+def export_statement():
+    return (
+        select(Book.id, Book.title, Author.name, Book.isbn, Book.total_copies, Book.borrowed_copies,
+               Book.total_copies - Book.borrowed_copies)
+        .outerjoin(Author, Book.author_id == Author.id)
+        .order_by(Book.id)
+    )
+
+
+# The export uses its own connection, held until the last batch is sent (or the client goes away)
+def _batches(statement, batch_size: int) -> Iterator[List[tuple]]:
+    with engine.connect() as conn:
+        result = conn.execution_options(stream_results=True).execute(statement)
+        for rows in result.partitions(batch_size):
+            yield rows
+
+
+def export_ndjson(batch_size: int = None) -> Iterator[bytes]:
+    for rows in _batches(export_statement(), batch_size or settings.EXPORT_BATCH_SIZE):
+        yield "".join(json.dumps(dict(zip(EXPORT_COLUMNS, row))) + "\n" for row in rows).encode()
+
+
+def export_csv(batch_size: int = None) -> Iterator[bytes]:
+    return stream_csv(EXPORT_COLUMNS, export_statement(), batch_size)
+
+
+# CSV of the rows of any select() statement, with a header line of columns, streamed batch by batch
+def stream_csv(columns, statement, batch_size: int = None) -> Iterator[bytes]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for rows in _batches(statement, batch_size or settings.EXPORT_BATCH_SIZE):
+        writer.writerows(rows)
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode()
@@ -0,0 +1,71 @@
+from datetime import date, datetime, time, timedelta
+from typing import Optional, Tuple
+from sqlalchemy import and_, or_, select, union_all
+from app.models import Book, Borrow, BorrowHistory, Copy
+
+# Borrow history of a user or of a book, newest first: the open and not yet archived borrows from borrows, the
+# archived ones from borrow_history (see app/archive.py). Each table is read newest first through its
+# (user_id | book_id, borrow_date, id) index and cut at the page size before the two are merged, so a page reads
+# at most two pages of rows however long the history is. Both are read by the same statement: a borrow archived
+# meanwhile is seen in exactly one of them. Pages follow each other by (borrow_date, id), which an archived borrow keeps.
+
+HISTORY_COLUMNS = ("borrow_id", "user_id", "book_id", "book_title", "borrow_date", "return_date")
+OPEN = "open"
+RETURNED = "returned"
+
+
+def _branch(statement, columns, limit: int, user_id: Optional[int], book_id: Optional[int],
+            start_date: Optional[date], end_date: Optional[date], status: Optional[str],
+            after: Optional[Tuple[datetime, int]]):
+    borrow_id, borrow_user_id, borrow_book_id, borrow_date, return_date = columns
+    if user_id is not None:
+        statement = statement.filter(borrow_user_id == user_id)
+    if book_id is not None:
+        statement = statement.filter(borrow_book_id == book_id)
+    if start_date is not None:
+        statement = statement.filter(borrow_date >= datetime.combine(start_date, time.min))
+    if end_date is not None:
+        statement = statement.filter(borrow_date < datetime.combine(end_date + timedelta(days=1), time.min))
+    if status == OPEN:
+        statement = statement.filter(return_date.is_(None))
+    elif status == RETURNED:
+        statement = statement.filter(return_date.isnot(None))
+    if after is not None:
+        # Seek past the last borrow of the previous page
+        last_date, last_id = after
+        statement = statement.filter(or_(borrow_date < last_date, and_(borrow_date == last_date, borrow_id < last_id)))
+    return select(statement.order_by(borrow_date.desc(), borrow_id.desc()).limit(limit).subquery())
+
+
+# A page of the borrows of user_id or of book_id (borrowed between start_date and end_date included, open or
+# returned only with status), newest first. after is the (borrow_date, id) of the last borrow of the previous page.
+def borrow_history_statement(limit: int, user_id: Optional[int] = None, book_id: Optional[int] = None,
+                             start_date: Optional[date] = None, end_date: Optional[date] = None,
+                             status: Optional[str] = None, after: Optional[Tuple[datetime, int]] = None):
+    filters = (limit, user_id, book_id, start_date, end_date, status, after)
+    branches = [_branch(
+        select(Borrow.id.label("borrow_id"), Borrow.user_id, Copy.book_id, Borrow.borrow_date, Borrow.return_date)
+        .select_from(Borrow)
+        .join(Copy, Borrow.copy_id == Copy.id),
+        (Borrow.id, Borrow.user_id, Copy.book_id, Borrow.borrow_date, Borrow.return_date),
+        *filters,
+    )]
+    # Only returned borrows are archived
+    if status != OPEN:
+        branches.append(_branch(
+            select(BorrowHistory.id.label("borrow_id"), BorrowHistory.user_id, BorrowHistory.book_id,
+                   BorrowHistory.borrow_date, BorrowHistory.return_date),
+            (BorrowHistory.id, BorrowHistory.user_id, BorrowHistory.book_id, BorrowHistory.borrow_date,
+             BorrowHistory.return_date),
+            *filters,
+        ))
+    history = union_all(*branches).subquery("history")
+    # The title of a deleted book is null
+    return (
+        select(history.c.borrow_id, history.c.user_id, history.c.book_id, Book.title, history.c.borrow_date,
+               history.c.return_date)
+        .select_from(history)
+        .outerjoin(Book, Book.id == history.c.book_id)
+        .order_by(history.c.borrow_date.desc(), history.c.borrow_id.desc())
+        .limit(limit)
+    )
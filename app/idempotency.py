@@ -0,0 +1,137 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+from app.config import settings
+
+# Idempotency keys of the write requests, applied by IdempotencyMiddleware: the first POST / PUT / PATCH / DELETE
+# of a user with an Idempotency-Key header runs, and its response is stored with a fingerprint of the request
+# (method, path, query string and body) for IDEMPOTENCY_TTL_SECONDS. A retry with the same key and the same request
+# gets the stored response back, with an Idempotent-Replayed header, without running the endpoint again.
+# The same key with another request, or while the first request is still running, is a 409.
+# Responses that ask for a retry (5xx, 409, 429) are not stored, the request runs again on the next attempt.
+# Keys are per user (the subject of the access token); requests without a valid access token are not tracked.
+# The in-process store is per worker: a retry served by another worker runs again unless the store is shared.
+
+IDEMPOTENT_METHODS = ("POST", "PUT", "PATCH", "DELETE")
+MAX_KEY_LENGTH = 255
+
+NEW = "new"
+REPLAYED = "replayed"
+MISMATCH = "mismatch"
+IN_PROGRESS = "in_progress"
+
+
+class StoredResponse:
+    def __init__(self, status: int, headers: List[Tuple[bytes, bytes]], body: bytes):
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+
+def request_fingerprint(method: str, path: str, query_string: bytes, body: bytes) -> str:
+    digest = hashlib.sha256()
+    for part in (method.encode(), path.encode(), query_string, body):
+        digest.update(len(part).to_bytes(8, "big"))
+        digest.update(part)
+    return digest.hexdigest()
+
+
+def is_stored(status: int) -> bool:
+    return status < 500 and status not in (409, 429)
+
+
+class IdempotencyStore:
+    """Storage interface of the idempotency keys. A shared store (e.g. Redis) implements the same methods.
+
+    begin() claims a key atomically: the first request of a key gets NEW and must call complete() or release().
+    """
+
+    def begin(self, key: str, fingerprint: str) -> Tuple[str, Optional[StoredResponse]]:
+        raise NotImplementedError
+
+    def complete(self, key: str, response: StoredResponse):
+        raise NotImplementedError
+
+    def release(self, key: str):
+        raise NotImplementedError
+
+    def size(self) -> int:
+        raise NotImplementedError
+
+
+class MemoryIdempotencyStore(IdempotencyStore):
+    """Bounded LRU of the keys with a TTL, in the memory of the process."""
+
+    def __init__(self, max_size: int, ttl_seconds: int):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.lock = threading.Lock()
+        # key -> [fingerprint, expires_at, StoredResponse or None while the request runs]
+        self.entries = OrderedDict()
+
+    def begin(self, key: str, fingerprint: str) -> Tuple[str, Optional[StoredResponse]]:
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] <= now:
+                del self.entries[key]
+                entry = None
+            if entry is None:
+                self.entries[key] = [fingerprint, now + self.ttl_seconds, None]
+                while len(self.entries) > self.max_size:
+                    self.entries.popitem(last=False)
+                return NEW, None
+            self.entries.move_to_end(key)
+            if entry[0] != fingerprint:
+                return MISMATCH, None
+            if entry[2] is None:
+                return IN_PROGRESS, None
+            return REPLAYED, entry[2]
+
+    def complete(self, key: str, response: StoredResponse):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                entry[2] = response
+
+    def release(self, key: str):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[2] is None:
+                del self.entries[key]
+
+    def size(self) -> int:
+        with self.lock:
+            return len(self.entries)
+
+
+class Idempotency:
+    """The idempotency store with the counts of the requests by result."""
+
+    def __init__(self, store: IdempotencyStore, enabled: bool = True):
+        self.store = store
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.results = {NEW: 0, REPLAYED: 0, MISMATCH: 0, IN_PROGRESS: 0}
+
+    def begin(self, key: str, fingerprint: str) -> Tuple[str, Optional[StoredResponse]]:
+        result, response = self.store.begin(key, fingerprint)
+        with self.lock:
+            self.results[result] += 1
+        return result, response
+
+    def stats(self) -> dict:
+        with self.lock:
+            results = {(result,): count for result, count in self.results.items()}
+        return {"keys": self.store.size(), "results": results}
+
+
+def create_idempotency_store(name: str) -> IdempotencyStore:
+    if name == "memory":
+        return MemoryIdempotencyStore(settings.IDEMPOTENCY_MAX_KEYS, settings.IDEMPOTENCY_TTL_SECONDS)
+    raise ValueError("Unknown IDEMPOTENCY_BACKEND: {0}".format(name))
+
+
+idempotency = Idempotency(create_idempotency_store(settings.IDEMPOTENCY_BACKEND), enabled=settings.IDEMPOTENCY_ENABLED)
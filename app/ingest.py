@@ -0,0 +1,131 @@
+from collections import Counter
+from typing import Dict, Iterable, List
+from sqlalchemy import bindparam, insert, update
+from sqlalchemy.orm import Session
+from app.config import settings
+from app.etags import CATALOG_SCOPE, bump_catalog_version
+from app.models import Author, Book, Copy
+from app.schemas import BookCreateSchema
+
+# Rows resolved per IN (...) lookup, kept below SQLite's default bound parameter limit
+LOOKUP_BATCH_SIZE = 500
+
+CREATED = "created"
+COPIES_ADDED = "copies_added"
+REJECTED = "rejected"
+
+
+def _batches(values: List, size: int = LOOKUP_BATCH_SIZE) -> Iterable[List]:
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+# Map each author name to its id, the lowest id wins if a name exists more than once
+def _author_ids(names: List[str], db: Session) -> Dict[str, int]:
+    author_ids = {}
+    for batch in _batches(names):
+        rows = db.query(Author.name, Author.id).filter(Author.name.in_(batch)).order_by(Author.id)
+        for name, author_id in rows:
+            author_ids.setdefault(name, author_id)
+    return author_ids
+
+
+# Map each isbn to its book id, the lowest id wins if an isbn exists more than once
+def _book_ids(isbns: List[str], db: Session) -> Dict[str, int]:
+    book_ids = {}
+    for batch in _batches(isbns):
+        rows = db.query(Book.isbn, Book.id).filter(Book.isbn.in_(batch)).order_by(Book.id)
+        for isbn, book_id in rows:
+            book_ids.setdefault(isbn, book_id)
+    return book_ids
+
+
+def _reject_reason(book: BookCreateSchema):
+    if not book.isbn:
+        return "isbn is required"
+    if not book.title:
+        return "title is required"
+    if not book.author:
+        return "author is required"
+    if book.copies < 0:
+        return "copies cannot be negative"
+    return None
+
+
+def _ingest_chunk(books: List[BookCreateSchema], first_index: int, db: Session) -> List[dict]:
+    results = [None] * len(books)
+    valid_rows = []
+    for position, book in enumerate(books):
+        reason = _reject_reason(book)
+        if reason:
+            results[position] = {"index": first_index + position, "isbn": book.isbn, "status": REJECTED, "reason": reason}
+        else:
+            valid_rows.append(position)
+
+    # Resolve every isbn of the chunk at once.
+    # If the book already exists, we will ignore the author or the title if they differ from the data in db
+    book_ids = _book_ids(list({books[position].isbn for position in valid_rows}), db)
+
+    # The first row with an unknown isbn creates the book, later rows with the same isbn only add copies
+    new_books = {}
+    for position in valid_rows:
+        book = books[position]
+        if book.isbn not in book_ids and book.isbn not in new_books:
+            new_books[book.isbn] = book
+
+    if new_books:
+        author_names = list({book.author for book in new_books.values()})
+        author_ids = _author_ids(author_names, db)
+        missing_authors = [name for name in author_names if name not in author_ids]
+        if missing_authors:
+            db.execute(insert(Author), [{"name": name} for name in missing_authors])
+            author_ids.update(_author_ids(missing_authors, db))
+
+        db.execute(insert(Book), [
+            {"title": book.title, "author_id": author_ids[book.author], "isbn": isbn}
+            for isbn, book in new_books.items()
+        ])
+        book_ids.update(_book_ids(list(new_books), db))
+
+    copies = []
+    added_copies = Counter()
+    for position in valid_rows:
+        book = books[position]
+        book_id = book_ids[book.isbn]
+        copies.extend({"book_id": book_id, "borrowed": False} for _ in range(book.copies))
+        added_copies[book_id] += book.copies
+        status = CREATED if new_books.pop(book.isbn, None) is not None else COPIES_ADDED
+        results[position] = {"index": first_index + position, "isbn": book.isbn, "status": status,
+                             "book_id": book_id, "copies": book.copies}
+
+    if copies:
+        db.execute(insert(Copy), copies)
+        # Keep the copy counters in the same transaction, one multi-row statement per chunk
+        db.execute(
+            update(Book)
+            .where(Book.id == bindparam("target_id"))
+            .values(total_copies=Book.total_copies + bindparam("added")),
+            [{"target_id": book_id, "added": added} for book_id, added in added_copies.items() if added]
+        )
+
+    # New books and added copies change the GET /books pages, see app/etags.py
+    if valid_rows:
+        bump_catalog_version(db, CATALOG_SCOPE)
+
+    return results
+
+
+# Bulk load books: authors and isbns are resolved per chunk and books and copies are
+# inserted with multi-row statements, committing once per chunk.
+# Returns one result per input row, in input order.
+def ingest_books(books: List[BookCreateSchema], db: Session, chunk_size: int = None) -> List[dict]:
+    chunk_size = chunk_size or settings.INGEST_CHUNK_SIZE
+    results = []
+    for start in range(0, len(books), chunk_size):
+        try:
+            results.extend(_ingest_chunk(books[start:start + chunk_size], start, db))
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+    return results
@@ -0,0 +1,76 @@
+import json
+import logging
+import sys
+import threading
+import time
+from app.config import settings
+
+# Structured (one JSON object per line), leveled logging for the app.* loggers.
+# Each call site is rate limited so a hot path cannot flood the output.
+
+
+class JsonFormatter(logging.Formatter):
+    # Attributes every LogRecord has, anything else was passed through extra=
+    RESERVED = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname.lower(),
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        entry.update({key: value for key, value in vars(record).items() if key not in self.RESERVED})
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class RateLimitFilter(logging.Filter):
+    """Lets at most `limit` records per call site (logger, line) through each `period` seconds.
+
+    The first record after a suppressed burst carries the number of dropped records.
+    """
+
+    def __init__(self, limit: int, period: float = 60.0):
+        super().__init__()
+        self.limit = limit
+        self.period = period
+        self.lock = threading.Lock()
+        self.windows = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.limit <= 0:
+            return True
+        key = (record.name, record.pathname, record.lineno)
+        now = time.monotonic()
+        with self.lock:
+            window_start, count, suppressed = self.windows.get(key, (now, 0, 0))
+            if now - window_start >= self.period:
+                window_start, count = now, 0
+            if count >= self.limit:
+                self.windows[key] = (window_start, count, suppressed + 1)
+                return False
+            self.windows[key] = (window_start, count + 1, 0)
+        if suppressed:
+            record.suppressed = suppressed
+        return True
+
+
+def setup_logging():
+    logger = logging.getLogger("app")
+    if logger.handlers:
+        return
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(JsonFormatter())
+    handler.addFilter(RateLimitFilter(settings.LOG_RATE_LIMIT_PER_MINUTE))
+    logger.addHandler(handler)
+    logger.setLevel(settings.LOG_LEVEL.upper())
+    logger.propagate = False
+
+
+def get_logger(name: str) -> logging.Logger:
+    return logging.getLogger(name)
+
+
+setup_logging()
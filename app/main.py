@@ -1,20 +1,62 @@
 from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, Request
 from fastapi.middleware.cors import CORSMiddleware
+from .config import settings
 from .database import engine
-from .routers import books, users, borrows, login
-from app import models
-from app.middlewares import catch_exceptions_middleware
+from .routers import books, users, borrows, login, metrics, reports, profiles
+from app.archive import borrow_archiver
+from app.middlewares import (CatchExceptionsMiddleware, IdempotencyMiddleware, ProfilingMiddleware,
+                             AdmissionControlMiddleware, MetricsMiddleware)
+from app.profiling import profile_endpoints
+from app.migrations import check_schema
 
-models.Base.metadata.create_all(bind=engine)
+# Refuse to start on a database that is missing migrations (python -m app.manage migrate)
+check_schema(engine)
 app = FastAPI()
 
 
+# Swap the endpoints that have an async version, keeping the route order of the sync router
+def use_async_routes(router, async_router):
+    async_routes = {(route.path, frozenset(route.methods)): route for route in async_router.routes}
+    router.routes = [async_routes.get((route.path, frozenset(route.methods)), route) for route in router.routes]
+
+
+if settings.ASYNC_DATABASE:
+    for module in (books, users, borrows, login):
+        use_async_routes(module.router, module.async_router)
+
 app.include_router(books.router, prefix="/books", tags=["Books"])
 app.include_router(users.router, prefix="/users", tags=["Users"])
 app.include_router(borrows.router, tags=["Borrows"])
 app.include_router(login.router, tags=["Users"])
+app.include_router(metrics.router, tags=["Metrics"])
+app.include_router(reports.router, prefix="/reports", tags=["Reports"])
+app.include_router(profiles.router, prefix="/profiles", tags=["Profiling"])
+
+# The sync endpoints run under cProfile when their request is profiled, see app/profiling.py
+if settings.PROFILING_ENABLED:
+    profile_endpoints(app)
+
+
+# Background archival of the returned borrows, see app/archive.py
+@app.on_event("startup")
+def start_borrow_archiver():
+    borrow_archiver.start()
+
+
+@app.on_event("shutdown")
+def stop_borrow_archiver():
+    borrow_archiver.stop()
+
 
-app.middleware("http")(catch_exceptions_middleware)
+app.add_middleware(CatchExceptionsMiddleware)
+# Outside CatchExceptionsMiddleware so it sees the error responses it must not store
+app.add_middleware(IdempotencyMiddleware)
+if settings.PROFILING_ENABLED:
+    app.add_middleware(ProfilingMiddleware)
+# Outside CatchExceptionsMiddleware so a request waiting for admission holds nothing yet
+app.add_middleware(AdmissionControlMiddleware)
+# Registered last so it is the outermost middleware and sees the final status of every request
+app.add_middleware(MetricsMiddleware)
 
 
 origins = [
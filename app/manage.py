@@ -0,0 +1,71 @@
+import argparse
+import json
+from app.archive import BorrowArchiver
+from app.config import settings
+from app.database import SessionLocal, engine
+from app.migrations import LATEST_VERSION, current_version, migrate
+from app.routers.utils import check_copy_counters
+
+# Maintenance commands, run from the project root:
+#     python -m app.manage migrate [--to VERSION] [--check]
+#     python -m app.manage check-counters [--repair]
+#     python -m app.manage archive-borrows [--batch-size N] [--max-batches N]
+
+
+def run_migrations(args):
+    with engine.connect() as conn:
+        version = current_version(conn)
+    if args.check:
+        print(json.dumps({"version": version, "latest": LATEST_VERSION}, indent=2))
+        return 1 if version < LATEST_VERSION else 0
+    applied = migrate(engine, target=args.to)
+    with engine.connect() as conn:
+        version = current_version(conn)
+    print(json.dumps({"applied": applied, "version": version, "latest": LATEST_VERSION}, indent=2))
+    return 0
+
+
+def check_counters(args):
+    db = SessionLocal()
+    try:
+        mismatches = check_copy_counters(db, repair=args.repair)
+        if args.repair:
+            db.commit()
+    finally:
+        db.close()
+    print(json.dumps({"mismatches": len(mismatches), "repaired": len(mismatches) if args.repair else 0, "books": mismatches}, indent=2))
+    return 1 if mismatches and not args.repair else 0
+
+
+# Move the returned borrows to borrow_history, all of them unless --max-batches
+def archive_borrows(args):
+    archiver = BorrowArchiver(engine, batch_size=args.batch_size, max_batches=args.max_batches, interval_seconds=0)
+    archived = archiver.run(args.max_batches)
+    print(json.dumps({"archived": archived}, indent=2))
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m app.manage")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    migrations = commands.add_parser("migrate", help="Apply the pending schema migrations")
+    migrations.add_argument("--to", type=int, help="Stop at this schema version")
+    migrations.add_argument("--check", action="store_true", help="Only report the schema version, exit 1 if migrations are pending")
+    migrations.set_defaults(handler=run_migrations)
+
+    counters = commands.add_parser("check-counters", help="Compare the copy counters of books with the copies table")
+    counters.add_argument("--repair", action="store_true", help="Rewrite the counters that are off")
+    counters.set_defaults(handler=check_counters)
+
+    archive = commands.add_parser("archive-borrows", help="Move the returned borrows to the borrow history")
+    archive.add_argument("--batch-size", type=int, default=settings.BORROW_ARCHIVE_BATCH_SIZE, help="Borrows moved per transaction")
+    archive.add_argument("--max-batches", type=int, help="Stop after this many transactions")
+    archive.set_defaults(handler=archive_borrows)
+
+    args = parser.parse_args(argv)
+    return args.handler(args)
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
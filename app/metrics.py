@@ -0,0 +1,214 @@
+import threading
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from sqlalchemy import event
+
+# In-process metrics exported in the Prometheus text format on GET /metrics.
+# Values are per process, Prometheus aggregates the workers.
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(label_names, label_values, extra=()):
+    pairs = list(zip(label_names, label_values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _format_value(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    type_name = None
+
+    def __init__(self, name: str, documentation: str, label_names=(), callback=None):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        # callback returns the current value, or a {label values: value} dict, at export time
+        self.callback = callback
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def _samples(self):
+        if self.callback is not None:
+            value = self.callback()
+            return value.items() if isinstance(value, dict) else [((), value)]
+        with self.lock:
+            return list(self.values.items())
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        for label_values, value in self._samples():
+            lines.append(f"{self.name}{_format_labels(self.label_names, label_values)} {_format_value(value)}")
+        return lines
+
+
+class Counter(Metric):
+    type_name = "counter"
+
+    def inc(self, amount=1, labels=()):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    type_name = "gauge"
+
+    def inc(self, amount=1, labels=()):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def dec(self, amount=1, labels=()):
+        self.inc(-amount, labels)
+
+    def set(self, value, labels=()):
+        with self.lock:
+            self.values[labels] = value
+
+
+class Histogram(Metric):
+    type_name = "histogram"
+
+    def __init__(self, name: str, documentation: str, label_names=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, labels=()):
+        with self.lock:
+            series = self.values.get(labels)
+            if series is None:
+                series = self.values[labels] = [[0] * len(self.buckets), 0, 0.0]
+            index = bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                series[0][index] += 1
+            series[1] += 1
+            series[2] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        with self.lock:
+            series_list = [(labels, list(counts), count, total) for labels, (counts, count, total) in self.values.items()]
+        for label_values, bucket_counts, count, total in series_list:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.label_names, label_values, [("le", _format_value(float(bound)))])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.label_names, label_values, [("le", "+Inf")])
+            lines.append(f"{self.name}_bucket{labels} {count}")
+            lines.append(f"{self.name}_count{_format_labels(self.label_names, label_values)} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(self.label_names, label_values)} {_format_value(total)}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        self.lock = threading.Lock()
+
+    def register(self, metric: Metric) -> Metric:
+        with self.lock:
+            self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, label_names=(), callback=None) -> Counter:
+        return self.register(Counter(name, documentation, label_names, callback))
+
+    def gauge(self, name, documentation, label_names=(), callback=None) -> Gauge:
+        return self.register(Gauge(name, documentation, label_names, callback))
+
+    def histogram(self, name, documentation, label_names=(), buckets=LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, label_names, buckets))
+
+    def render(self) -> str:
+        with self.lock:
+            metrics = list(self.metrics)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+REQUEST_LATENCY = registry.histogram("http_request_duration_seconds", "Request latency", ("method", "route", "status"))
+REQUESTS_IN_FLIGHT = registry.gauge("http_requests_in_flight", "Requests being served")
+REQUEST_SQL_STATEMENTS = registry.histogram("http_request_sql_statements", "SQL statements issued per request",
+                                            ("method", "route"), COUNT_BUCKETS)
+REQUEST_SQL_SECONDS = registry.histogram("http_request_sql_duration_seconds", "Time spent in SQL per request",
+                                         ("method", "route"))
+SQL_STATEMENT_SECONDS = registry.histogram("sql_statement_duration_seconds", "SQL statement latency")
+POOL_CHECKOUT_WAIT = registry.histogram("db_pool_checkout_wait_seconds", "Time waited for a pooled connection")
+ADMISSION_QUEUE_SECONDS = registry.histogram("admission_queue_seconds", "Time admitted requests waited for a slot of their route",
+                                             ("method", "route"))
+
+
+class RequestStats:
+    """SQL work done on behalf of the current request."""
+
+    __slots__ = ("sql_statements", "sql_seconds", "pool_wait_seconds", "statements")
+
+    def __init__(self):
+        self.sql_statements = 0
+        self.sql_seconds = 0.0
+        self.pool_wait_seconds = 0.0
+        # (statement, seconds) of every statement, only for a profiled request (app/profiling.py)
+        self.statements = None
+
+
+# Set by metrics_middleware, the request's sync endpoint and dependencies see it through the
+# context copied into the thread pool
+request_stats: ContextVar = ContextVar("request_stats", default=None)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info["query_started"].pop()
+    elapsed = time.perf_counter() - started
+    SQL_STATEMENT_SECONDS.observe(elapsed)
+    stats = request_stats.get()
+    if stats is not None:
+        stats.sql_statements += 1
+        stats.sql_seconds += elapsed
+        if stats.statements is not None:
+            stats.statements.append((statement, elapsed))
+
+
+# Count and time every statement, and time waiting for a connection from the pool
+def instrument_engine(engine):
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+
+    # The pool has no event before a checkout, so its _do_get (wait for / open a connection) is wrapped
+    pool = engine.pool
+    do_get = pool._do_get
+
+    def timed_do_get():
+        started = time.perf_counter()
+        try:
+            return do_get()
+        finally:
+            elapsed = time.perf_counter() - started
+            POOL_CHECKOUT_WAIT.observe(elapsed)
+            stats = request_stats.get()
+            if stats is not None:
+                stats.pool_wait_seconds += elapsed
+
+    pool._do_get = timed_do_get
+    if hasattr(pool, "checkedout"):
+        registry.gauge("db_pool_checked_out_connections", "Connections currently checked out of the pool",
+                       callback=pool.checkedout)
@@ -1,21 +1,366 @@
-from fastapi import FastAPI, Request
+import random
+import time
+from datetime import datetime
+from typing import Optional
 from fastapi.responses import JSONResponse
 from fastapi.exceptions import HTTPException
+from jose import jwt, JWTError
 from sqlalchemy.exc import SQLAlchemyError, IntegrityError
+from starlette.concurrency import run_in_threadpool
+from starlette.routing import Match
+from app.admission import AdmissionRejected, admission_controller
+from app.auth import SECRET_KEY, ALGORITHM, principal_cache, remove_bearer_prefix
+from app.database import SessionLocal
+from app.idempotency import (IDEMPOTENT_METHODS, MAX_KEY_LENGTH, NEW, REPLAYED, MISMATCH, StoredResponse,
+                             idempotency, is_stored, request_fingerprint)
+from app.config import settings
+from app.log import get_logger
+from app.models import User
+from app.profiling import PROFILE_HEADER, PROFILE_ID_HEADER, RequestProfile, current_profile, profile_store
+from app.metrics import (REQUEST_LATENCY, REQUESTS_IN_FLIGHT, REQUEST_SQL_STATEMENTS, REQUEST_SQL_SECONDS,
+                         ADMISSION_QUEUE_SECONDS, RequestStats, request_stats)
 
-async def catch_exceptions_middleware(request: Request, call_next):
-    try:
-        response = await call_next(request)
-        return response
-    except HTTPException as http_exception:
-        return JSONResponse(status_code=http_exception.status_code, content={"detail": http_exception.detail})
-    except IntegrityError as integrity_error:
-        print("IntegrityError:", integrity_error)
+logger = get_logger(__name__)
+
+# Requests slower than this are logged with their SQL statistics
+SLOW_REQUEST_SECONDS = 1.0
+
+# The middlewares are plain ASGI callables rather than BaseHTTPMiddleware: BaseHTTPMiddleware runs the
+# app in a separate task and buffers the response body in an unbounded queue, so a streamed response
+# (GET /books/export) would be read from the database as fast as possible whatever the client's pace.
+
+
+def error_response(exception: Exception, path: str) -> JSONResponse:
+    if isinstance(exception, HTTPException):
+        return JSONResponse(status_code=exception.status_code, content={"detail": exception.detail})
+    if isinstance(exception, IntegrityError):
+        logger.warning("IntegrityError: %s", exception.orig, extra={"path": path})
         return JSONResponse(status_code=400, content={"detail": "IntegrityError occurred"})
-    except SQLAlchemyError as db_exception:
-        print("SQLAlchemy exception:", db_exception)
-        return JSONResponse(status_code=500, content={"detail": "Internal server error"})
-    except Exception as exception:
-        print("Exception:", exception)
+    if isinstance(exception, SQLAlchemyError):
+        logger.error("SQLAlchemy exception", exc_info=exception, extra={"path": path})
         return JSONResponse(status_code=500, content={"detail": "Internal server error"})
+    logger.error("Unhandled exception", exc_info=exception, extra={"path": path})
+    return JSONResponse(status_code=500, content={"detail": "Internal server error"})
+
+
+class CatchExceptionsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        response_started = False
+
+        async def send_wrapper(message):
+            nonlocal response_started
+            if message["type"] == "http.response.start":
+                response_started = True
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        except Exception as exception:
+            if response_started:
+                # Too late for an error response, the server closes the connection
+                logger.error("Exception after the response started", exc_info=exception, extra={"path": scope["path"]})
+                raise
+            await error_response(exception, scope["path"])(scope, receive, send)
+
+
+# Route template of the matched endpoint ("/books/{book_id}"), so the labels don't grow with ids
+_route_paths = {}
+
+def route_path(scope) -> str:
+    endpoint = scope.get("endpoint")
+    if endpoint is None:
+        return "unmatched"
+    path = _route_paths.get(endpoint)
+    if path is None:
+        for route in scope["app"].routes:
+            if getattr(route, "endpoint", None) is endpoint:
+                path = _route_paths[endpoint] = route.path
+                break
+        else:
+            path = "unmatched"
+    return path
+
+
+# Records latency (until the last byte of the body is sent), in-flight requests and the SQL work of
+# every request, exported on GET /metrics
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = RequestStats()
+        token = request_stats.set(stats)
+        REQUESTS_IN_FLIGHT.inc()
+        started = time.perf_counter()
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - started
+            REQUESTS_IN_FLIGHT.dec()
+            request_stats.reset(token)
+            method = scope["method"]
+            route = route_path(scope)
+            REQUEST_LATENCY.observe(elapsed, (method, route, status))
+            REQUEST_SQL_STATEMENTS.observe(stats.sql_statements, (method, route))
+            REQUEST_SQL_SECONDS.observe(stats.sql_seconds, (method, route))
+            if elapsed >= SLOW_REQUEST_SECONDS:
+                logger.warning("Slow request", extra={
+                    "method": method, "route": route, "status": status, "duration_ms": round(elapsed * 1000, 1),
+                    "sql_statements": stats.sql_statements, "sql_ms": round(stats.sql_seconds * 1000, 1),
+                    "pool_wait_ms": round(stats.pool_wait_seconds * 1000, 1),
+                })
+
+
+# The route a request will be dispatched to, None when none matches (404 or 405)
+def match_route(scope):
+    for route in scope["app"].routes:
+        match, child_scope = route.matches(scope)
+        if match == Match.FULL:
+            return route
+    return None
+
+
+# The user of a valid access token, None for anonymous requests. Keys the rate limit and the idempotency keys:
+# anonymous requests are not rate limited, all the clients behind a proxy would share one address.
+def request_user_key(scope):
+    for name, value in scope["headers"]:
+        if name == b"authorization":
+            scheme, _, token = value.decode("latin-1").partition(" ")
+            if scheme.lower() != "bearer":
+                return None
+            try:
+                return jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM]).get("sub")
+            except JWTError:
+                return None
+    return None
+
+
+# Admission control in front of the endpoints, see app/admission.py. The route's slot is held until the
+# last byte of the response is sent (a streamed export holds it for its whole duration).
+class AdmissionControlMiddleware:
+    def __init__(self, app, controller=None):
+        self.app = app
+        self.controller = controller or admission_controller
+
+    async def __call__(self, scope, receive, send):
+        controller = self.controller
+        if scope["type"] != "http" or not controller.enabled:
+            await self.app(scope, receive, send)
+            return
+        route = match_route(scope)
+        if route is None or route.path in settings.ADMISSION_EXEMPT_ROUTES:
+            await self.app(scope, receive, send)
+            return
+
+        method = scope["method"]
+        limiter = controller.limiter(method, route.path)
+        try:
+            controller.check_rate(request_user_key(scope))
+            queued = await limiter.acquire()
+        except AdmissionRejected as rejection:
+            controller.count_rejection(method, route.path, rejection.reason)
+            # The endpoint is not reached, set it for the route label of MetricsMiddleware
+            scope["endpoint"] = route.endpoint
+            response = JSONResponse(status_code=rejection.status_code, content={"detail": rejection.detail},
+                                    headers={"Retry-After": str(rejection.retry_after)})
+            await response(scope, receive, send)
+            return
+
+        ADMISSION_QUEUE_SECONDS.observe(queued, (method, route.path))
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            limiter.release()
+
+
+def header_value(scope, name: bytes) -> Optional[str]:
+    for header, value in scope["headers"]:
+        if header == name:
+            return value.decode("latin-1")
+    return None
+
+
+# Idempotency-Key of the write requests, see app/idempotency.py. The request body is read up front for the
+# fingerprint and handed to the endpoint as is. Inside admission control, so a replay is still rate limited.
+class IdempotencyMiddleware:
+    def __init__(self, app, idempotency_keys=None):
+        self.app = app
+        self.idempotency = idempotency_keys or idempotency
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.idempotency.enabled or scope["method"] not in IDEMPOTENT_METHODS:
+            await self.app(scope, receive, send)
+            return
+        key = header_value(scope, b"idempotency-key")
+        user = request_user_key(scope) if key is not None else None
+        if user is None:
+            await self.app(scope, receive, send)
+            return
+        if not key or len(key) > MAX_KEY_LENGTH:
+            response = JSONResponse(status_code=400, content={"detail": f"Idempotency-Key must be 1 to {MAX_KEY_LENGTH} characters"})
+            await response(scope, receive, send)
+            return
+
+        chunks = []
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return
+            chunks.append(message.get("body", b""))
+            if not message.get("more_body", False):
+                break
+        body = b"".join(chunks)
+
+        store_key = f"{user}:{key}"
+        fingerprint = request_fingerprint(scope["method"], scope["path"], scope["query_string"], body)
+        result, stored = self.idempotency.begin(store_key, fingerprint)
+        if result != NEW:
+            # The endpoint is not reached, set it for the route label of MetricsMiddleware
+            route = match_route(scope)
+            if route is not None:
+                scope["endpoint"] = route.endpoint
+        if result == REPLAYED:
+            await send({"type": "http.response.start", "status": stored.status,
+                        "headers": stored.headers + [(b"idempotent-replayed", b"true")]})
+            await send({"type": "http.response.body", "body": stored.body})
+            return
+        if result != NEW:
+            if result == MISMATCH:
+                detail = "Idempotency-Key already used for another request"
+            else:
+                detail = "A request with this Idempotency-Key is in progress"
+            response = JSONResponse(status_code=409, content={"detail": detail}, headers={"Retry-After": "1"})
+            await response(scope, receive, send)
+            return
+
+        body_sent = False
+
+        async def receive_body():
+            nonlocal body_sent
+            if not body_sent:
+                body_sent = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            return await receive()
+
+        start, response_chunks, complete = None, [], False
+
+        async def send_wrapper(message):
+            nonlocal start, complete
+            if message["type"] == "http.response.start":
+                start = message
+            elif message["type"] == "http.response.body":
+                response_chunks.append(message.get("body", b""))
+                complete = not message.get("more_body", False)
+            await send(message)
+
+        try:
+            await self.app(scope, receive_body, send_wrapper)
+        finally:
+            if complete and is_stored(start["status"]):
+                self.idempotency.store.complete(store_key, StoredResponse(
+                    start["status"], list(start.get("headers", [])), b"".join(response_chunks)))
+            else:
+                self.idempotency.store.release(store_key)
+
+
+def _load_user(username: str) -> Optional[User]:
+    db = SessionLocal()
+    try:
+        return db.query(User).filter(User.username == username).first()
+    finally:
+        db.close()
+
+
+# Whether the access token of the request is an admin's, from the principal cache when it has the token
+async def is_admin_request(scope) -> bool:
+    authorization = header_value(scope, b"authorization")
+    if authorization is None:
+        return False
+    user = principal_cache.get(remove_bearer_prefix(authorization))
+    if user is None:
+        username = request_user_key(scope)
+        if username is None:
+            return False
+        user = await run_in_threadpool(_load_user, username)
+    return user is not None and bool(user.is_admin)
+
+
+# Profiling of the requests of admins with an X-Profile header and of a sample of all the requests, see
+# app/profiling.py. Inside admission control, so the time waiting for admission is not part of the profile.
+class ProfilingMiddleware:
+    def __init__(self, app, store=None, sample_rate: float = None):
+        self.app = app
+        self.store = store or profile_store
+        self.sample_rate = settings.PROFILING_SAMPLE_RATE if sample_rate is None else sample_rate
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        requested = header_value(scope, PROFILE_HEADER) not in (None, "", "0", "false")
+        sampled = not requested and self.sample_rate > 0 and random.random() < self.sample_rate
+        if requested:
+            requested = await is_admin_request(scope)
+        if not requested and not sampled:
+            await self.app(scope, receive, send)
+            return
+
+        profile = RequestProfile(sampled)
+        stats = request_stats.get()
+        if stats is not None:
+            stats.statements = profile.statements
+        token = current_profile.set(profile)
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                message = {**message, "headers": list(message.get("headers", [])) + [(PROFILE_ID_HEADER, profile.id.encode())]}
+            await send(message)
 
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            duration = time.perf_counter() - started
+            current_profile.reset(token)
+            if stats is not None:
+                stats.statements = None
+            summary = {
+                "id": profile.id,
+                "timestamp": datetime.utcfromtimestamp(profile.started_at).isoformat(),
+                "method": scope["method"],
+                "route": route_path(scope),
+                "path": scope["path"],
+                "query_string": scope["query_string"].decode("latin-1"),
+                "status": status,
+                "duration_ms": round(duration * 1000, 3),
+                "sql_statements": len(profile.statements),
+                "sql_ms": round(sum(elapsed for _, elapsed in profile.statements) * 1000, 3),
+                "sampled": profile.sampled,
+                "python_profile": profile.profiler is not None,
+            }
+            try:
+                await run_in_threadpool(self.store.save, profile, summary)
+            except Exception as e:
+                logger.error("Cannot save the request profile", exc_info=e, extra={"path": scope["path"]})
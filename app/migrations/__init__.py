@@ -0,0 +1,114 @@
+import importlib
+import pkgutil
+import warnings
+from datetime import datetime
+from typing import List
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, func, inspect, select, text
+from sqlalchemy.exc import SAWarning
+from app.log import get_logger
+
+# Versioned schema migrations, applied with `python -m app.manage migrate`.
+# Every module named mNNNN_<name>.py in this package is one migration to schema version NNNN and defines:
+#     description   one line shown in the logs and recorded in schema_version
+#     transactional False when its statements cannot run inside a transaction (CREATE INDEX CONCURRENTLY),
+#                   it then runs on an autocommit connection and must be safe to re-run after an interruption
+#     upgrade(conn) the schema changes, written against the tables as they are at that version (never app.models)
+
+logger = get_logger(__name__)
+
+metadata = MetaData()
+
+schema_version = Table(
+    "schema_version", metadata,
+    Column("version", Integer, primary_key=True),
+    Column("description", String, nullable=False),
+    Column("applied_at", DateTime, nullable=False),
+)
+
+# Key of the Postgres advisory lock that keeps two deployments from migrating at the same time
+MIGRATION_LOCK_KEY = 72317001
+
+
+def load_migrations() -> list:
+    migrations = []
+    for module_info in pkgutil.iter_modules(__path__):
+        name = module_info.name
+        if name.startswith("m") and name[1:5].isdigit():
+            migrations.append((int(name[1:5]), importlib.import_module(f"{__name__}.{name}")))
+    return sorted(migrations, key=lambda migration: migration[0])
+
+
+MIGRATIONS = load_migrations()
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def current_version(conn) -> int:
+    if not inspect(conn).has_table("schema_version"):
+        return 0
+    return conn.execute(select(func.max(schema_version.c.version))).scalar() or 0
+
+
+def _record(conn, version: int, module):
+    conn.execute(schema_version.insert().values(version=version, description=module.description, applied_at=datetime.utcnow()))
+
+
+# Apply the pending migrations up to target (the latest by default), returns the versions applied
+def migrate(engine, target: int = None) -> List[int]:
+    applied = []
+    # The lock is held by its own autocommit connection: an open transaction would make
+    # CREATE INDEX CONCURRENTLY wait for it
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as lock_conn:
+        if engine.dialect.name == "postgresql":
+            lock_conn.execute(text("SELECT pg_advisory_lock(:key)"), {"key": MIGRATION_LOCK_KEY})
+        try:
+            with engine.begin() as conn:
+                metadata.create_all(conn)
+                version = current_version(conn)
+            for number, module in MIGRATIONS:
+                if number <= version or (target is not None and number > target):
+                    continue
+                logger.info("Applying migration", extra={"version": number, "description": module.description})
+                if module.transactional:
+                    with engine.begin() as conn:
+                        module.upgrade(conn)
+                        _record(conn, number, module)
+                else:
+                    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+                        module.upgrade(conn)
+                    with engine.begin() as conn:
+                        _record(conn, number, module)
+                applied.append(number)
+        finally:
+            if engine.dialect.name == "postgresql":
+                lock_conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": MIGRATION_LOCK_KEY})
+    return applied
+
+
+# Run at startup instead of creating the tables: serving against an older schema would fail on missing
+# columns or, worse, run without its constraints and indexes
+def check_schema(engine):
+    with engine.connect() as conn:
+        version = current_version(conn)
+    if version < LATEST_VERSION:
+        raise RuntimeError(
+            f"The database schema is at version {version}, this release needs version {LATEST_VERSION}. "
+            "Run `python -m app.manage migrate` first."
+        )
+    if version > LATEST_VERSION:
+        logger.warning("The database schema is newer than this release", extra={"version": version, "expected": LATEST_VERSION})
+
+
+# Drop every table and migrate from scratch, for benchmarks and throwaway databases only
+def reset_database(engine):
+    existing = MetaData()
+    partitions = set()
+    if engine.dialect.name == "postgresql":
+        # Partitions are dropped with their partitioned table
+        with engine.connect() as conn:
+            partitions = {name for name, in conn.execute(text("SELECT relname FROM pg_class WHERE relispartition"))}
+    with warnings.catch_warnings():
+        # Expression indexes can't be reflected, they are dropped with their table anyway
+        warnings.simplefilter("ignore", SAWarning)
+        existing.reflect(bind=engine, only=lambda name, _: name not in partitions)
+    existing.drop_all(bind=engine)
+    migrate(engine)
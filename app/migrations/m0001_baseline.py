@@ -0,0 +1,52 @@
+from sqlalchemy import Boolean, Column, DateTime, ForeignKey, Integer, MetaData, String, Table
+
+# The schema as it was before migrations existed, frozen here so later model changes don't alter it.
+# Tables that already exist (databases created by Base.metadata.create_all) are left as they are.
+
+description = "Baseline schema"
+transactional = True
+
+metadata = MetaData()
+
+Table(
+    "authors", metadata,
+    Column("id", Integer, primary_key=True),
+    Column("name", String),
+)
+
+Table(
+    "books", metadata,
+    Column("id", Integer, primary_key=True),
+    Column("author_id", Integer, ForeignKey("authors.id")),
+    Column("title", String),
+    Column("isbn", String),
+)
+
+Table(
+    "copies", metadata,
+    Column("id", Integer, primary_key=True),
+    Column("book_id", Integer, ForeignKey("books.id")),
+    Column("borrowed", Boolean),
+)
+
+Table(
+    "users", metadata,
+    Column("id", Integer, primary_key=True),
+    Column("username", String),
+    Column("email", String),
+    Column("password", String),
+    Column("is_admin", Boolean),
+)
+
+Table(
+    "borrows", metadata,
+    Column("id", Integer, primary_key=True),
+    Column("copy_id", Integer, ForeignKey("copies.id")),
+    Column("user_id", Integer, ForeignKey("users.id")),
+    Column("borrow_date", DateTime),
+    Column("return_date", DateTime),
+)
+
+
+def upgrade(conn):
+    metadata.create_all(conn, checkfirst=True)
@@ -0,0 +1,21 @@
+from sqlalchemy import text
+from app.migrations.operations import column_names
+
+# Denormalized copy counters on books, filled from the copies table.
+# Databases created by create_all after the counters were introduced already have them.
+
+description = "Copy counters on books"
+transactional = True
+
+
+def upgrade(conn):
+    columns = column_names(conn, "books")
+    if "total_copies" in columns and "borrowed_copies" in columns:
+        return
+    conn.execute(text("ALTER TABLE books ADD COLUMN total_copies INTEGER DEFAULT 0 NOT NULL"))
+    conn.execute(text("ALTER TABLE books ADD COLUMN borrowed_copies INTEGER DEFAULT 0 NOT NULL"))
+    conn.execute(text("""
+        UPDATE books SET
+            total_copies = (SELECT count(*) FROM copies WHERE copies.book_id = books.id),
+            borrowed_copies = (SELECT count(*) FROM copies WHERE copies.book_id = books.id AND copies.borrowed)
+    """))
@@ -0,0 +1,16 @@
+from sqlalchemy import text
+from app.migrations.operations import create_index
+
+# pg_trgm trigram indexes behind GET /books/search and the title / author filters of GET /books.
+# Other databases use the in-process search index, see app/search.py.
+
+description = "Trigram search indexes (Postgres)"
+transactional = False
+
+
+def upgrade(conn):
+    if conn.dialect.name != "postgresql":
+        return
+    conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+    create_index(conn, "ix_books_title_trgm", "books", "title gin_trgm_ops", using="gin")
+    create_index(conn, "ix_authors_name_trgm", "authors", "name gin_trgm_ops", using="gin")
@@ -0,0 +1,55 @@
+from sqlalchemy import text
+
+# Nothing kept authors, books and users unique so far. Before the unique indexes of the next migration:
+# - authors with the same name are merged into the one with the lowest id,
+# - books with the same isbn are merged into the one with the lowest id (the one the ingestion already
+#   picked), their copies move over,
+# - duplicate usernames or emails belong to different people and can't be merged automatically,
+#   the migration stops and lists them.
+
+description = "Merge duplicate authors and books"
+transactional = True
+
+
+def _duplicate_users(conn, column: str) -> list:
+    return [row[0] for row in conn.execute(text(
+        f"SELECT {column} FROM users WHERE {column} IS NOT NULL GROUP BY {column} HAVING count(*) > 1"
+    ))]
+
+
+def upgrade(conn):
+    duplicates = {column: _duplicate_users(conn, column) for column in ("username", "email")}
+    if any(duplicates.values()):
+        raise RuntimeError(f"Duplicate users must be resolved by hand before migrating: {duplicates}")
+
+    conn.execute(text("""
+        UPDATE books SET author_id = (
+            SELECT min(keep.id) FROM authors keep JOIN authors dup ON keep.name = dup.name
+            WHERE dup.id = books.author_id
+        )
+        WHERE author_id IN (
+            SELECT id FROM authors WHERE id NOT IN (SELECT min(id) FROM authors GROUP BY name) AND name IS NOT NULL
+        )
+    """))
+    conn.execute(text(
+        "DELETE FROM authors WHERE name IS NOT NULL AND id NOT IN (SELECT min(id) FROM authors GROUP BY name)"
+    ))
+
+    duplicate_books = """
+        SELECT id FROM books WHERE isbn IS NOT NULL AND id NOT IN (SELECT min(id) FROM books GROUP BY isbn)
+    """
+    conn.execute(text(f"""
+        UPDATE copies SET book_id = (
+            SELECT min(keep.id) FROM books keep JOIN books dup ON keep.isbn = dup.isbn
+            WHERE dup.id = copies.book_id
+        )
+        WHERE book_id IN ({duplicate_books})
+    """))
+    # Counters of the books that received copies
+    conn.execute(text("""
+        UPDATE books SET
+            total_copies = (SELECT count(*) FROM copies WHERE copies.book_id = books.id),
+            borrowed_copies = (SELECT count(*) FROM copies WHERE copies.book_id = books.id AND copies.borrowed)
+        WHERE id IN (SELECT min(id) FROM books WHERE isbn IS NOT NULL GROUP BY isbn HAVING count(*) > 1)
+    """))
+    conn.execute(text(f"DELETE FROM books WHERE id IN ({duplicate_books})"))
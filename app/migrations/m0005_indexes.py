@@ -0,0 +1,21 @@
+from app.migrations.operations import create_index
+
+# Unique indexes on the natural keys and the indexes of the hot lookups:
+# register and login (users.username, users.email), the ingestion (books.isbn, authors.name),
+# free copy lookups (copies.book_id, borrowed) and open borrows of a user (borrows.user_id, return_date).
+# Also the copy counter indexes, for databases that got the counters from the previous migrations.
+
+description = "Unique constraints and lookup indexes"
+transactional = False
+
+
+def upgrade(conn):
+    create_index(conn, "ix_users_username", "users", "username", unique=True)
+    create_index(conn, "ix_users_email", "users", "email", unique=True)
+    create_index(conn, "ix_books_isbn", "books", "isbn", unique=True)
+    create_index(conn, "ix_authors_name", "authors", "name", unique=True)
+    create_index(conn, "ix_copies_book_id_borrowed", "copies", "book_id, borrowed")
+    create_index(conn, "ix_borrows_user_id_return_date", "borrows", "user_id, return_date")
+    create_index(conn, "ix_books_total_copies", "books", "total_copies")
+    create_index(conn, "ix_books_borrowed_copies", "books", "borrowed_copies")
+    create_index(conn, "ix_books_free_copies", "books", "(total_copies - borrowed_copies)")
@@ -0,0 +1,39 @@
+from datetime import datetime
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, text
+from app.migrations.operations import column_names
+
+# Change counters behind the ETags of the book endpoints: a version and a modification time on every book,
+# and the sharded catalog_versions counters of the "books" (catalog changes) and "availability" (copy counters)
+# scopes. The shard count is app.etags.CATALOG_VERSION_SHARDS.
+
+description = "Book versions and catalog versions"
+transactional = True
+
+SCOPES = ("books", "availability")
+SHARDS = 16
+
+metadata = MetaData()
+
+catalog_versions = Table(
+    "catalog_versions", metadata,
+    Column("scope", String, primary_key=True),
+    Column("shard", Integer, primary_key=True),
+    Column("version", Integer, nullable=False, server_default="0"),
+    Column("updated_at", DateTime),
+)
+
+
+def upgrade(conn):
+    now = datetime.utcnow()
+    columns = column_names(conn, "books")
+    if "version" not in columns:
+        conn.execute(text("ALTER TABLE books ADD COLUMN version INTEGER DEFAULT 1 NOT NULL"))
+    if "updated_at" not in columns:
+        conn.execute(text("ALTER TABLE books ADD COLUMN updated_at TIMESTAMP"))
+        conn.execute(text("UPDATE books SET updated_at = :now"), {"now": now})
+
+    metadata.create_all(conn, checkfirst=True)
+    if not conn.execute(text("SELECT 1 FROM catalog_versions")).first():
+        conn.execute(catalog_versions.insert(), [
+            {"scope": scope, "shard": shard, "version": 0, "updated_at": now} for scope in SCOPES for shard in range(SHARDS)
+        ])
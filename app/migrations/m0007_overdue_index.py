@@ -0,0 +1,11 @@
+from app.migrations.operations import create_index
+
+# Partial index of the open borrows by borrow date, read by the overdue report (app/reports.py):
+# the overdue borrows are the open ones borrowed before a cutoff date, in borrow date order.
+
+description = "Index of the open borrows by borrow date"
+transactional = False
+
+
+def upgrade(conn):
+    create_index(conn, "ix_borrows_open_borrow_date", "borrows", "borrow_date, id", where="return_date IS NULL")
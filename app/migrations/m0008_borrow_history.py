@@ -0,0 +1,28 @@
+from sqlalchemy import Column, DateTime, Integer, MetaData, Table
+from app.migrations.operations import create_index
+
+# Hot/cold split of the borrows: the returned borrows are moved by the archiver (app/archive.py) from borrows
+# to borrow_history, a table partitioned by month of borrow_date on Postgres (the partitions are created by the
+# archiver as needed), so borrows only keeps the open borrows and the ones returned since the last run.
+# The partial index finds the returned borrows to archive without reading the open ones.
+
+description = "Borrow history table"
+transactional = False
+
+metadata = MetaData()
+
+borrow_history = Table(
+    "borrow_history", metadata,
+    Column("id", Integer, primary_key=True, autoincrement=False),
+    Column("borrow_date", DateTime, primary_key=True),
+    Column("user_id", Integer, nullable=False),
+    Column("copy_id", Integer, nullable=False),
+    Column("book_id", Integer, nullable=False),
+    Column("return_date", DateTime, nullable=False),
+    postgresql_partition_by="RANGE (borrow_date)",
+)
+
+
+def upgrade(conn):
+    metadata.create_all(conn, checkfirst=True)
+    create_index(conn, "ix_borrows_returned_id", "borrows", "id", where="return_date IS NOT NULL")
@@ -0,0 +1,18 @@
+from app.migrations.operations import create_index
+
+# Indexes of the borrow history endpoints (app/history.py): the borrows of a user, and of a book, newest first
+# with the id as tie-breaker of the keyset pagination, in both borrows and borrow_history. The borrows of a
+# book are found in borrows through the copies of the book.
+
+description = "Borrow history indexes"
+transactional = False
+
+
+def upgrade(conn):
+    create_index(conn, "ix_borrows_user_id_borrow_date", "borrows", "user_id, borrow_date, id")
+    create_index(conn, "ix_borrows_copy_id", "borrows", "copy_id")
+    # borrow_history is partitioned on Postgres, its indexes are built on every partition
+    create_index(conn, "ix_borrow_history_user_id_borrow_date", "borrow_history", "user_id, borrow_date, id",
+                 concurrently=False)
+    create_index(conn, "ix_borrow_history_book_id_borrow_date", "borrow_history", "book_id, borrow_date, id",
+                 concurrently=False)
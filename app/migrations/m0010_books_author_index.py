@@ -0,0 +1,11 @@
+from app.migrations.operations import create_index
+
+# The books of an author: the author side of GET /books/search on Postgres (app/search.py) finds the matching
+# authors through their trigram index, then their books through this one.
+
+description = "Books by author index"
+transactional = False
+
+
+def upgrade(conn):
+    create_index(conn, "ix_books_author_id", "books", "author_id")
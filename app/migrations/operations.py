@@ -0,0 +1,33 @@
+from typing import List
+from sqlalchemy import inspect, text
+
+# Building blocks of the migrations. Every operation checks the current state first, so a migration
+# interrupted halfway can simply be run again.
+
+
+def column_names(conn, table: str) -> List[str]:
+    return [column["name"] for column in inspect(conn).get_columns(table)]
+
+
+# Create an index without blocking writes: CONCURRENTLY on Postgres (the connection must be in autocommit
+# mode), a plain CREATE INDEX elsewhere. columns is the SQL of the indexed columns or expressions,
+# where the SQL condition of a partial index. Partitioned tables take concurrently=False (Postgres can't
+# build their indexes concurrently).
+def create_index(conn, name: str, table: str, columns: str, unique: bool = False, using: str = None, where: str = None,
+                 concurrently: bool = True):
+    unique_sql = "UNIQUE " if unique else ""
+    where_sql = f" WHERE {where}" if where else ""
+    if conn.dialect.name == "postgresql" and concurrently:
+        # An interrupted or failed CREATE INDEX CONCURRENTLY leaves an invalid index behind, build it again
+        invalid = conn.execute(text(
+            "SELECT 1 FROM pg_index JOIN pg_class ON pg_class.oid = pg_index.indexrelid "
+            "WHERE pg_class.relname = :name AND NOT pg_index.indisvalid"
+        ), {"name": name}).first()
+        if invalid:
+            conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+        using_sql = f" USING {using}" if using else ""
+        conn.execute(text(
+            f"CREATE {unique_sql}INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table}{using_sql} ({columns}){where_sql}"))
+    else:
+        using_sql = f" USING {using}" if using and conn.dialect.name == "postgresql" else ""
+        conn.execute(text(f"CREATE {unique_sql}INDEX IF NOT EXISTS {name} ON {table}{using_sql} ({columns}){where_sql}"))
@@ -1,15 +1,18 @@
-from sqlalchemy import Column, Integer, String, Boolean, ForeignKey, DateTime
+from datetime import datetime
+from sqlalchemy import Column, Integer, String, Boolean, ForeignKey, DateTime, Index, text
 from sqlalchemy.orm import relationship
 from sqlalchemy.ext.declarative import declarative_base
 
 Base = declarative_base()
 
+# The schema is created and changed by the migrations in app/migrations, keep these models in sync with them
+
 
 class Author(Base):
     __tablename__ = 'authors'
 
     id = Column(Integer, primary_key=True)
-    name = Column(String)
+    name = Column(String, unique=True, index=True)
 
 
 class Book(Base):
@@ -18,11 +21,34 @@ class Book(Base):
     id = Column(Integer, primary_key=True)
     author_id = Column(Integer, ForeignKey('authors.id'))
     title = Column(String)
-    isbn = Column(String)
+    isbn = Column(String, unique=True, index=True)
+    # Denormalized copy counters, kept in sync by every write to copies (see app/routers/utils.add_copy_counts)
+    total_copies = Column(Integer, nullable=False, default=0, server_default='0', index=True)
+    borrowed_copies = Column(Integer, nullable=False, default=0, server_default='0', index=True)
+    # Bumped by every UPDATE of the row, ORM flushes and bulk statements alike, they make the book's ETag
+    version = Column(Integer, nullable=False, default=1, server_default='1', onupdate=text('version + 1'))
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     copies = relationship('Copy', backref='book', lazy='dynamic')
     author = relationship('Author', backref='books')
 
 
+# Serves the available=False filter of GET /books (books without a free copy)
+Index('ix_books_free_copies', Book.total_copies - Book.borrowed_copies)
+# The books of an author, for the author matches of the search
+Index('ix_books_author_id', Book.author_id)
+
+
+# Change counters of the catalog as a whole, behind the ETags of GET /books (see app/etags.py).
+# Each scope is split in shards so concurrent writers rarely update the same row.
+class CatalogVersion(Base):
+    __tablename__ = 'catalog_versions'
+
+    scope = Column(String, primary_key=True)
+    shard = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False, default=0, server_default='0')
+    updated_at = Column(DateTime)
+
+
 class Copy(Base):
     __tablename__ = 'copies'
 
@@ -31,6 +57,9 @@ class Copy(Base):
     borrowed = Column(Boolean, default=False)
 
 
+# Free copy lookups of the borrows and the copy adjustments of PUT /books
+Index('ix_copies_book_id_borrowed', Copy.book_id, Copy.borrowed)
+
 
 class Borrow(Base):
     __tablename__ = 'borrows'
@@ -47,11 +76,49 @@ class Borrow(Base):
     def __repr__(self):
         return f"Borrow(id={self.id}, copy_id={self.copy_id}, user_id={self.user_id}, borrow_date={self.borrow_date}, return_date={self.return_date})"
 
+
+# Open borrows of a user (return_date IS NULL)
+Index('ix_borrows_user_id_return_date', Borrow.user_id, Borrow.return_date)
+# Open borrows by age, for the overdue report (partial index, only the open borrows)
+Index('ix_borrows_open_borrow_date', Borrow.borrow_date, Borrow.id,
+      postgresql_where=Borrow.return_date.is_(None), sqlite_where=Borrow.return_date.is_(None))
+# Borrow history of a user, newest first, and the borrows of the copies of a book
+Index('ix_borrows_user_id_borrow_date', Borrow.user_id, Borrow.borrow_date, Borrow.id)
+Index('ix_borrows_copy_id', Borrow.copy_id)
+# Returned borrows still to be archived (partial index, only the returned borrows)
+Index('ix_borrows_returned_id', Borrow.id,
+      postgresql_where=Borrow.return_date.isnot(None), sqlite_where=Borrow.return_date.isnot(None))
+
+
+class BorrowHistory(Base):
+    """Returned borrows, moved out of borrows by the archiver (app/archive.py) with the id they had there.
+
+    Partitioned by month of borrow_date on Postgres. No foreign keys: the history outlives deleted copies and books.
+    """
+    __tablename__ = 'borrow_history'
+    __table_args__ = {'postgresql_partition_by': 'RANGE (borrow_date)'}
+
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    borrow_date = Column(DateTime, primary_key=True)
+    user_id = Column(Integer, nullable=False)
+    copy_id = Column(Integer, nullable=False)
+    book_id = Column(Integer, nullable=False)
+    return_date = Column(DateTime, nullable=False)
+
+    def __repr__(self):
+        return f"BorrowHistory(id={self.id}, user_id={self.user_id}, book_id={self.book_id}, borrow_date={self.borrow_date}, return_date={self.return_date})"
+
+
+# Borrow history of a user and of a book, newest first
+Index('ix_borrow_history_user_id_borrow_date', BorrowHistory.user_id, BorrowHistory.borrow_date, BorrowHistory.id)
+Index('ix_borrow_history_book_id_borrow_date', BorrowHistory.book_id, BorrowHistory.borrow_date, BorrowHistory.id)
+
+
 class User(Base):
     __tablename__ = 'users'
 
     id = Column(Integer, primary_key=True)
-    username = Column(String)
-    email = Column(String)
+    username = Column(String, unique=True, index=True)
+    email = Column(String, unique=True, index=True)
     password = Column(String)
     is_admin = Column(Boolean, default=False)
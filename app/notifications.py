@@ -0,0 +1,274 @@
+import asyncio
+import threading
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional
+from fastapi import HTTPException, Response
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+from app.config import settings
+from app.log import get_logger
+from app.models import Book
+from app.serialization import dumps
+
+logger = get_logger(__name__)
+
+# Push notifications of book availability (GET /books/availability/stream), instead of clients polling the books.
+# The borrows, returns and catalog writes publish the number of available copies of the books they changed once
+# committed, to the streams subscribed to these books. A subscription holds only the latest state not yet sent of
+# every book it watches: a burst of changes to a book goes out as one event, and a slow consumer never holds more
+# than one pending event per book whatever the write rate. A consumer that doesn't read at all for
+# NOTIFICATIONS_SEND_TIMEOUT_SECONDS is disconnected.
+# The in-process backend is per worker: with several workers, a shared backend (e.g. Redis pub/sub) implementing
+# PubSubBackend delivers the writes of every worker to the streams of all of them.
+
+
+class Subscription:
+    """The books watched by a stream and the latest state not yet sent of each, filled from any thread."""
+
+    def __init__(self, book_ids: Iterable[int]):
+        self.book_ids = frozenset(book_ids)
+        self.lock = threading.Lock()
+        self.pending = {}
+        # Last version queued per book: a state read before a newer one was queued is stale
+        self.versions = {}
+        self.loop = None
+        self.changed = None
+
+    # Starts the wake-ups, on the event loop of the stream
+    def attach(self, loop):
+        self.changed = asyncio.Event()
+        with self.lock:
+            self.loop = loop
+            if self.pending:
+                self.changed.set()
+
+    # Queues the state of a book, returns whether it replaced one not sent yet
+    def push(self, book_id: int, message: dict) -> bool:
+        version = message.get("version")
+        with self.lock:
+            if version is not None and version <= self.versions.get(book_id, 0):
+                return False
+            if version is not None:
+                self.versions[book_id] = version
+            coalesced = book_id in self.pending
+            self.pending[book_id] = message
+            loop = self.loop
+        if loop is not None:
+            try:
+                loop.call_soon_threadsafe(self.changed.set)
+            except RuntimeError:
+                # The event loop is closed, the stream is gone
+                pass
+        return coalesced
+
+    def drain(self) -> List[dict]:
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        if self.changed is not None:
+            self.changed.clear()
+        return list(pending.values())
+
+
+class PubSubBackend:
+    """Delivery of the availability messages to the subscriptions. A shared store (e.g. Redis) implements the same methods."""
+
+    def subscribe(self, subscription: Subscription):
+        raise NotImplementedError
+
+    def unsubscribe(self, subscription: Subscription):
+        raise NotImplementedError
+
+    # The books with at least one subscription, the others are not published
+    def watched(self, book_ids: Iterable[int]) -> List[int]:
+        raise NotImplementedError
+
+    def publish(self, book_id: int, message: dict):
+        raise NotImplementedError
+
+    def stats(self) -> dict:
+        raise NotImplementedError
+
+
+class MemoryPubSubBackend(PubSubBackend):
+    """Subscriptions per book in the memory of the process."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscriptions = defaultdict(set)
+        self.count = 0
+        self.published = 0
+        self.coalesced = 0
+
+    def subscribe(self, subscription: Subscription):
+        with self.lock:
+            for book_id in subscription.book_ids:
+                self.subscriptions[book_id].add(subscription)
+            self.count += 1
+
+    def unsubscribe(self, subscription: Subscription):
+        with self.lock:
+            for book_id in subscription.book_ids:
+                subscriptions = self.subscriptions.get(book_id)
+                if subscriptions is not None:
+                    subscriptions.discard(subscription)
+                    if not subscriptions:
+                        del self.subscriptions[book_id]
+            self.count -= 1
+
+    def watched(self, book_ids: Iterable[int]) -> List[int]:
+        with self.lock:
+            return [book_id for book_id in book_ids if book_id in self.subscriptions]
+
+    def publish(self, book_id: int, message: dict):
+        with self.lock:
+            subscriptions = list(self.subscriptions.get(book_id, ()))
+        coalesced = sum(1 for subscription in subscriptions if subscription.push(book_id, message))
+        with self.lock:
+            self.published += 1
+            self.coalesced += coalesced
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"subscribers": self.count, "published": self.published, "coalesced": self.coalesced}
+
+
+# State of the books as sent to the streams, a deleted book is sent once with deleted set
+def availability_messages(book_ids: List[int], db: Session) -> Dict[int, dict]:
+    rows = db.execute(
+        select(Book.id, Book.total_copies, Book.borrowed_copies, Book.version).filter(Book.id.in_(book_ids))
+    ).all()
+    messages = {book_id: {"book_id": book_id, "deleted": True} for book_id in book_ids}
+    for row in rows:
+        messages[row.id] = {"book_id": row.id, "num_available_copies": row.total_copies - row.borrowed_copies,
+                            "version": row.version}
+    return messages
+
+
+def encode_event(message: dict) -> bytes:
+    return b"event: availability\ndata: " + dumps(message) + b"\n\n"
+
+
+class AvailabilityNotifier:
+    """Publishes the availability of the books changed by the writes and serves the streams."""
+
+    def __init__(self, backend: PubSubBackend, max_subscribers: int, coalesce_seconds: float,
+                 keepalive_seconds: float, send_timeout_seconds: float):
+        self.backend = backend
+        self.max_subscribers = max_subscribers
+        self.coalesce_seconds = coalesce_seconds
+        self.keepalive_seconds = keepalive_seconds
+        self.send_timeout_seconds = send_timeout_seconds
+        self.lock = threading.Lock()
+        self.sent = 0
+        self.rejected = 0
+        self.slow_consumers = 0
+
+    # Called after the write is committed, reads the counters of the watched books only
+    def publish(self, book_ids: Iterable[int], db: Session):
+        watched = self.backend.watched(book_ids)
+        if not watched:
+            return
+        for book_id, message in availability_messages(watched, db).items():
+            self.backend.publish(book_id, message)
+
+    # Stream of the books: their current state, then every change. Subscribes before reading the state,
+    # so no change is missed in between (an older state read after a newer one was published is dropped).
+    def stream(self, book_ids: List[int], db: Session) -> "EventStreamResponse":
+        if self.backend.stats()["subscribers"] >= self.max_subscribers:
+            with self.lock:
+                self.rejected += 1
+            raise HTTPException(status_code=503, detail="Too many availability streams, please retry",
+                                headers={"Retry-After": str(max(1, round(self.keepalive_seconds)))})
+        subscription = Subscription(book_ids)
+        self.backend.subscribe(subscription)
+        try:
+            for book_id, message in availability_messages(book_ids, db).items():
+                subscription.push(book_id, message)
+        except Exception:
+            self.backend.unsubscribe(subscription)
+            raise
+        return EventStreamResponse(self, subscription)
+
+    def count(self, sent: int = 0, slow_consumers: int = 0):
+        with self.lock:
+            self.sent += sent
+            self.slow_consumers += slow_consumers
+
+    def stats(self) -> dict:
+        with self.lock:
+            stats = {"sent": self.sent, "rejected": self.rejected, "slow_consumers": self.slow_consumers}
+        return {**self.backend.stats(), **stats}
+
+
+async def _wait_disconnect(receive):
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return
+
+
+class EventStreamResponse(Response):
+    """Server-sent events of a subscription until the client disconnects, with a comment line as keep-alive."""
+
+    media_type = "text/event-stream"
+
+    def __init__(self, notifier: AvailabilityNotifier, subscription: Subscription):
+        # Proxies must not buffer nor cache the stream
+        super().__init__(headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+        self.notifier = notifier
+        self.subscription = subscription
+
+    async def __call__(self, scope, receive, send):
+        notifier, subscription = self.notifier, self.subscription
+        subscription.attach(asyncio.get_event_loop())
+        disconnected = asyncio.ensure_future(_wait_disconnect(receive))
+        try:
+            await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+            # The current state of the books goes out right away
+            chunk, events = self._chunk(subscription.drain())
+            while True:
+                try:
+                    await asyncio.wait_for(send({"type": "http.response.body", "body": chunk, "more_body": True}),
+                                           timeout=notifier.send_timeout_seconds)
+                except asyncio.TimeoutError:
+                    notifier.count(slow_consumers=1)
+                    logger.warning("Availability stream not read, disconnecting",
+                                   extra={"send_timeout_seconds": notifier.send_timeout_seconds})
+                    return
+                notifier.count(sent=events)
+
+                changed = asyncio.ensure_future(subscription.changed.wait())
+                done, _ = await asyncio.wait({changed, disconnected}, timeout=notifier.keepalive_seconds,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                if disconnected in done:
+                    changed.cancel()
+                    return
+                if changed in done:
+                    # The rest of a burst is sent along
+                    await asyncio.sleep(notifier.coalesce_seconds)
+                    chunk, events = self._chunk(subscription.drain())
+                else:
+                    changed.cancel()
+                    chunk, events = b": keep-alive\n\n", 0
+        finally:
+            disconnected.cancel()
+            notifier.backend.unsubscribe(subscription)
+
+    @staticmethod
+    def _chunk(messages: List[dict]):
+        return b"".join(encode_event(message) for message in messages), len(messages)
+
+
+def create_pubsub_backend(name: str) -> PubSubBackend:
+    if name == "memory":
+        return MemoryPubSubBackend()
+    raise ValueError("Unknown NOTIFICATIONS_BACKEND: {0}".format(name))
+
+
+availability_notifier = AvailabilityNotifier(
+    create_pubsub_backend(settings.NOTIFICATIONS_BACKEND),
+    max_subscribers=settings.NOTIFICATIONS_MAX_SUBSCRIBERS,
+    coalesce_seconds=settings.NOTIFICATIONS_COALESCE_SECONDS,
+    keepalive_seconds=settings.NOTIFICATIONS_KEEPALIVE_SECONDS,
+    send_timeout_seconds=settings.NOTIFICATIONS_SEND_TIMEOUT_SECONDS,
+)
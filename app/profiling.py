@@ -0,0 +1,155 @@
+import asyncio
+import cProfile
+import json
+import os
+import pstats
+import re
+import threading
+import time
+import uuid
+from contextvars import ContextVar
+from typing import List, Optional
+from fastapi.routing import APIRoute
+from app.config import settings
+from app.log import get_logger
+
+logger = get_logger(__name__)
+
+# On-demand request profiling, applied by ProfilingMiddleware: a request of an admin with an "X-Profile: 1" header,
+# and PROFILING_SAMPLE_RATE of all the requests, are profiled. A profile holds the duration, route and status of the
+# request, the SQL statements it ran with their durations, and the cProfile of its endpoint when the endpoint is a
+# sync function (it runs alone on its thread pool thread, an async endpoint shares the event loop thread with other
+# requests). It is written to PROFILING_DIR as <id>.json and <id>.prof (pstats, for snakeviz or python -m pstats),
+# which keeps the PROFILING_MAX_PROFILES newest, and listed by GET /profiles. The response of a profiled request
+# carries its id in X-Profile-Id.
+# Requests that are not profiled only pay for the header lookup: the endpoints are wrapped and the middleware
+# installed only with PROFILING_ENABLED, and a profile is only created for the requests profiled.
+
+PROFILE_HEADER = b"x-profile"
+PROFILE_ID_HEADER = b"x-profile-id"
+# Functions kept in the summary of a profile, by cumulative time
+TOP_FUNCTIONS = 40
+PROFILE_ID_PATTERN = re.compile(r"^\d+-[0-9a-f]{8}$")
+
+
+class RequestProfile:
+    """What is collected while a profiled request runs."""
+
+    def __init__(self, sampled: bool):
+        self.id = f"{int(time.time() * 1000)}-{uuid.uuid4().hex[:8]}"
+        self.sampled = sampled
+        self.started_at = time.time()
+        self.profiler = None
+        self.statements = []
+
+
+# Set by ProfilingMiddleware for a profiled request, the sync endpoint sees it through the context copied into
+# the thread pool
+current_profile: ContextVar = ContextVar("current_profile", default=None)
+
+
+def _profiled_endpoint(call):
+    def profiled(*args, **kwargs):
+        profile = current_profile.get()
+        if profile is None:
+            return call(*args, **kwargs)
+        profile.profiler = cProfile.Profile()
+        return profile.profiler.runcall(call, *args, **kwargs)
+    profiled.profiled = True
+    return profiled
+
+
+# Wraps the sync endpoints of the app so they run under cProfile when their request is profiled. The request
+# handlers call dependant.call when the request is served, and keep treating it as a sync function.
+def profile_endpoints(app):
+    for route in app.routes:
+        if not isinstance(route, APIRoute):
+            continue
+        call = route.dependant.call
+        if not asyncio.iscoroutinefunction(call) and not getattr(call, "profiled", False):
+            route.dependant.call = _profiled_endpoint(call)
+
+
+def top_functions(profiler: cProfile.Profile) -> List[dict]:
+    stats = pstats.Stats(profiler)
+    entries = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:TOP_FUNCTIONS]
+    return [
+        {"function": f"{filename}:{line}({name})", "calls": calls, "total_ms": round(total * 1000, 3),
+         "cumulative_ms": round(cumulative * 1000, 3)}
+        for (filename, line, name), (_, calls, total, cumulative, _) in entries
+    ]
+
+
+class ProfileStore:
+    """The profiles on disk, the oldest removed beyond max_profiles."""
+
+    def __init__(self, directory: str, max_profiles: int):
+        self.directory = directory
+        self.max_profiles = max_profiles
+        self.lock = threading.Lock()
+        self.saved = 0
+
+    def _path(self, profile_id: str, extension: str) -> str:
+        return os.path.join(self.directory, f"{profile_id}.{extension}")
+
+    # Runs in the thread pool, after the response is sent
+    def save(self, profile: RequestProfile, summary: dict):
+        statements = [{"sql": statement, "duration_ms": round(elapsed * 1000, 3)}
+                      for statement, elapsed in profile.statements[:settings.PROFILING_MAX_STATEMENTS]]
+        document = {**summary, "top_functions": top_functions(profile.profiler) if profile.profiler else [],
+                    "statements": statements}
+        with self.lock:
+            os.makedirs(self.directory, exist_ok=True)
+            if profile.profiler is not None:
+                profile.profiler.dump_stats(self._path(profile.id, "prof"))
+            with open(self._path(profile.id, "json"), "w") as file:
+                json.dump(document, file)
+            self.saved += 1
+            self._rotate()
+
+    def _rotate(self):
+        for profile_id in self._ids()[self.max_profiles:]:
+            for extension in ("json", "prof"):
+                try:
+                    os.remove(self._path(profile_id, extension))
+                except FileNotFoundError:
+                    pass
+
+    # Newest first, the ids start with the time in milliseconds
+    def _ids(self) -> List[str]:
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        ids = [name[:-5] for name in names if name.endswith(".json") and PROFILE_ID_PATTERN.match(name[:-5])]
+        return sorted(ids, reverse=True)
+
+    def list(self) -> List[dict]:
+        summaries = []
+        for profile_id in self._ids():
+            profile = self.get(profile_id)
+            if profile is not None:
+                summaries.append({key: value for key, value in profile.items() if key not in ("top_functions", "statements")})
+        return summaries
+
+    def get(self, profile_id: str) -> Optional[dict]:
+        if not PROFILE_ID_PATTERN.match(profile_id):
+            return None
+        try:
+            with open(self._path(profile_id, "json")) as file:
+                return json.load(file)
+        except (FileNotFoundError, ValueError):
+            # Removed by the rotation meanwhile, or still being written
+            return None
+
+    def read_prof(self, profile_id: str) -> Optional[bytes]:
+        if not PROFILE_ID_PATTERN.match(profile_id):
+            return None
+        try:
+            with open(self._path(profile_id, "prof"), "rb") as file:
+                return file.read()
+        except FileNotFoundError:
+            return None
+
+
+profile_store = ProfileStore(settings.PROFILING_DIR, settings.PROFILING_MAX_PROFILES)
@@ -0,0 +1,150 @@
+import itertools
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Optional
+from fastapi import Request
+from sqlalchemy import create_engine, event
+from sqlalchemy.exc import DBAPIError
+from app.config import settings
+from app.database import SessionLocal
+from app.log import get_logger
+from app.metrics import instrument_engine
+
+logger = get_logger(__name__)
+
+# Read replicas for the read-only endpoints (get_read_db). Replicas are used round-robin; one that can't
+# be reached is skipped for REPLICA_RETRY_SECONDS, and the reads go to the primary when none is left.
+# With READ_YOUR_WRITES_SECONDS, the reads made with the access token of a recent write go to the
+# primary for that long after the commit, so a user sees their own changes despite the replication lag.
+
+
+class ReplicaSet:
+    def __init__(self, engines: List, retry_seconds: float):
+        self.engines = engines
+        self.retry_seconds = retry_seconds
+        self.lock = threading.Lock()
+        self.down_until = [0.0] * len(engines)
+        self.counter = itertools.count()
+        self.reads = {"primary": 0, "replica": 0}
+        for index, engine in enumerate(engines):
+            event.listen(engine, "handle_error", self._error_handler(index))
+
+    # A connection lost during a query takes the replica out too
+    def _error_handler(self, index: int):
+        def handle_error(context):
+            if context.is_disconnect:
+                self.mark_down(index)
+        return handle_error
+
+    def mark_down(self, index: int):
+        with self.lock:
+            self.down_until[index] = time.monotonic() + self.retry_seconds
+        logger.warning("Replica unavailable", extra={"replica": index, "retry_seconds": self.retry_seconds})
+
+    # A connection to the next healthy replica, None when there is none (the caller uses the primary)
+    def connect(self):
+        start = next(self.counter)
+        for offset in range(len(self.engines)):
+            index = (start + offset) % len(self.engines)
+            if self.down_until[index] > time.monotonic():
+                continue
+            try:
+                connection = self.engines[index].connect()
+            except DBAPIError:
+                self.mark_down(index)
+                continue
+            self.count_read("replica")
+            return connection
+        self.count_read("primary")
+        return None
+
+    def count_read(self, target: str):
+        with self.lock:
+            self.reads[target] += 1
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        with self.lock:
+            return {
+                "up": {(str(index),): int(down_until <= now) for index, down_until in enumerate(self.down_until)},
+                "reads": {(target,): count for target, count in self.reads.items()},
+            }
+
+
+class RecentWriters:
+    """Access tokens that made a write in the last window_seconds, at most max_size of them."""
+
+    def __init__(self, window_seconds: float, max_size: int = 100000):
+        self.window_seconds = window_seconds
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def mark(self, token: Optional[str]):
+        if not token or self.window_seconds <= 0:
+            return
+        with self.lock:
+            self.entries.pop(token, None)
+            self.entries[token] = time.monotonic() + self.window_seconds
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def is_recent(self, token: Optional[str]) -> bool:
+        if not token or self.window_seconds <= 0:
+            return False
+        with self.lock:
+            until = self.entries.get(token)
+            if until is not None and until <= time.monotonic():
+                del self.entries[token]
+                until = None
+        return until is not None
+
+
+def create_replica_engine(url: str):
+    connect_args = {"check_same_thread": False} if url.startswith("sqlite") else {}
+    # pool_pre_ping makes a checkout fail on a replica that went away, which then fails over
+    engine = create_engine(url, echo=settings.SQL_ECHO, connect_args=connect_args, pool_pre_ping=True)
+    instrument_engine(engine)
+    logger.info("Replica engine created", extra={"database_url": repr(engine.url)})
+    return engine
+
+
+replica_set = ReplicaSet([create_replica_engine(url) for url in settings.DATABASE_REPLICA_URLS],
+                         retry_seconds=settings.REPLICA_RETRY_SECONDS)
+recent_writers = RecentWriters(settings.READ_YOUR_WRITES_SECONDS)
+
+
+# get_current_user sets writer_token on the session of a write request, its commits restart the window
+@event.listens_for(SessionLocal, "after_commit")
+def _mark_writer(session):
+    recent_writers.mark(session.info.get("writer_token"))
+
+
+# What a replica session reads may predate the last commits on the primary: it must not fill the shared
+# response cache, the entry would outlive the invalidation of the write and be served to the writer too
+def on_replica(db) -> bool:
+    return db.info.get("replica", False)
+
+
+def request_token(request: Request) -> Optional[str]:
+    scheme, _, token = request.headers.get("authorization", "").partition(" ")
+    return token if scheme.lower() == "bearer" else None
+
+
+# Session of the read-only endpoints: on a replica when there is one, else (or for a recent writer) the primary
+def get_read_db(request: Request):
+    connection = None
+    if replica_set.engines:
+        if recent_writers.is_recent(request_token(request)):
+            replica_set.count_read("primary")
+        else:
+            connection = replica_set.connect()
+    db = SessionLocal(bind=connection) if connection is not None else SessionLocal()
+    db.info["replica"] = connection is not None
+    try:
+        yield db
+    finally:
+        db.close()
+        if connection is not None:
+            connection.close()
@@ -0,0 +1,96 @@
+from datetime import date, datetime, time, timedelta
+from typing import Optional, Tuple
+from sqlalchemy import Date, Float, Integer, and_, cast, func, literal, or_, select
+from app.config import settings
+from app.models import Book, Borrow, Copy, User
+
+# Library-wide overdue report: the overdue days and fines of all the open borrows computed by the database,
+# with the rules of get_user_borrows (MAX_BORROW_TIME days of loan, BORROW_FINE_PER_OVERDUE_DAY per day after).
+# A borrow is overdue when its date is before the cutoff (today - MAX_BORROW_TIME), a range over the partial
+# index ix_borrows_open_borrow_date, so the report reads the overdue borrows only whatever the size of borrows.
+# The fine grows with the overdue days, so the borrows are sorted by fine in borrow date order, which the
+# index also serves for the keyset pagination.
+
+OVERDUE_BORROW_COLUMNS = ("borrow_id", "user_id", "username", "book_id", "book_title", "borrow_date",
+                          "overdue_days", "fine_amount")
+OVERDUE_USER_COLUMNS = ("user_id", "username", "email", "overdue_borrows", "max_overdue_days", "total_fine_amount")
+
+
+def overdue_cutoff(today: date) -> datetime:
+    return datetime.combine(today - timedelta(days=settings.MAX_BORROW_TIME), time.min)
+
+
+# Whole days between the borrow date and today, minus the loan period
+def overdue_days_expression(dialect_name: str, today: date):
+    if dialect_name == "postgresql":
+        days = literal(today, Date) - cast(Borrow.borrow_date, Date)
+    else:
+        days = func.julianday(today.isoformat()) - func.julianday(func.date(Borrow.borrow_date))
+    return cast(days, Integer) - settings.MAX_BORROW_TIME
+
+
+def fine_expression(overdue_days):
+    return overdue_days * literal(settings.BORROW_FINE_PER_OVERDUE_DAY, Float)
+
+
+def _overdue_filter(statement, today: date):
+    return statement.filter(Borrow.return_date.is_(None), Borrow.borrow_date < overdue_cutoff(today))
+
+
+# Overdue borrows, highest fine first unless ascending. after is the (borrow_date, id) of the last borrow of the
+# previous page: that borrow may have been returned and archived since, the cursor doesn't read it back.
+def overdue_borrows_statement(dialect_name: str, today: date, ascending: bool = False,
+                              limit: Optional[int] = None, offset: int = 0,
+                              after: Optional[Tuple[datetime, int]] = None):
+    overdue_days = overdue_days_expression(dialect_name, today)
+    statement = _overdue_filter(
+        select(Borrow.id, Borrow.user_id, User.username, Book.id, Book.title, Borrow.borrow_date,
+               overdue_days, fine_expression(overdue_days))
+        .select_from(Borrow)
+        .join(User, Borrow.user_id == User.id)
+        .join(Copy, Borrow.copy_id == Copy.id)
+        .join(Book, Copy.book_id == Book.id),
+        today,
+    )
+    if after is not None:
+        # Seek past the last borrow of the previous page (by borrow date, then id)
+        last_date, last_id = after
+        if ascending:
+            statement = statement.filter(or_(Borrow.borrow_date < last_date,
+                                             and_(Borrow.borrow_date == last_date, Borrow.id < last_id)))
+        else:
+            statement = statement.filter(or_(Borrow.borrow_date > last_date,
+                                             and_(Borrow.borrow_date == last_date, Borrow.id > last_id)))
+    if ascending:
+        statement = statement.order_by(Borrow.borrow_date.desc(), Borrow.id.desc())
+    else:
+        statement = statement.order_by(Borrow.borrow_date, Borrow.id)
+    if limit is not None:
+        statement = statement.offset(offset).limit(limit)
+    return statement
+
+
+# Totals per user, highest total fine first unless ascending
+def overdue_users_statement(dialect_name: str, today: date, ascending: bool = False,
+                            limit: Optional[int] = None, offset: int = 0):
+    overdue_days = overdue_days_expression(dialect_name, today)
+    total_fine_amount = func.sum(fine_expression(overdue_days))
+    statement = _overdue_filter(
+        select(User.id, User.username, User.email, func.count(Borrow.id), func.max(overdue_days), total_fine_amount)
+        .select_from(Borrow)
+        .join(User, Borrow.user_id == User.id),
+        today,
+    ).group_by(User.id, User.username, User.email)
+    statement = statement.order_by(total_fine_amount if ascending else total_fine_amount.desc(), User.id)
+    if limit is not None:
+        statement = statement.offset(offset).limit(limit)
+    return statement
+
+
+# Number of overdue borrows and the sum of their fines
+def overdue_totals_statement(dialect_name: str, today: date):
+    overdue_days = overdue_days_expression(dialect_name, today)
+    return _overdue_filter(
+        select(func.count(Borrow.id), func.coalesce(func.sum(fine_expression(overdue_days)), 0.0)).select_from(Borrow),
+        today,
+    )
@@ -1,41 +1,89 @@
 
-from typing import List
-from fastapi import APIRouter, HTTPException, Query, Depends
+import hashlib
+import json
+from typing import List, Optional
+from fastapi import APIRouter, HTTPException, Query, Depends, Request, Response
+from fastapi.responses import StreamingResponse
 from pydantic import PositiveInt
-from sqlalchemy import not_, exists
-from sqlalchemy.orm import Session
-from app.schemas import BookBaseSchema, BookQueryParams, BookCreateSchema, BookUpdateSchema, BooksResponseSchema, BookDetailsResponseSchema
+from sqlalchemy import not_, exists, insert, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, joinedload
+from app.schemas import BookBaseSchema, BookQueryParams, BookCreateSchema, BookUpdateSchema, BooksResponseSchema, BookDetailsResponseSchema, BookSearchResponseSchema, BooksBatchResponseSchema
 from app.models import Book, Copy, User, Borrow, Author
-from app.database import get_db
-from app.auth import get_current_user
-from app.routers.utils import count_available_copies,count_borrowed_copies, borrowed_copy_for_user_and_book
+from app.database import get_db, get_async_db
+from app.replicas import get_read_db, on_replica
+from app.auth import get_current_user, get_current_user_async
+from app.routers.utils import count_available_copies,count_borrowed_copies, borrowed_copy_for_user_and_book, encode_cursor, decode_cursor
+from app.ingest import ingest_books, CREATED, COPIES_ADDED, REJECTED
+from app.export import export_csv, export_ndjson
+from app.search import search_backend
+from app.serialization import dumps, JSONBytesResponse
+from app.cache import response_cache, book_tag, LIST_TAG, AVAILABILITY_TAG
+from app.notifications import availability_notifier
+from app.etags import (CATALOG_SCOPE, AVAILABILITY_SCOPE, bump_catalog_version, catalog_version_statement, catalog_validators,
+                       book_version_statement, book_validators, validator_headers, not_modified_response, conditional_response)
 router = APIRouter()
+# Endpoints on the async database session, served instead of their sync version when ASYNC_DATABASE is set
+async_router = APIRouter()
 
-@router.get("/", response_model=BooksResponseSchema)
-def get_books(
-    query_params: BookQueryParams = Depends(),
-    page: int = Query(1, ge=1),
-    limit: int = Query(10, ge=1, le=100),
-    db: Session = Depends(get_db)
-):
-    # Define the base query to fetch books from the database
-    base_query = db.query(Book)
-
+# Apply the filters and the pagination of GET /books, works on both a Query and a select() statement
+def filter_books(base_query, query_params: BookQueryParams, page: int, limit: int, after: Optional[str]):
     # Apply filters based on query parameters
     if query_params.title:
         base_query = base_query.filter(Book.title.ilike(f"%{query_params.title}%"))
 
+    # The authors are joined by books_page_statement
     if query_params.author:
-        base_query = base_query.join(Book.author).filter(Author.name.ilike(f"%{query_params.author}%"))
+        base_query = base_query.filter(Author.name.ilike(f"%{query_params.author}%"))
 
-    if query_params.available is not None:
-        base_query = base_query.filter(~Book.copies.any(Copy.borrowed == query_params.available))
+    # Served by the copy counter indexes: available=True means no copy is borrowed,
+    # available=False means every copy is borrowed
+    if query_params.available is True:
+        base_query = base_query.filter(Book.borrowed_copies == 0)
+    elif query_params.available is False:
+        base_query = base_query.filter(Book.total_copies - Book.borrowed_copies == 0)
 
  
-    # Apply pagination
-    offset = (page - 1) * limit
-    books = base_query.offset(offset).limit(limit+1).all()
-    books = [BookBaseSchema.from_model(book) for book in books]
+    # Pages are ordered by id, the primary key index serves both the offset and the cursor mode
+    base_query = base_query.order_by(Book.id)
+
+    # Apply pagination: a cursor seeks past the last id of the previous page instead of skipping rows
+    if after is not None:
+        base_query = base_query.filter(Book.id > decode_cursor(after))
+    else:
+        base_query = base_query.offset((page - 1) * limit)
+    return base_query.limit(limit+1)
+
+
+# Cache entry of a GET /books page. Pages filtered on availability also change with borrows and returns.
+def books_page_lookup(request: Request, query_params: BookQueryParams, page: int, limit: int, after: Optional[str]):
+    params = {
+        "title": query_params.title.lower() if query_params.title else None,
+        "author": query_params.author.lower() if query_params.author else None,
+        "available": query_params.available,
+        "page": page,
+        "limit": limit,
+        "after": after,
+    }
+    tags = (LIST_TAG, AVAILABILITY_TAG) if query_params.available is not None else (LIST_TAG,)
+    return response_cache.lookup(request, "/books/", params, tags)
+
+
+# Version counters a GET /books page depends on, see app/etags.py
+def books_page_version_statement(query_params: BookQueryParams):
+    scopes = (CATALOG_SCOPE, AVAILABILITY_SCOPE) if query_params.available is not None else (CATALOG_SCOPE,)
+    return catalog_version_statement(scopes)
+
+
+# Only the columns of BookBaseSchema, with the author name joined in the same query
+def books_page_statement(query_params: BookQueryParams, page: int, limit: int, after: Optional[str]):
+    base_query = select(Book.id, Book.title, Author.name, Book.isbn).outerjoin(Author, Book.author_id == Author.id)
+    return filter_books(base_query, query_params, page, limit, after)
+
+
+# The BooksResponseSchema of the rows of books_page_statement, encoded directly (see app/serialization.py)
+def books_page_response(rows, page: int, limit: int) -> bytes:
+    books = [{"id": book_id, "title": title, "author": author, "isbn": isbn} for book_id, title, author, isbn in rows]
 
     # Check if there are more books available
     has_more = len(books) > limit
@@ -43,7 +91,193 @@ def get_books(
     # If there are more books, remove the extra book used for determining the has_more flag
     if has_more:
         books = books[:-1]
-    return BooksResponseSchema(books=books, page=page, count=len(books), has_more=has_more)
+    next_cursor = encode_cursor(books[-1]["id"]) if has_more else None
+    return dumps({"books": books, "page": page, "count": len(books), "has_more": has_more, "next_cursor": next_cursor})
+
+
+@router.get("/", response_model=BooksResponseSchema)
+def get_books(
+    request: Request,
+    query_params: BookQueryParams = Depends(),
+    page: int = Query(1, ge=1),
+    limit: int = Query(10, ge=1, le=100),
+    after: Optional[str] = Query(None, description="Cursor from next_cursor of the previous page, replaces page"),
+    db: Session = Depends(get_read_db)
+):
+    cached = books_page_lookup(request, query_params, page, limit, after)
+    if cached.response is not None:
+        return conditional_response(request, cached.response)
+
+    # A revalidation of an unchanged page is answered from the catalog version alone
+    validators = catalog_validators(db.execute(books_page_version_statement(query_params)))
+    not_modified = not_modified_response(request, validators)
+    if not_modified is not None:
+        return not_modified
+
+    rows = db.execute(books_page_statement(query_params, page, limit, after)).all()
+    return cached.store(books_page_response(rows, page, limit), validator_headers(validators),
+                        cacheable=not on_replica(db))
+
+
+@async_router.get("/", response_model=BooksResponseSchema)
+async def get_books_async(
+    request: Request,
+    query_params: BookQueryParams = Depends(),
+    page: int = Query(1, ge=1),
+    limit: int = Query(10, ge=1, le=100),
+    after: Optional[str] = Query(None, description="Cursor from next_cursor of the previous page, replaces page"),
+    db: AsyncSession = Depends(get_async_db)
+):
+    cached = books_page_lookup(request, query_params, page, limit, after)
+    if cached.response is not None:
+        return conditional_response(request, cached.response)
+
+    validators = catalog_validators(await db.execute(books_page_version_statement(query_params)))
+    not_modified = not_modified_response(request, validators)
+    if not_modified is not None:
+        return not_modified
+
+    rows = (await db.execute(books_page_statement(query_params, page, limit, after))).all()
+    return cached.store(books_page_response(rows, page, limit), validator_headers(validators))
+
+
+@router.get("/search", response_model=BookSearchResponseSchema)
+def search_books(
+    q: str = Query(..., min_length=1, max_length=200),
+    limit: int = Query(20, ge=1, le=100),
+    db: Session = Depends(get_read_db)
+):
+    # Relevance ranked, typo tolerant search over titles and author names
+    results = search_backend.search(q.strip(), limit, db)
+    return BookSearchResponseSchema(results=results, count=len(results))
+
+
+# Declared before /{book_id} so "export" is not taken for a book id
+@router.get("/export")
+def export_books(
+    format: str = Query("ndjson", regex="^(ndjson|csv)$"),
+    current_user: User = Depends(get_current_user)
+):
+    if not current_user.is_admin:
+        raise HTTPException(status_code=403, detail="Unauthorized access")
+
+    # The body is produced batch by batch from a server-side cursor, see app/export.py
+    if format == "csv":
+        return StreamingResponse(export_csv(), media_type="text/csv",
+                                 headers={"Content-Disposition": 'attachment; filename="books.csv"'})
+    return StreamingResponse(export_ndjson(), media_type="application/x-ndjson")
+
+
+# Most books resolved by one GET /books/batch or watched by one availability stream
+LOOKUP_BATCH_MAX_BOOKS = 100
+
+
+# ids=1,2,3 or ids=1&ids=2&ids=3, in request order without duplicates
+def batch_keys(values: Optional[List[str]]) -> List[str]:
+    keys = [key.strip() for value in values or () for key in value.split(",") if key.strip()]
+    return list(dict.fromkeys(keys))
+
+
+def books_batch_keys(ids: Optional[List[str]], isbns: Optional[List[str]]):
+    if (ids is None) == (isbns is None):
+        raise HTTPException(status_code=400, detail="Provide either ids or isbns")
+    keys = batch_keys(ids if ids is not None else isbns)
+    if not keys:
+        raise HTTPException(status_code=400, detail="No book requested")
+    if len(keys) > LOOKUP_BATCH_MAX_BOOKS:
+        raise HTTPException(status_code=400, detail=f"At most {LOOKUP_BATCH_MAX_BOOKS} books per request")
+    if ids is not None:
+        try:
+            return Book.id, [int(key) for key in keys]
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid book id")
+    return Book.isbn, keys
+
+
+# The details of all the requested books in one query, the copy counters are columns of books
+def books_batch_statement(key_column, keys):
+    return (
+        select(Book.id, Book.title, Author.name, Book.isbn, Book.total_copies, Book.borrowed_copies,
+               Book.version, Book.updated_at)
+        .outerjoin(Author, Book.author_id == Author.id)
+        .filter(key_column.in_(keys))
+    )
+
+
+# The books in request order and the keys not found. The ETag covers the version of every book returned.
+def books_batch_response(request: Request, rows, key_column, keys, current_user: User) -> Response:
+    is_admin = bool(current_user.is_admin)
+    rows_by_key = {row.id if key_column is Book.id else row.isbn: row for row in rows}
+    found = [rows_by_key[key] for key in keys if key in rows_by_key]
+    missing = [key for key in keys if key not in rows_by_key]
+
+    digest = hashlib.sha1(json.dumps([[row.id, row.version] for row in found] + [missing, is_admin]).encode())
+    validators = (f'"books-batch-{digest.hexdigest()}"',
+                  max((row.updated_at for row in found if row.updated_at is not None), default=None))
+    not_modified = not_modified_response(request, validators)
+    if not_modified is not None:
+        return not_modified
+
+    books = [
+        {"id": row.id, "title": row.title, "author": row.name, "isbn": row.isbn,
+         "num_copies": row.total_copies if is_admin else None,
+         "num_borrowed_copies": row.borrowed_copies if is_admin else None}
+        for row in found
+    ]
+    return JSONBytesResponse({"books": books, "count": len(books), "missing": missing},
+                             headers=validator_headers(validators))
+
+
+# Details of several books by id or isbn (e.g. a shelf of the front end) in one request and one query.
+# Declared before /{book_id} so "batch" is not taken for a book id.
+@router.get("/batch", response_model=BooksBatchResponseSchema)
+def get_books_batch(
+    request: Request,
+    ids: Optional[List[str]] = Query(None, description="Book ids, comma separated or repeated"),
+    isbns: Optional[List[str]] = Query(None, description="Isbns, comma separated or repeated"),
+    db: Session = Depends(get_read_db),
+    current_user: User = Depends(get_current_user)
+):
+    key_column, keys = books_batch_keys(ids, isbns)
+    rows = db.execute(books_batch_statement(key_column, keys)).all()
+    return books_batch_response(request, rows, key_column, keys, current_user)
+
+
+@async_router.get("/batch", response_model=BooksBatchResponseSchema)
+async def get_books_batch_async(
+    request: Request,
+    ids: Optional[List[str]] = Query(None, description="Book ids, comma separated or repeated"),
+    isbns: Optional[List[str]] = Query(None, description="Isbns, comma separated or repeated"),
+    db: AsyncSession = Depends(get_async_db),
+    current_user: User = Depends(get_current_user_async)
+):
+    key_column, keys = books_batch_keys(ids, isbns)
+    rows = (await db.execute(books_batch_statement(key_column, keys))).all()
+    return books_batch_response(request, rows, key_column, keys, current_user)
+
+
+# Server-sent events of the availability of the books (ids=1,2,3 or repeated): an "availability" event with
+# the current num_available_copies of every book, then one per change, see app/notifications.py.
+# The session only serves the authentication and the current state, it is released before the stream starts.
+@router.get("/availability/stream")
+def stream_availability(
+    ids: List[str] = Query(..., description="Book ids, comma separated or repeated"),
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_user)
+):
+    keys = batch_keys(ids)
+    if not keys:
+        raise HTTPException(status_code=400, detail="No book requested")
+    if len(keys) > LOOKUP_BATCH_MAX_BOOKS:
+        raise HTTPException(status_code=400, detail=f"At most {LOOKUP_BATCH_MAX_BOOKS} books per request")
+    try:
+        book_ids = [int(key) for key in keys]
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid book id")
+    try:
+        return availability_notifier.stream(book_ids, db)
+    finally:
+        db.close()
 
 
 @router.post("/")
@@ -57,71 +291,94 @@ def create_books(
     if not current_user.is_admin:
         raise HTTPException(status_code=403, detail="Unauthorized access")
 
-    for book in books:
-        # Check if the author exists, or create a new one
-        author = db.query(Author).filter(Author.name == book.author).first()
-        if not author:
-            author = Author(name=book.author)
-            db.add(author)
-            db.commit()
-            db.refresh(author)
-
-        # Check if the book exists already (same isbn)
-        # If the book already exists, we will ignore the author or the title if they differ from the data in db
-        book_in_library = db.query(Book).filter(Book.isbn == book.isbn).first()
-        if book_in_library:
-            for _ in range(book.copies):
-                new_copy = Copy(book_id=book_in_library.id, borrowed=False)
-                db.add(new_copy)
-                db.commit()
-                db.refresh(new_copy)
-        else:            
-            # Create the book with the specified number of copies
-            new_book = Book(
-                title=book.title,
-                author_id=author.id,
-                isbn= book.isbn
-                # Set other properties as needed
-            )
-            db.add(new_book)
-            db.commit()
-            db.refresh(new_book)
-
-            # Create the copies
-            for _ in range(book.copies):
-                new_copy = Copy(book_id=new_book.id, borrowed=False)
-                db.add(new_copy)
-                db.commit()
-                db.refresh(new_copy)
-
-    return {"message": "Books added successfully"}
+    # Authors and isbns are resolved per chunk and rows are inserted in bulk, see app/ingest.py
+    results = ingest_books(books, db)
+
+    summary = {status: 0 for status in (CREATED, COPIES_ADDED, REJECTED)}
+    for result in results:
+        summary[result["status"]] += 1
+    search_backend.books_changed([result["book_id"] for result in results if result["status"] == CREATED], db)
+    # New books show up in the lists, added copies change the details and the availability of existing books
+    copies_added = {result["book_id"] for result in results if result["status"] == COPIES_ADDED}
+    response_cache.invalidate(LIST_TAG, *{book_tag(book_id) for book_id in copies_added})
+    availability_notifier.publish(copies_added, db)
+
+    return {"message": "Books added successfully", **summary, "results": results}
+
+
+def book_details_response(book: Book, current_user: User) -> BookDetailsResponseSchema:
+    response_model = BookDetailsResponseSchema(
+        id=book.id,
+        title=book.title,
+        author=book.author.name,
+        isbn=book.isbn,
+    )
+
+    if current_user.is_admin:
+        response_model.num_copies = book.total_copies
+        response_model.num_borrowed_copies = book.borrowed_copies
+
+    return response_model
+
+
+# Admins also get the copy counters, so the details are cached per role
+def book_details_lookup(request: Request, book_id: int, current_user: User):
+    return response_cache.lookup(request, "/books/{book_id}", {"id": book_id, "admin": bool(current_user.is_admin)},
+                                 (book_tag(book_id),))
 
 
 @router.get("/{book_id}", response_model=BookDetailsResponseSchema)
 def get_book(
+    request: Request,
     book_id: int,
-    db: Session = Depends(get_db),
+    db: Session = Depends(get_read_db),
     current_user: User = Depends(get_current_user)
 ):
+    cached = book_details_lookup(request, book_id, current_user)
+    if cached.response is not None:
+        return conditional_response(request, cached.response)
+
+    # The version is read first: a revalidation of an unchanged book loads nothing else
+    version = db.execute(book_version_statement(book_id)).first()
+    if not version:
+        raise HTTPException(status_code=404, detail="Book not found")
+    validators = book_validators(book_id, version.version, version.updated_at, current_user.is_admin)
+    not_modified = not_modified_response(request, validators)
+    if not_modified is not None:
+        return not_modified
+
     book = db.query(Book).get(book_id)
     if not book:
         raise HTTPException(status_code=404, detail="Book not found")
 
-    response_model = BookDetailsResponseSchema(
-        id=book.id,
-        title=book.title,
-        author=book.author.name,
-        isbn=book.isbn,
-    )
+    return cached.store(book_details_response(book, current_user), validator_headers(validators),
+                        cacheable=not on_replica(db))
 
-    if current_user.is_admin:
-        num_copies = db.query(Copy).filter(Copy.book_id == book.id).count()
-        response_model.num_copies = num_copies
 
-        num_borrowed_copies = count_borrowed_copies(book_id, db)
-        response_model.num_borrowed_copies = num_borrowed_copies
+@async_router.get("/{book_id}", response_model=BookDetailsResponseSchema)
+async def get_book_async(
+    request: Request,
+    book_id: int,
+    db: AsyncSession = Depends(get_async_db),
+    current_user: User = Depends(get_current_user_async)
+):
+    cached = book_details_lookup(request, book_id, current_user)
+    if cached.response is not None:
+        return conditional_response(request, cached.response)
 
-    return response_model
+    version = (await db.execute(book_version_statement(book_id))).first()
+    if not version:
+        raise HTTPException(status_code=404, detail="Book not found")
+    validators = book_validators(book_id, version.version, version.updated_at, current_user.is_admin)
+    not_modified = not_modified_response(request, validators)
+    if not_modified is not None:
+        return not_modified
+
+    book = await db.get(Book, book_id, options=[joinedload(Book.author)])
+    if not book:
+        raise HTTPException(status_code=404, detail="Book not found")
+
+    return cached.store(book_details_response(book, current_user), validator_headers(validators))
 
 
 @router.put("/{book_id}")
@@ -135,36 +392,31 @@ def update_book(
     if not current_user.is_admin:
         raise HTTPException(status_code=403, detail="Unauthorized access")
 
-    # Fetch the book from the database
-    book = db.query(Book).get(book_id)
+    # Fetch the book from the database, the row lock keeps borrows and returns from changing the counters meanwhile
+    book = db.query(Book).filter(Book.id == book_id).with_for_update().first()
     if not book:
         raise HTTPException(status_code=404, detail="Book not found")
 
-    # Check if any copies are currently borrowed
-    borrowed_copies = count_borrowed_copies(book_id, db)
-
     if book_data.copies is not None:
-        if book_data.copies < borrowed_copies:
+        if book_data.copies < book.borrowed_copies:
+            db.rollback()
             raise HTTPException(status_code=400, detail="Cannot reduce the number of copies below the number of borrowed copies")
 
-        if book_data.copies < book.copies.count():
-            excess_copies = book.copies.count() - book_data.copies
-            excess_copies_query = (
-                db.query(Copy)
+        if book_data.copies < book.total_copies:
+            excess_copies = book.total_copies - book_data.copies
+            excess_copy_ids = [
+                copy_id for copy_id, in
+                db.query(Copy.id)
                 .filter(Copy.book_id == book.id, Copy.borrowed == False)
                 .order_by(Copy.id.asc())
                 .limit(excess_copies)
-            )
-            excess_copies_instances = excess_copies_query.all()  # Execute the query and get the instances
-            for copy in excess_copies_instances:
-                db.delete(copy)
-        elif book_data.copies > book.copies.count():
-            num_additional_copies = book_data.copies - book.copies.count()
-            for _ in range(num_additional_copies):
-                new_copy = Copy(book_id=book.id, borrowed=False)
-                db.add(new_copy)
-                db.commit()
-                db.refresh(new_copy)
+            ]
+            db.query(Copy).filter(Copy.id.in_(excess_copy_ids)).delete(synchronize_session=False)
+            book.total_copies -= len(excess_copy_ids)
+        elif book_data.copies > book.total_copies:
+            num_additional_copies = book_data.copies - book.total_copies
+            db.execute(insert(Copy), [{"book_id": book.id, "borrowed": False}] * num_additional_copies)
+            book.total_copies += num_additional_copies
 
     if book_data.title:
         book.title = book_data.title
@@ -173,15 +425,19 @@ def update_book(
         if not author:
             author = Author(name=book_data.author)
             db.add(author)
-            db.commit()
-            db.refresh(author)
+            # Gives the author its id, the update commits as a whole below
+            db.flush()
         book.author_id = author.id
     if book_data.isbn:
         book.isbn = book_data.isbn
 
+    bump_catalog_version(db, CATALOG_SCOPE, book.id)
     # Commit the changes to the database
     db.commit()
     db.refresh(book)
+    search_backend.book_changed(book.id, db)
+    response_cache.invalidate(LIST_TAG, book_tag(book.id))
+    availability_notifier.publish([book.id], db)
 
     return {"message": "Book updated successfully"}
 
@@ -201,8 +457,7 @@ def delete_book(
         raise HTTPException(status_code=404, detail="Book not found")
 
     # Check if any copies are currently borrowed
-    borrowed_copies = count_borrowed_copies(book_id, db)
-    if borrowed_copies > 0:
+    if book.borrowed_copies > 0:
         raise HTTPException(status_code=400, detail="Cannot delete a book with borrowed copies")
 
     # Delete the book copies
@@ -210,8 +465,12 @@ def delete_book(
 
     # Delete the book
     db.delete(book)
+    bump_catalog_version(db, CATALOG_SCOPE, book_id)
 
     # Commit the changes to the database
     db.commit()
+    search_backend.book_deleted(book_id)
+    response_cache.invalidate(LIST_TAG, book_tag(book_id))
+    availability_notifier.publish([book_id], db)
 
     return {"message": "Book deleted successfully"}
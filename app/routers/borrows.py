@@ -1,22 +1,32 @@
 
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Query
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session, joinedload
-from app.auth import get_current_user
-from app.database import get_db
+from app.auth import get_current_user, get_current_user_async
+from app.cache import response_cache, book_tag, AVAILABILITY_TAG
+from app.notifications import availability_notifier
+from app.config import settings
+from app.database import get_db, get_async_db
+from app.replicas import get_read_db
 from app.models import User, Copy, Book, Borrow, Author
 from sqlalchemy.sql.operators import is_
 from datetime import datetime
-from app.routers.utils import borrowed_record_for_user_and_book, count_available_copies, get_available_copy, get_available_copies
-from app.schemas import BorrowResponse, BorrowsListResponse
-from datetime import datetime, timedelta
-from typing import List
+from app.history import HISTORY_COLUMNS, borrow_history_statement
+from app.routers.utils import claim_copy, release_copy, claim_copies, release_copies, encode_date_cursor, decode_date_cursor
+from app.schemas import BorrowResponse, BorrowsListResponse, BookBatchRequest, BookBatchResponse, BorrowHistoryResponse
+from app.serialization import JSONBytesResponse
+from datetime import date, datetime, timedelta
+from typing import List, Optional
 
 
 router = APIRouter()
-# TODO: Move these parameters to some environment file
-MAX_BORROWS = 10
-MAX_BORROW_TIME = 14
-BORROW_FINE_PER_OVERDUE_DAY = 0.10
+# Endpoints on the async database session, served instead of their sync version when ASYNC_DATABASE is set
+async_router = APIRouter()
+# Borrowing rules, see app/config.py
+MAX_BORROWS = settings.MAX_BORROWS
+MAX_BORROW_TIME = settings.MAX_BORROW_TIME
+BORROW_FINE_PER_OVERDUE_DAY = settings.BORROW_FINE_PER_OVERDUE_DAY
   
 @router.post("/books/{book_id}/borrow")
 def borrow_book(
@@ -24,42 +34,18 @@ def borrow_book(
     db: Session = Depends(get_db),
     current_user: User = Depends(get_current_user)
 ):
-    # Check if the user has reached the maximum number of borrows
-    num_borrows = db.query(Borrow).filter_by(user_id=current_user.id, return_date=None).count()
-    if num_borrows >= MAX_BORROWS:
-        raise HTTPException(status_code=400, detail="Maximum number of borrows reached")
-
-    # Check if the book exists and there are available copies
-    book = db.query(Book).filter_by(id=book_id).first()
-    if not book:
-        raise HTTPException(status_code=404, detail="Book not found")
-    available_copies = count_available_copies(book_id,db)
-    if available_copies == 0:
-        raise HTTPException(status_code=400, detail="No copies available for borrowing")
-
-    # Check if the user has already borrowed a copy of the same book
-    existing_borrow = borrowed_record_for_user_and_book(current_user.id, book_id, db)
-    if existing_borrow:
-        raise HTTPException(status_code=400, detail="You have already borrowed this book")
-
-    # Get available copy
-    available_copies = [copy.id for copy in get_available_copies(book_id, db)]
-    available_copy = get_available_copy(book_id, db)
-    borrow = Borrow(
-        copy_id=available_copy.id,
-        user_id=current_user.id,
-        borrow_date=datetime.now(),
-        return_date=None
-    )
-
-    # Add the new Borrow object to the session
-    db.add(borrow)
-
-    # Update the borrowed status of the Copy
-    available_copy.borrowed = True
-
-    # Commit the changes as a transaction
-    db.commit()
+    # Limit checks, copy claim and the borrow record in one transaction, see claim_copy.
+    # A rejected borrow rolls back right away: the dependency teardown that would otherwise release
+    # the locks runs in the same thread pool as the borrows waiting for them.
+    try:
+        claim_copy(book_id, current_user.id, db, MAX_BORROWS)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    # The copy counters changed: the book's details, the pages filtered on availability and its streams
+    response_cache.invalidate(AVAILABILITY_TAG, book_tag(book_id))
+    availability_notifier.publish([book_id], db)
  
     return {"message": "Book borrowed successfully"}
 
@@ -69,31 +55,69 @@ def return_book(
     db: Session = Depends(get_db),
     current_user: User = Depends(get_current_user)
 ):
-    # Check if the book exists
-    book = db.query(Book).filter_by(id=book_id).first()
-    if not book:
-        raise HTTPException(status_code=404, detail="Book not found")
+    # Close the borrow record and free its copy, see release_copy
+    try:
+        release_copy(book_id, current_user.id, db)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    response_cache.invalidate(AVAILABILITY_TAG, book_tag(book_id))
+    availability_notifier.publish([book_id], db)
 
-    borrow = borrowed_record_for_user_and_book(current_user.id, book_id, db)
-   # If no borrowed copy found, raise an exception
-    if not borrow:
-        raise HTTPException(status_code=400, detail="You have not borrowed this book")
+    return {"message": "Book returned successfully"}
 
-    # Set the return date for the borrow record
-    borrow.return_date = datetime.now()
 
-    # Update the copy's borrowed flag to False
-    borrowed_copy = borrow.copy
-    borrowed_copy.borrowed = False
+def batch_response(outcomes: List[dict]) -> BookBatchResponse:
+    succeeded = sum(1 for outcome in outcomes if outcome["status_code"] == 200)
+    return BookBatchResponse(results=outcomes, succeeded=succeeded, failed=len(outcomes) - succeeded)
 
-    db.commit()
 
-    return {"message": "Book returned successfully"}
+# Borrow several books in one request and one transaction (e.g. a self-checkout kiosk), with an outcome
+# per book: the books that can't be borrowed don't prevent the others, see claim_copies
+@router.post("/borrows/batch", response_model=BookBatchResponse)
+def borrow_books(
+    batch: BookBatchRequest,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_user)
+):
+    try:
+        outcomes = claim_copies(batch.book_ids, current_user.id, db, MAX_BORROWS)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    borrowed = [outcome["book_id"] for outcome in outcomes if outcome["status_code"] == 200]
+    if borrowed:
+        response_cache.invalidate(AVAILABILITY_TAG, *(book_tag(book_id) for book_id in borrowed))
+        availability_notifier.publish(borrowed, db)
+
+    return batch_response(outcomes)
+
+# Return several books in one request and one transaction, see release_copies
+@router.post("/returns/batch", response_model=BookBatchResponse)
+def return_books(
+    batch: BookBatchRequest,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_user)
+):
+    try:
+        outcomes = release_copies(batch.book_ids, current_user.id, db)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    returned = [outcome["book_id"] for outcome in outcomes if outcome["status_code"] == 200]
+    if returned:
+        response_cache.invalidate(AVAILABILITY_TAG, *(book_tag(book_id) for book_id in returned))
+        availability_notifier.publish(returned, db)
+
+    return batch_response(outcomes)
 
 
 
 # Shared method to get the list of borrows for a user
-def get_user_borrows(user_id: int, current_user: User, db: Session) -> BorrowsListResponse:
+def get_user_borrows(user_id: int, current_user: User, db: Session) -> JSONBytesResponse:
     if not current_user.is_admin and user_id != current_user.id:
         raise HTTPException(status_code=403, detail="You do not have permission to access this resource")
 
@@ -101,56 +125,154 @@ def get_user_borrows(user_id: int, current_user: User, db: Session) -> BorrowsLi
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
 
-    borrows = (
-        db.query(Borrow)
-        .join(Copy)
-        .join(Book)
-        .join(Author)
-        .options(joinedload(Borrow.copy).joinedload(Copy.book).joinedload(Book.author))
+    return borrows_list_response(db.execute(open_borrows_statement(user_id)))
+
+
+# Same as get_user_borrows on the async session
+async def get_user_borrows_async(user_id: int, current_user: User, db: AsyncSession) -> JSONBytesResponse:
+    if not current_user.is_admin and user_id != current_user.id:
+        raise HTTPException(status_code=403, detail="You do not have permission to access this resource")
+
+    user = await db.get(User, user_id)
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+
+    return borrows_list_response(await db.execute(open_borrows_statement(user_id)))
+
+
+# Open borrows of a user: only the columns of BorrowResponse, with the book and author joined in the same query
+def open_borrows_statement(user_id: int):
+    return (
+        select(Book.id, Book.title, Author.name, Borrow.borrow_date)
+        .select_from(Borrow)
+        .join(Copy, Borrow.copy_id == Copy.id)
+        .join(Book, Copy.book_id == Book.id)
+        .join(Author, Book.author_id == Author.id)
         .filter(Borrow.user_id == user_id, Borrow.return_date.is_(None))
-        .all()
     )
 
+
+# The BorrowsListResponse of the rows of open_borrows_statement, encoded directly (see app/serialization.py)
+def borrows_list_response(rows) -> JSONBytesResponse:
     borrow_list = []
-    total_fine_amount = 0
-    for borrow in borrows:
+    total_fine_amount = 0.0
+    today = datetime.now().date()
+    for book_id, book_title, author, borrow_date in rows:
         # Calculate max return date based on borrow date and remaining days (in case of overdue, it will be negative)
-        if isinstance(borrow.borrow_date, str):
-            borrow.borrow_date = datetime.strptime(borrow.borrow_date, "%Y-%m-%d %H:%M:%S.%f")
+        if isinstance(borrow_date, str):
+            borrow_date = datetime.strptime(borrow_date, "%Y-%m-%d %H:%M:%S.%f")
+
+        max_return_date = borrow_date + timedelta(days=MAX_BORROW_TIME)
+        remaining_days = (max_return_date.date() - today).days
 
-        max_return_date = borrow.borrow_date + timedelta(days=MAX_BORROW_TIME) 
-        remaining_days = (max_return_date.date() - datetime.now().date()).days
-    
         # Calculate fine
-        fine_amount = 0
+        fine_amount = 0.0
         if remaining_days < 0:
             fine_amount = -remaining_days * BORROW_FINE_PER_OVERDUE_DAY
             total_fine_amount = total_fine_amount + fine_amount
 
+        borrow_list.append({
+            "book_id": book_id,
+            "book_title": book_title,
+            "author": author,
+            "borrow_date": borrow_date,
+            "remaining_days": remaining_days,
+            "fine_amount": fine_amount,
+        })
 
-
-        # Create BorrowResponse instance
-        borrow_response = BorrowResponse(
-            book_id=borrow.copy.book.id,
-            book_title=borrow.copy.book.title,
-            author=borrow.copy.book.author.name,
-            borrow_date=borrow.borrow_date,
-            remaining_days=remaining_days,
-            fine_amount=fine_amount
-        )
-
-        borrow_list.append(borrow_response)
-
-    return BorrowsListResponse(borrows=borrow_list, count=len(borrow_list),total_fine_amount=total_fine_amount)
+    return JSONBytesResponse({"borrows": borrow_list, "count": len(borrow_list), "total_fine_amount": total_fine_amount})
 
 
 # API to get the list of borrows for the currently logged-in user
 @router.get("/users/me/borrows", response_model=BorrowsListResponse)
-def get_current_user_borrows(current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+def get_current_user_borrows(current_user: User = Depends(get_current_user), db: Session = Depends(get_read_db)):
     return get_user_borrows(current_user.id, current_user, db)
 
 # API to get the list of borrows for a specific user (admin restricted)
 @router.get("/users/{user_id}/borrows", response_model=BorrowsListResponse)
-def get_some_user_borrows(user_id: int, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+def get_some_user_borrows(user_id: int, current_user: User = Depends(get_current_user), db: Session = Depends(get_read_db)):
     return get_user_borrows(user_id, current_user, db)
 
+@async_router.get("/users/me/borrows", response_model=BorrowsListResponse)
+async def get_current_user_borrows_async(current_user: User = Depends(get_current_user_async), db: AsyncSession = Depends(get_async_db)):
+    return await get_user_borrows_async(current_user.id, current_user, db)
+
+@async_router.get("/users/{user_id}/borrows", response_model=BorrowsListResponse)
+async def get_some_user_borrows_async(user_id: int, current_user: User = Depends(get_current_user_async), db: AsyncSession = Depends(get_async_db)):
+    return await get_user_borrows_async(user_id, current_user, db)
+
+
+# Filters and pagination of the borrow history endpoints
+def history_params(
+    start_date: Optional[date] = Query(None, description="Borrowed on or after this day"),
+    end_date: Optional[date] = Query(None, description="Borrowed on or before this day"),
+    status: Optional[str] = Query(None, regex="^(open|returned)$"),
+    limit: int = Query(50, ge=1, le=500),
+    after: Optional[str] = Query(None, description="Cursor from next_cursor of the previous page"),
+) -> dict:
+    if start_date is not None and end_date is not None and start_date > end_date:
+        raise HTTPException(status_code=400, detail="start_date is after end_date")
+    return {"start_date": start_date, "end_date": end_date, "status": status, "limit": limit,
+            "after": decode_date_cursor(after) if after is not None else None}
+
+
+# A page of borrow history, newest first, see app/history.py
+def borrow_history_response(db: Session, params: dict, **owner) -> JSONBytesResponse:
+    limit = params["limit"]
+    # One more row than the page tells if there is a next page
+    rows = db.execute(borrow_history_statement(**{**params, "limit": limit + 1}, **owner)).all()
+    has_more = len(rows) > limit
+    borrows = [dict(zip(HISTORY_COLUMNS, row)) for row in rows[:limit]]
+    return JSONBytesResponse({
+        "borrows": borrows,
+        "count": len(borrows),
+        "has_more": has_more,
+        "next_cursor": encode_date_cursor(borrows[-1]["borrow_date"], borrows[-1]["borrow_id"]) if has_more else None,
+    })
+
+
+# Every borrow of a user, open and returned (the user or an admin), optionally of one book
+def get_user_borrow_history(user_id: int, book_id: Optional[int], params: dict, current_user: User, db: Session):
+    if not current_user.is_admin and user_id != current_user.id:
+        raise HTTPException(status_code=403, detail="You do not have permission to access this resource")
+
+    user = db.query(User).get(user_id)
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+
+    return borrow_history_response(db, params, user_id=user_id, book_id=book_id)
+
+
+# Declared before /users/{user_id}/borrows/history so "me" is not taken for a user id
+@router.get("/users/me/borrows/history", response_model=BorrowHistoryResponse)
+def get_current_user_borrow_history(
+    book_id: Optional[int] = None,
+    params: dict = Depends(history_params),
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_read_db)
+):
+    return get_user_borrow_history(current_user.id, book_id, params, current_user, db)
+
+@router.get("/users/{user_id}/borrows/history", response_model=BorrowHistoryResponse)
+def get_some_user_borrow_history(
+    user_id: int,
+    book_id: Optional[int] = None,
+    params: dict = Depends(history_params),
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_read_db)
+):
+    return get_user_borrow_history(user_id, book_id, params, current_user, db)
+
+# Every borrow of a book (admin restricted), optionally of one user. The history of a deleted book stays available.
+@router.get("/books/{book_id}/borrows", response_model=BorrowHistoryResponse)
+def get_book_borrow_history(
+    book_id: int,
+    user_id: Optional[int] = None,
+    params: dict = Depends(history_params),
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_read_db)
+):
+    if not current_user.is_admin:
+        raise HTTPException(status_code=403, detail="Unauthorized access")
+
+    return borrow_history_response(db, params, user_id=user_id, book_id=book_id)
@@ -1,15 +1,16 @@
 from fastapi import APIRouter, Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordRequestForm
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 from app.models import User
 from app.schemas import Token
-from app.auth import create_access_token, authenticate_user
-from app.database import get_db
+from app.auth import create_access_token, authenticate_user, authenticate_user_async
+from app.database import get_db, get_async_db
 router = APIRouter()
+# Endpoints on the async database session, served instead of their sync version when ASYNC_DATABASE is set
+async_router = APIRouter()
 
-@router.post("/login", response_model=Token)
-async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
-    user = await authenticate_user(form_data.username, form_data.password, db)
+def login_response(user: User):
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -18,3 +19,14 @@ async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(
         )
     access_token = create_access_token(user.username)
     return {"access_token": access_token, "token_type": "bearer"}
+
+# A plain def endpoint runs in the thread pool, the user lookup and bcrypt must not block the event loop
+@router.post("/login", response_model=Token)
+def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
+    user = authenticate_user(form_data.username, form_data.password, db)
+    return login_response(user)
+
+@async_router.post("/login", response_model=Token)
+async def login_for_access_token_async(form_data: OAuth2PasswordRequestForm = Depends(), db: AsyncSession = Depends(get_async_db)):
+    user = await authenticate_user_async(form_data.username, form_data.password, db)
+    return login_response(user)
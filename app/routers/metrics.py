@@ -0,0 +1,76 @@
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+from app.admission import admission_controller
+from app.archive import borrow_archiver
+from app.auth import principal_cache
+from app.cache import response_cache
+from app.crypto import hash_executor
+from app.idempotency import idempotency
+from app.notifications import availability_notifier
+from app.replicas import replica_set
+from app.metrics import registry
+
+router = APIRouter()
+
+# Caches and executors keep their own counters, they are read when /metrics is scraped
+registry.counter("principal_cache_hits_total", "Authenticated user cache hits",
+                 callback=lambda: principal_cache.stats()["hits"])
+registry.counter("principal_cache_misses_total", "Authenticated user cache misses",
+                 callback=lambda: principal_cache.stats()["misses"])
+registry.gauge("principal_cache_entries", "Authenticated users cached",
+               callback=lambda: principal_cache.stats()["size"])
+registry.counter("response_cache_requests_total", "Cacheable requests by result (hit, miss, bypass)", ("route", "result"),
+                 callback=lambda: response_cache.stats()["results"])
+registry.gauge("response_cache_entries", "Responses cached",
+               callback=lambda: response_cache.stats()["size"])
+registry.counter("response_cache_invalidations_total", "Response cache invalidations by catalog writes",
+                 callback=lambda: response_cache.stats()["invalidations"])
+registry.gauge("password_hash_queue_depth", "Password hashes waiting for a hashing thread",
+               callback=lambda: hash_executor.stats()["queue_depth"])
+registry.gauge("password_hash_running", "Password hashes being computed",
+               callback=lambda: hash_executor.stats()["running"])
+registry.counter("password_hash_completed_total", "Password hashes computed",
+                 callback=lambda: hash_executor.stats()["completed"])
+registry.counter("password_hash_rejected_total", "Password hashes rejected with 503 because the queue was full",
+                 callback=lambda: hash_executor.stats()["rejected"])
+registry.counter("password_hash_wait_seconds_total", "Time password hashes waited for a hashing thread",
+                 callback=lambda: hash_executor.stats()["wait_seconds_total"])
+registry.counter("password_hash_seconds_total", "Time spent computing password hashes",
+                 callback=lambda: hash_executor.stats()["hash_seconds_total"])
+registry.counter("admission_rejections_total", "Requests rejected by admission control by reason (rate_limited, queue_full, queue_timeout)",
+                 ("method", "route", "reason"), callback=lambda: admission_controller.stats()["rejections"])
+registry.gauge("admission_active_requests", "Requests holding a slot of their route", ("method", "route"),
+               callback=lambda: admission_controller.stats()["active"])
+registry.gauge("admission_queued_requests", "Requests waiting for a slot of their route", ("method", "route"),
+               callback=lambda: admission_controller.stats()["queued"])
+registry.gauge("db_replica_up", "Whether the read replica is in use (0 while skipped after a failure)", ("replica",),
+               callback=lambda: replica_set.stats()["up"])
+registry.counter("db_read_sessions_total", "Sessions of the read-only endpoints by database (replica, primary)", ("target",),
+                 callback=lambda: replica_set.stats()["reads"])
+
+registry.gauge("availability_streams", "Open availability streams",
+               callback=lambda: availability_notifier.stats()["subscribers"])
+registry.counter("availability_published_total", "Book availability changes published to their streams",
+                 callback=lambda: availability_notifier.stats()["published"])
+registry.counter("availability_coalesced_total", "Availability changes replaced by a newer one before being sent",
+                 callback=lambda: availability_notifier.stats()["coalesced"])
+registry.counter("availability_events_sent_total", "Availability events sent to the streams",
+                 callback=lambda: availability_notifier.stats()["sent"])
+registry.counter("availability_streams_rejected_total", "Availability streams rejected with 503 at NOTIFICATIONS_MAX_SUBSCRIBERS",
+                 callback=lambda: availability_notifier.stats()["rejected"])
+registry.counter("availability_slow_consumers_total", "Availability streams disconnected for not reading",
+                 callback=lambda: availability_notifier.stats()["slow_consumers"])
+
+registry.counter("borrows_archived_total", "Returned borrows moved to borrow_history",
+                 callback=lambda: borrow_archiver.stats()["archived"])
+registry.counter("borrow_archive_errors_total", "Background borrow archival runs that failed",
+                 callback=lambda: borrow_archiver.stats()["errors"])
+registry.counter("idempotency_requests_total", "Requests with an Idempotency-Key by result (new, replayed, mismatch, in_progress)",
+                 ("result",), callback=lambda: idempotency.stats()["results"])
+registry.gauge("idempotency_keys", "Idempotency keys remembered",
+               callback=lambda: idempotency.stats()["keys"])
+
+# Prometheus scrape endpoint
+@router.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+def get_metrics():
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
@@ -0,0 +1,41 @@
+from fastapi import APIRouter, Depends, HTTPException, Response
+from app.auth import get_current_user
+from app.models import User
+from app.profiling import profile_store
+from app.serialization import JSONBytesResponse
+
+router = APIRouter()
+
+
+def check_admin(current_user: User):
+    if not current_user.is_admin:
+        raise HTTPException(status_code=403, detail="Only admins can access this API.")
+
+
+# The stored request profiles, newest first: id, time, method, route, status, duration and SQL statement count
+@router.get("/")
+def list_profiles(current_user: User = Depends(get_current_user)):
+    check_admin(current_user)
+    profiles = profile_store.list()
+    return JSONBytesResponse({"profiles": profiles, "count": len(profiles)})
+
+
+# A profile with its SQL statements and the functions with the most cumulative time
+@router.get("/{profile_id}")
+def get_profile(profile_id: str, current_user: User = Depends(get_current_user)):
+    check_admin(current_user)
+    profile = profile_store.get(profile_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return JSONBytesResponse(profile)
+
+
+# The cProfile output of a profile (pstats format), for snakeviz or python -m pstats
+@router.get("/{profile_id}/prof")
+def download_profile(profile_id: str, current_user: User = Depends(get_current_user)):
+    check_admin(current_user)
+    content = profile_store.read_prof(profile_id)
+    if content is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return Response(content, media_type="application/octet-stream",
+                    headers={"Content-Disposition": f'attachment; filename="{profile_id}.prof"'})
@@ -0,0 +1,86 @@
+from datetime import date
+from typing import Optional
+from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.responses import StreamingResponse
+from sqlalchemy.orm import Session
+from app.auth import get_current_user
+from app.database import get_db
+from app.replicas import get_read_db
+from app.export import stream_csv
+from app.models import User
+from app.reports import (OVERDUE_BORROW_COLUMNS, OVERDUE_USER_COLUMNS, overdue_borrows_statement,
+                         overdue_totals_statement, overdue_users_statement)
+from app.routers.utils import encode_date_cursor, decode_date_cursor
+from app.schemas import OverdueBorrowsResponse, OverdueUsersResponse
+from app.serialization import JSONBytesResponse
+
+router = APIRouter()
+
+SORT_PATTERN = "^-?fine_amount$"
+
+
+def check_admin(current_user: User):
+    if not current_user.is_admin:
+        raise HTTPException(status_code=403, detail="Only admins can access this API.")
+
+
+# Overdue borrows of all users with their overdue days and fine, see app/reports.py.
+# sort=-fine_amount (default) for the highest fines first, fine_amount for the lowest.
+# format=csv streams every overdue borrow instead of a page.
+@router.get("/overdue", response_model=OverdueBorrowsResponse)
+def overdue_borrows(
+    sort: str = Query("-fine_amount", regex=SORT_PATTERN),
+    page: int = Query(1, ge=1),
+    limit: int = Query(50, ge=1, le=1000),
+    after: Optional[str] = Query(None, description="Cursor from next_cursor of the previous page, replaces page"),
+    format: str = Query("json", regex="^(json|csv)$"),
+    db: Session = Depends(get_read_db),
+    current_user: User = Depends(get_current_user)
+):
+    check_admin(current_user)
+    dialect_name, today, ascending = db.get_bind().dialect.name, date.today(), not sort.startswith("-")
+
+    if format == "csv":
+        statement = overdue_borrows_statement(dialect_name, today, ascending)
+        return StreamingResponse(stream_csv(OVERDUE_BORROW_COLUMNS, statement), media_type="text/csv",
+                                 headers={"Content-Disposition": 'attachment; filename="overdue_borrows.csv"'})
+
+    # One more row than the page tells if there is a next page
+    last = decode_date_cursor(after) if after is not None else None
+    offset = (page - 1) * limit if last is None else 0
+    rows = db.execute(overdue_borrows_statement(dialect_name, today, ascending, limit + 1, offset, last)).all()
+    has_more = len(rows) > limit
+    borrows = [dict(zip(OVERDUE_BORROW_COLUMNS, row)) for row in rows[:limit]]
+    total_overdue_borrows, total_fine_amount = db.execute(overdue_totals_statement(dialect_name, today)).one()
+    return JSONBytesResponse({
+        "borrows": borrows,
+        "page": page,
+        "count": len(borrows),
+        "has_more": has_more,
+        "next_cursor": encode_date_cursor(borrows[-1]["borrow_date"], borrows[-1]["borrow_id"]) if has_more else None,
+        "total_overdue_borrows": total_overdue_borrows,
+        "total_fine_amount": total_fine_amount,
+    })
+
+
+# Overdue totals per user: number of overdue borrows, the longest overdue and the sum of the fines
+@router.get("/overdue/users", response_model=OverdueUsersResponse)
+def overdue_users(
+    sort: str = Query("-fine_amount", regex=SORT_PATTERN),
+    page: int = Query(1, ge=1),
+    limit: int = Query(50, ge=1, le=1000),
+    format: str = Query("json", regex="^(json|csv)$"),
+    db: Session = Depends(get_read_db),
+    current_user: User = Depends(get_current_user)
+):
+    check_admin(current_user)
+    dialect_name, today, ascending = db.get_bind().dialect.name, date.today(), not sort.startswith("-")
+
+    if format == "csv":
+        statement = overdue_users_statement(dialect_name, today, ascending)
+        return StreamingResponse(stream_csv(OVERDUE_USER_COLUMNS, statement), media_type="text/csv",
+                                 headers={"Content-Disposition": 'attachment; filename="overdue_users.csv"'})
+
+    rows = db.execute(overdue_users_statement(dialect_name, today, ascending, limit + 1, (page - 1) * limit)).all()
+    users = [dict(zip(OVERDUE_USER_COLUMNS, row)) for row in rows[:limit]]
+    return JSONBytesResponse({"users": users, "page": page, "count": len(users), "has_more": len(rows) > limit})
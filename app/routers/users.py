@@ -1,14 +1,20 @@
 from fastapi import APIRouter, HTTPException, Depends
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 from app.schemas import UserCreate, UserUpdateRequest, UserSchema
 from app.models import User
-from app.database import get_db
+from app.database import get_db, get_async_db
+from app.replicas import get_read_db
 from app.crypto import get_password_hash
+from app.serialization import JSONBytesResponse
 from typing import List
 
 
-from app.auth import get_current_user
+from app.auth import get_current_user, get_current_user_async, principal_cache
 router = APIRouter()
+# Endpoints on the async database session, served instead of their sync version when ASYNC_DATABASE is set
+async_router = APIRouter()
 
 @router.post("/register")
 def register(user: UserCreate, db: Session = Depends(get_db)):
@@ -32,12 +38,29 @@ def register(user: UserCreate, db: Session = Depends(get_db)):
     return {"message": "User registered successfully"}
 
 
+# Only the columns of UserSchema, encoded directly (see app/serialization.py)
+def users_statement():
+    return select(User.id, User.username, User.email, User.is_admin).order_by(User.id)
+
+
+def users_response(rows) -> JSONBytesResponse:
+    return JSONBytesResponse([
+        {"id": user_id, "username": username, "email": email, "is_admin": bool(is_admin)}
+        for user_id, username, email, is_admin in rows
+    ])
+
+
 @router.get("/", response_model=List[UserSchema])
-def get_all_users(db: Session = Depends(get_db), current_user: UserSchema = Depends(get_current_user)):
+def get_all_users(db: Session = Depends(get_read_db), current_user: UserSchema = Depends(get_current_user)):
+    if not current_user.is_admin:
+        raise HTTPException(status_code=403, detail="Only admins can access this API.")
+    return users_response(db.execute(users_statement()))
+
+@async_router.get("/", response_model=List[UserSchema])
+async def get_all_users_async(db: AsyncSession = Depends(get_async_db), current_user: UserSchema = Depends(get_current_user_async)):
     if not current_user.is_admin:
         raise HTTPException(status_code=403, detail="Only admins can access this API.")
-    users = db.query(User).all()
-    return users
+    return users_response(await db.execute(users_statement()))
 
 @router.put("/me")
 def update_own_user(user_update: UserUpdateRequest,
@@ -89,4 +112,6 @@ def update_user_util(user_update: UserUpdateRequest, user: User, db: Session):
     # Save the changes to the database
     db.commit()
     db.refresh(user)
+    # Tokens cached for the old username, password or role must be authenticated again
+    principal_cache.invalidate_user(user.id)
     
@@ -1,8 +1,51 @@
+import base64
+import binascii
+import json
+from fastapi import HTTPException
 from sqlalchemy.orm import Session
-from sqlalchemy import func, and_, or_, exists
+from sqlalchemy import func, and_, or_, exists, case, insert
 from app.models import User, Copy, Book, Borrow
 from datetime import datetime
 from pydantic.types import Optional
+from typing import List, Tuple
+from app.log import get_logger
+from app.etags import AVAILABILITY_SCOPE, CATALOG_VERSION_SHARDS, bump_catalog_version
+
+logger = get_logger(__name__)
+
+# How many free copies a borrow tries to claim before giving up under contention
+CLAIM_ATTEMPTS = 5
+
+# Opaque keyset pagination cursors: url safe base64 of the sort key of the last row of a page
+def encode_cursor(last_id: int) -> str:
+    payload = json.dumps({"id": last_id}, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(payload).decode().rstrip("=")
+
+# Cursor of the lists ordered by a date then id: the date and the id of the last row of the previous page
+def encode_date_cursor(last_date: datetime, last_id: int) -> str:
+    payload = json.dumps({"date": last_date.isoformat(), "id": last_id}, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(payload).decode().rstrip("=")
+
+def decode_date_cursor(cursor: str) -> Tuple[datetime, int]:
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded))
+        last_date, last_id = datetime.fromisoformat(payload["date"]), payload["id"]
+    except (binascii.Error, ValueError, TypeError, KeyError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if not isinstance(last_id, int):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return last_date, last_id
+
+def decode_cursor(cursor: str) -> int:
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        last_id = json.loads(base64.urlsafe_b64decode(padded))["id"]
+    except (binascii.Error, ValueError, TypeError, KeyError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if not isinstance(last_id, int):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return last_id
 
 def get_ongoing_borrows(book_id: int, db: Session, user_id=None):
     ongoing_borrows_query = db.query(Borrow).join(Copy).filter(
@@ -21,7 +64,6 @@ def get_copies_from_borrows(ongoing_borrows):
 
 def borrowed_record_for_user_and_book(user_id:str, book_id:int, db: Session):
     ongoing_borrows = get_ongoing_borrows(user_id=user_id, book_id=book_id, db=db)
-    print("ongoing borrows = ", ongoing_borrows)
     return ongoing_borrows[0] if ongoing_borrows else None
 
 def borrowed_copy_for_user_and_book(user_id:str, book_id:int, db: Session):
@@ -30,19 +72,250 @@ def borrowed_copy_for_user_and_book(user_id:str, book_id:int, db: Session):
 
 def count_available_copies(book_id: int, db: Session) -> int:
     return (
-        db.query(Copy)
-        .join(Book)
-        .filter(Book.id == book_id, Copy.borrowed == False)
-        .count()
-    )
+        db.query(Book.total_copies - Book.borrowed_copies)
+        .filter(Book.id == book_id)
+        .scalar()
+    ) or 0
 
 def count_borrowed_copies(book_id: int, db: Session) -> int:
     return (
-        db.query(Copy)
-        .join(Book)
-        .filter(Book.id == book_id, Copy.borrowed == True)
-        .count()
+        db.query(Book.borrowed_copies)
+        .filter(Book.id == book_id)
+        .scalar()
+    ) or 0
+
+# Adjust the copy counters of a book in the current transaction, the increment is done by the database
+# so concurrent borrows and returns don't overwrite each other
+def add_copy_counts(book_id: int, db: Session, total: int = 0, borrowed: int = 0):
+    db.query(Book).filter(Book.id == book_id).update(
+        {Book.total_copies: Book.total_copies + total, Book.borrowed_copies: Book.borrowed_copies + borrowed},
+        synchronize_session=False
+    )
+    bump_catalog_version(db, AVAILABILITY_SCOPE, book_id)
+
+# add_copy_counts of the same borrowed increment for several books, in one UPDATE
+def add_borrowed_counts(book_ids: List[int], db: Session, borrowed: int):
+    db.query(Book).filter(Book.id.in_(book_ids)).update(
+        {Book.borrowed_copies: Book.borrowed_copies + borrowed}, synchronize_session=False
+    )
+    # Once per shard touched, in shard order so concurrent batches lock the version rows in the same order
+    for shard in sorted({book_id % CATALOG_VERSION_SHARDS for book_id in book_ids}):
+        bump_catalog_version(db, AVAILABILITY_SCOPE, shard)
+
+# Lock a user's row until the end of the transaction. SQLite has no row locks and only starts the
+# transaction at the first write, so there a no-op UPDATE takes the database write lock instead.
+def lock_user(user_id: int, db: Session):
+    if db.get_bind().dialect.name == "sqlite":
+        db.query(User).filter(User.id == user_id).update({User.id: User.id}, synchronize_session=False)
+    else:
+        db.query(User.id).filter(User.id == user_id).with_for_update().one()
+
+# Borrow a copy of a book for a user as one transaction (the caller commits):
+# the user's row lock serializes concurrent borrows of the same user so the limit and the
+# duplicate checks hold, and the free copy is claimed with FOR UPDATE SKIP LOCKED so concurrent
+# borrowers of the same book never wait for nor receive the same copy. The conditional UPDATE
+# keeps that guarantee on databases without row locks (SQLite).
+def claim_copy(book_id: int, user_id: int, db: Session, max_borrows: int) -> Borrow:
+    lock_user(user_id, db)
+
+    # Open borrows of the user, and how many of them are for this book, in one query
+    num_borrows, num_borrows_of_book = (
+        db.query(func.count(Borrow.id), func.coalesce(func.sum(case((Copy.book_id == book_id, 1), else_=0)), 0))
+        .select_from(Borrow)
+        .join(Copy, Borrow.copy_id == Copy.id)
+        .filter(Borrow.user_id == user_id, Borrow.return_date.is_(None))
+        .one()
+    )
+    if num_borrows >= max_borrows:
+        raise HTTPException(status_code=400, detail="Maximum number of borrows reached")
+    if num_borrows_of_book:
+        raise HTTPException(status_code=400, detail="You have already borrowed this book")
+
+    copy_id = claim_free_copy(book_id, db)
+    if copy_id is None:
+        if not db.query(exists().where(Book.id == book_id)).scalar():
+            raise HTTPException(status_code=404, detail="Book not found")
+        raise HTTPException(status_code=400, detail="No copies available for borrowing")
+
+    borrow = Borrow(copy_id=copy_id, user_id=user_id, borrow_date=datetime.now(), return_date=None)
+    db.add(borrow)
+    add_copy_counts(book_id, db, borrowed=1)
+    return borrow
+
+# Mark a free copy of a book as borrowed and return its id, None when the book has no free copy
+def claim_free_copy(book_id: int, db: Session) -> Optional[int]:
+    for _ in range(CLAIM_ATTEMPTS):
+        copy_id = (
+            db.query(Copy.id)
+            .filter(Copy.book_id == book_id, Copy.borrowed == False)
+            .order_by(Copy.id)
+            .limit(1)
+            .with_for_update(skip_locked=True)
+            .scalar()
+        )
+        if copy_id is None:
+            return None
+
+        claimed = (
+            db.query(Copy)
+            .filter(Copy.id == copy_id, Copy.borrowed == False)
+            .update({Copy.borrowed: True}, synchronize_session=False)
+        )
+        if claimed:
+            return copy_id
+    raise HTTPException(status_code=409, detail="Too many concurrent borrows of this book, please retry")
+
+# Outcome of one book of a batch, with the status code and detail the single book endpoint would return
+def batch_outcome(book_id: int, status_code: int, detail: str) -> dict:
+    return {"book_id": book_id, "status_code": status_code, "detail": detail}
+
+# Borrow several books for a user in one transaction (the caller commits) and return an outcome per book,
+# in the order of book_ids. The user is locked, and the limit and duplicate checks done, once for the batch;
+# a book that can't be borrowed gets its error outcome without affecting the others. Books are granted in
+# order until the user reaches max_borrows. The borrows are inserted, and the counters updated, all at once.
+def claim_copies(book_ids: List[int], user_id: int, db: Session, max_borrows: int) -> List[dict]:
+    lock_user(user_id, db)
+
+    # Open borrows of the user, and the books of the batch among them
+    open_book_ids = [
+        book_id for book_id, in db.query(Copy.book_id)
+        .join(Borrow, Borrow.copy_id == Copy.id)
+        .filter(Borrow.user_id == user_id, Borrow.return_date.is_(None))
+    ]
+    borrowed_book_ids = set(open_book_ids)
+    existing_book_ids = {book_id for book_id, in db.query(Book.id).filter(Book.id.in_(set(book_ids)))}
+    remaining = max_borrows - len(open_book_ids)
+
+    outcomes, seen, claimed = [], set(), {}
+    for book_id in book_ids:
+        if book_id in seen:
+            outcomes.append(batch_outcome(book_id, 400, "Duplicate book in the batch"))
+            continue
+        seen.add(book_id)
+        if book_id not in existing_book_ids:
+            outcomes.append(batch_outcome(book_id, 404, "Book not found"))
+        elif book_id in borrowed_book_ids:
+            outcomes.append(batch_outcome(book_id, 400, "You have already borrowed this book"))
+        elif remaining <= 0:
+            outcomes.append(batch_outcome(book_id, 400, "Maximum number of borrows reached"))
+        else:
+            try:
+                copy_id = claim_free_copy(book_id, db)
+            except HTTPException as exception:
+                outcomes.append(batch_outcome(book_id, exception.status_code, exception.detail))
+                continue
+            if copy_id is None:
+                outcomes.append(batch_outcome(book_id, 400, "No copies available for borrowing"))
+                continue
+            claimed[book_id] = copy_id
+            remaining -= 1
+            outcomes.append(batch_outcome(book_id, 200, "Book borrowed successfully"))
+
+    if claimed:
+        borrow_date = datetime.now()
+        db.execute(insert(Borrow), [
+            {"copy_id": copy_id, "user_id": user_id, "borrow_date": borrow_date, "return_date": None}
+            for copy_id in claimed.values()
+        ])
+        add_borrowed_counts(list(claimed), db, 1)
+    return outcomes
+
+# Return the copy of a book borrowed by a user (the caller commits). Closing the borrow is a
+# conditional UPDATE so a retried or concurrent return cannot release the copy twice.
+def release_copy(book_id: int, user_id: int, db: Session) -> Borrow:
+    borrow = (
+        db.query(Borrow)
+        .join(Copy, Borrow.copy_id == Copy.id)
+        .filter(Borrow.user_id == user_id, Copy.book_id == book_id, Borrow.return_date.is_(None))
+        .first()
+    )
+    returned = borrow is not None and (
+        db.query(Borrow)
+        .filter(Borrow.id == borrow.id, Borrow.return_date.is_(None))
+        .update({Borrow.return_date: datetime.now()}, synchronize_session="fetch")
+    )
+    if not returned:
+        if not db.query(exists().where(Book.id == book_id)).scalar():
+            raise HTTPException(status_code=404, detail="Book not found")
+        raise HTTPException(status_code=400, detail="You have not borrowed this book")
+
+    db.query(Copy).filter(Copy.id == borrow.copy_id).update({Copy.borrowed: False}, synchronize_session=False)
+    add_copy_counts(book_id, db, borrowed=-1)
+    return borrow
+
+# Return several books of a user in one transaction (the caller commits) and return an outcome per book,
+# in the order of book_ids. The user's row lock keeps a concurrent return from closing the same borrows,
+# which are then closed and their copies freed with one UPDATE each.
+def release_copies(book_ids: List[int], user_id: int, db: Session) -> List[dict]:
+    lock_user(user_id, db)
+
+    open_borrows = dict(
+        db.query(Copy.book_id, Borrow.id)
+        .join(Borrow, Borrow.copy_id == Copy.id)
+        .filter(Borrow.user_id == user_id, Borrow.return_date.is_(None), Copy.book_id.in_(set(book_ids)))
+    )
+    missing_book_ids = set(book_ids) - set(open_borrows)
+    existing_book_ids = (
+        {book_id for book_id, in db.query(Book.id).filter(Book.id.in_(missing_book_ids))} if missing_book_ids else set()
+    )
+
+    outcomes, returned, seen = [], [], set()
+    for book_id in book_ids:
+        if book_id in seen:
+            outcomes.append(batch_outcome(book_id, 400, "Duplicate book in the batch"))
+            continue
+        seen.add(book_id)
+        if book_id in open_borrows:
+            returned.append(book_id)
+            outcomes.append(batch_outcome(book_id, 200, "Book returned successfully"))
+        elif book_id in existing_book_ids:
+            outcomes.append(batch_outcome(book_id, 400, "You have not borrowed this book"))
+        else:
+            outcomes.append(batch_outcome(book_id, 404, "Book not found"))
+
+    if returned:
+        borrow_ids = [open_borrows[book_id] for book_id in returned]
+        db.query(Borrow).filter(Borrow.id.in_(borrow_ids)).update(
+            {Borrow.return_date: datetime.now()}, synchronize_session=False
+        )
+        db.query(Copy).filter(Copy.id.in_(db.query(Borrow.copy_id).filter(Borrow.id.in_(borrow_ids)))).update(
+            {Copy.borrowed: False}, synchronize_session=False
+        )
+        add_borrowed_counts(returned, db, -1)
+    return outcomes
+
+# Recompute the copy counters from the copies table and return the books whose counters are off.
+# With repair=True the counters of those books are corrected (the caller commits).
+def check_copy_counters(db: Session, repair: bool = False):
+    copy_counts = (
+        db.query(
+            Copy.book_id.label("book_id"),
+            func.count(Copy.id).label("total"),
+            func.sum(case((Copy.borrowed == True, 1), else_=0)).label("borrowed")
+        )
+        .group_by(Copy.book_id)
+        .subquery()
+    )
+    actual_total = func.coalesce(copy_counts.c.total, 0)
+    actual_borrowed = func.coalesce(copy_counts.c.borrowed, 0)
+    mismatches = (
+        db.query(Book.id, Book.total_copies, Book.borrowed_copies, actual_total, actual_borrowed)
+        .outerjoin(copy_counts, copy_counts.c.book_id == Book.id)
+        .filter(or_(Book.total_copies != actual_total, Book.borrowed_copies != actual_borrowed))
+        .order_by(Book.id)
+        .all()
     )
+    if repair:
+        for book_id, _, _, total, borrowed in mismatches:
+            db.query(Book).filter(Book.id == book_id).update(
+                {Book.total_copies: total, Book.borrowed_copies: borrowed}, synchronize_session=False
+            )
+            bump_catalog_version(db, AVAILABILITY_SCOPE, book_id)
+    return [
+        {"book_id": book_id, "total_copies": stored_total, "borrowed_copies": stored_borrowed,
+         "actual_total_copies": total, "actual_borrowed_copies": borrowed}
+        for book_id, stored_total, stored_borrowed, total, borrowed in mismatches
+    ]
 
 def get_available_copies(book_id: int, db: Session):
     return (
@@ -61,7 +334,7 @@ def get_available_copy(book_id: int, db: Session):
             .first()
         )
     except Exception as e:
-        print("Cannot get first available copy:%s",e)
+        logger.error("Cannot get first available copy", exc_info=e, extra={"book_id": book_id})
     else:    
         return copy
 
@@ -1,6 +1,6 @@
-from pydantic import BaseModel, EmailStr
+from pydantic import BaseModel, EmailStr, conlist
 from pydantic.types import Optional
-from typing import List
+from typing import List, Union
 from datetime import datetime
 
 
@@ -70,6 +70,14 @@ class BooksResponseSchema(BaseSchema):
     page: int = 1
     count: int
     has_more: bool = None
+    next_cursor: Optional[str] = None
+
+class BookSearchResultSchema(BookBaseSchema):
+    score: float
+
+class BookSearchResponseSchema(BaseSchema):
+    results: List[BookSearchResultSchema] = []
+    count: int
 
 class BookCreateSchema(BaseSchema):
     title: str
@@ -92,6 +100,12 @@ class BookDetailsResponseSchema(BaseSchema):
     num_copies: Optional[int]
     num_borrowed_copies: Optional[int]
 
+class BooksBatchResponseSchema(BaseSchema):
+    books: List[BookDetailsResponseSchema] = []
+    count: int
+    # Requested ids (or isbns) that match no book
+    missing: List[Union[int, str]] = []
+
 class BookQueryParams(BaseSchema):
     title: Optional[str]
     author: Optional[str]
@@ -109,4 +123,67 @@ class BorrowResponse(BaseSchema):
 class BorrowsListResponse(BaseSchema):
     borrows: List[BorrowResponse]
     count: int = 0
-    total_fine_amount: float
\ No newline at end of file
+    total_fine_amount: float
+
+class BorrowHistorySchema(BaseSchema):
+    borrow_id: int
+    user_id: int
+    book_id: int
+    book_title: Optional[str]
+    borrow_date: datetime
+    return_date: Optional[datetime]
+
+class BorrowHistoryResponse(BaseSchema):
+    borrows: List[BorrowHistorySchema] = []
+    count: int
+    has_more: bool = None
+    next_cursor: Optional[str] = None
+
+# Most books borrowed or returned by one batch request
+CHECKOUT_BATCH_MAX_BOOKS = 50
+
+class BookBatchRequest(BaseSchema):
+    book_ids: conlist(int, min_items=1, max_items=CHECKOUT_BATCH_MAX_BOOKS)
+
+class BookBatchOutcome(BaseSchema):
+    book_id: int
+    status_code: int
+    detail: str
+
+class BookBatchResponse(BaseSchema):
+    results: List[BookBatchOutcome]
+    succeeded: int
+    failed: int
+
+class OverdueBorrowSchema(BaseSchema):
+    borrow_id: int
+    user_id: int
+    username: str
+    book_id: int
+    book_title: str
+    borrow_date: datetime
+    overdue_days: int
+    fine_amount: float
+
+class OverdueBorrowsResponse(BaseSchema):
+    borrows: List[OverdueBorrowSchema] = []
+    page: int = 1
+    count: int
+    has_more: bool = None
+    next_cursor: Optional[str] = None
+    total_overdue_borrows: int
+    total_fine_amount: float
+
+class OverdueUserSchema(BaseSchema):
+    user_id: int
+    username: str
+    email: str
+    overdue_borrows: int
+    max_overdue_days: int
+    total_fine_amount: float
+
+class OverdueUsersResponse(BaseSchema):
+    users: List[OverdueUserSchema] = []
+    page: int = 1
+    count: int
+    has_more: bool = None
@@ -0,0 +1,268 @@
+import math
+import re
+import threading
+import time
+from collections import defaultdict
+from typing import Dict, List, Set
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+from app.config import settings
+from app.database import engine
+from app.models import Author, Book
+
+# Trigram search over book titles and author names.
+# On Postgres the pg_trgm GIN indexes (see app/migrations/m0003_search_indexes.py) answer the queries
+# (they also serve the ilike filters of GET /books),
+# everywhere else an in-process inverted trigram index is used.
+
+_NON_WORD = re.compile(r"[^\w]+")
+
+
+# Split a text into the padded word trigrams used by pg_trgm ("  h", " ha", "har", ..., "ry ")
+def trigrams(value: str) -> Set[str]:
+    grams = set()
+    for word in _NON_WORD.sub(" ", (value or "").lower()).split():
+        padded = "  " + word + " "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+class TrigramIndex:
+    """Inverted index from trigram to document keys."""
+
+    def __init__(self):
+        self.postings: Dict[str, Set[int]] = defaultdict(set)
+        self.documents: Dict[int, Set[str]] = {}
+
+    def add(self, key: int, value: str):
+        self.remove(key)
+        grams = trigrams(value)
+        self.documents[key] = grams
+        for gram in grams:
+            self.postings[gram].add(key)
+
+    def remove(self, key: int):
+        for gram in self.documents.pop(key, ()):
+            keys = self.postings.get(gram)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.postings[gram]
+
+    # Score documents by the share of query trigrams they contain, which tolerates typos and matches
+    # substrings of long titles. A document reaching min_score must contain at least one of the
+    # rarest len(query) - required + 1 query trigrams, so only those posting lists are scanned.
+    def search(self, query_grams: Set[str], min_score: float) -> Dict[int, float]:
+        if not query_grams:
+            return {}
+        required = max(1, math.ceil(min_score * len(query_grams)))
+        by_rarity = sorted(query_grams, key=lambda gram: len(self.postings.get(gram, ())))
+        candidates = set()
+        for gram in by_rarity[:len(query_grams) - required + 1]:
+            candidates.update(self.postings.get(gram, ()))
+
+        scores = {}
+        for key in candidates:
+            shared = len(query_grams & self.documents[key])
+            if shared >= required:
+                scores[key] = shared / len(query_grams)
+        return scores
+
+
+class CatalogIndex:
+    """Trigram indexes of the titles and author names, with what the results show of every book."""
+
+    def __init__(self):
+        self.titles = TrigramIndex()
+        self.authors = TrigramIndex()
+        self.books = {}
+        self.author_books = defaultdict(set)
+
+    def add(self, book_id, title, isbn, author_id, author_name):
+        self.books[book_id] = (title, isbn, author_id, author_name)
+        self.titles.add(book_id, title)
+        if author_id is not None:
+            if author_id not in self.author_books:
+                self.authors.add(author_id, author_name)
+            self.author_books[author_id].add(book_id)
+
+    def remove(self, book_id):
+        book = self.books.pop(book_id, None)
+        if book is None:
+            return
+        self.titles.remove(book_id)
+        author_id = book[2]
+        if author_id is not None:
+            self.author_books[author_id].discard(book_id)
+            if not self.author_books[author_id]:
+                del self.author_books[author_id]
+                self.authors.remove(author_id)
+
+
+def _book_rows(db: Session):
+    return db.query(Book.id, Book.title, Book.isbn, Author.id, Author.name).outerjoin(Author, Book.author_id == Author.id)
+
+
+class MemorySearchBackend:
+    """Pure Python search backend, rebuilt from the database when older than SEARCH_INDEX_MAX_AGE_SECONDS.
+
+    One search rebuilds a new index outside the lock while the others keep searching the current one, which is
+    swapped for it once built. Only the first build is waited for.
+    """
+
+    def __init__(self, max_age_seconds: int):
+        self.max_age_seconds = max_age_seconds
+        self.lock = threading.RLock()
+        self.reload_lock = threading.Lock()
+        self.index = CatalogIndex()
+        self.loaded_at = None
+        self.built = False
+        # Books written while a rebuild runs, applied again to the new index: it may have read them before the write
+        self.changed_during_reload = None
+        self.expired = False
+
+    def _stale(self) -> bool:
+        return self.loaded_at is None or time.monotonic() - self.loaded_at > self.max_age_seconds
+
+    def _load(self, db: Session):
+        with self.lock:
+            self.changed_during_reload = set()
+            self.expired = False
+        index = CatalogIndex()
+        try:
+            for row in _book_rows(db).yield_per(10000):
+                index.add(*row)
+        except Exception:
+            with self.lock:
+                self.changed_during_reload = None
+            raise
+        with self.lock:
+            changed, self.changed_during_reload = self.changed_during_reload, None
+            self.index = index
+            for book_id in changed:
+                self._refresh(book_id, db)
+            # A large batch written meanwhile is picked up by the next rebuild
+            self.loaded_at = None if self.expired else time.monotonic()
+            self.built = True
+
+    def _ensure_loaded(self, db: Session):
+        with self.lock:
+            if not self._stale():
+                return
+            wait = not self.built
+        if not self.reload_lock.acquire(blocking=wait):
+            # Another search is rebuilding the index
+            return
+        try:
+            with self.lock:
+                if not self._stale():
+                    return
+            self._load(db)
+        finally:
+            self.reload_lock.release()
+
+    def search(self, query: str, limit: int, db: Session) -> List[dict]:
+        query_grams = trigrams(query)
+        self._ensure_loaded(db)
+        with self.lock:
+            index = self.index
+            scores = index.titles.search(query_grams, settings.SEARCH_MIN_SIMILARITY)
+            for author_id, score in index.authors.search(query_grams, settings.SEARCH_MIN_SIMILARITY).items():
+                for book_id in index.author_books.get(author_id, ()):
+                    if score > scores.get(book_id, 0):
+                        scores[book_id] = score
+            ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:limit]
+            return [
+                {"id": book_id, "title": index.books[book_id][0], "isbn": index.books[book_id][1],
+                 "author": index.books[book_id][3], "score": round(score, 3)}
+                for book_id, score in ranked
+            ]
+
+    def _refresh(self, book_id: int, db: Session):
+        row = _book_rows(db).filter(Book.id == book_id).first()
+        self.index.remove(book_id)
+        if row:
+            self.index.add(*row)
+
+    # Keep the index of this process in sync with writes, other processes catch up on their next reload
+    def book_changed(self, book_id: int, db: Session):
+        with self.lock:
+            if self.changed_during_reload is not None:
+                self.changed_during_reload.add(book_id)
+            if not self.built:
+                return
+            self._refresh(book_id, db)
+
+    def books_changed(self, book_ids: List[int], db: Session):
+        with self.lock:
+            # A large batch is cheaper to pick up with a full reload
+            if len(book_ids) > 1000:
+                self.loaded_at = None
+                self.expired = True
+                return
+            if not self.built and self.changed_during_reload is None:
+                return
+        for book_id in book_ids:
+            self.book_changed(book_id, db)
+
+    def book_deleted(self, book_id: int):
+        with self.lock:
+            if self.changed_during_reload is not None:
+                self.changed_during_reload.add(book_id)
+            self.index.remove(book_id)
+
+
+class PostgresSearchBackend:
+    """Search backend using the pg_trgm extension and its GIN indexes on books.title and authors.name."""
+
+    # Each side is matched through its own index (an OR across the two tables of a join could use neither and
+    # would score every book): the titles through ix_books_title_trgm, the authors through ix_authors_name_trgm
+    # then their books through ix_books_author_id. Only the matches are joined and ranked.
+    SEARCH_QUERY = text("""
+        WITH matches AS (
+            SELECT id FROM books WHERE :query <% title
+            UNION
+            SELECT id FROM books WHERE author_id IN (SELECT id FROM authors WHERE :query <% name)
+        )
+        SELECT books.id, books.title, books.isbn, authors.name AS author,
+               greatest(word_similarity(:query, books.title), word_similarity(:query, coalesce(authors.name, ''))) AS score
+        FROM matches
+        JOIN books ON books.id = matches.id
+        LEFT JOIN authors ON authors.id = books.author_id
+        ORDER BY score DESC, books.id
+        LIMIT :limit
+    """)
+
+    def search(self, query: str, limit: int, db: Session) -> List[dict]:
+        # Threshold of the <% operator, scoped to the current transaction
+        db.execute(text("SELECT set_config('pg_trgm.word_similarity_threshold', :threshold, true)"),
+                   {"threshold": str(settings.SEARCH_MIN_SIMILARITY)})
+        rows = db.execute(self.SEARCH_QUERY, {"query": query, "limit": limit})
+        return [
+            {"id": row.id, "title": row.title, "isbn": row.isbn, "author": row.author, "score": round(row.score, 3)}
+            for row in rows
+        ]
+
+    # Postgres keeps its indexes up to date by itself
+    def book_changed(self, book_id: int, db: Session):
+        pass
+
+    def books_changed(self, book_ids: List[int], db: Session):
+        pass
+
+    def book_deleted(self, book_id: int):
+        pass
+
+
+def create_search_backend(dialect_name: str):
+    backend = settings.SEARCH_BACKEND
+    if backend == "auto":
+        backend = "postgres" if dialect_name == "postgresql" else "memory"
+    if backend == "postgres":
+        return PostgresSearchBackend()
+    if backend == "memory":
+        return MemorySearchBackend(settings.SEARCH_INDEX_MAX_AGE_SECONDS)
+    raise ValueError("Unknown SEARCH_BACKEND: {0}".format(settings.SEARCH_BACKEND))
+
+
+search_backend = create_search_backend(engine.dialect.name)
@@ -0,0 +1,36 @@
+import json
+from datetime import date, datetime
+from fastapi import Response
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - the stdlib encoder is used instead
+    orjson = None
+
+# Direct JSON encoding of the list endpoints: their rows are selected as plain column tuples and turned
+# into dicts of str / int / float / bool / datetime values, so they skip the pydantic models, the
+# response_model validation and jsonable_encoder, and are encoded in one call.
+# orjson is used when installed, the output is the same as FastAPI's JSONResponse for these values.
+
+
+def _default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def dumps(content) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(content)
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, separators=(",", ":"), default=_default).encode()
+
+
+class JSONBytesResponse(Response):
+    """Response of already encoded JSON (bytes), or of content made of plain values only."""
+
+    media_type = "application/json"
+
+    def render(self, content) -> bytes:
+        if isinstance(content, bytes):
+            return content
+        return dumps(content)
@@ -0,0 +1,53 @@
+"""Drives an ASGI app in-process with the same interface as http_client.HTTPConnection."""
+import asyncio
+
+
+class ASGIConnection:
+    def __init__(self, app):
+        self.app = app
+
+    async def open(self):
+        pass
+
+    async def close(self):
+        pass
+
+    async def request(self, method: str, path: str, headers: dict = None, body: bytes = b""):
+        """Run one request through the app and return (status, headers, body)."""
+        path, _, query_string = path.partition("?")
+        scope = {
+            "type": "http",
+            "asgi": {"version": "3.0"},
+            "http_version": "1.1",
+            "method": method,
+            "scheme": "http",
+            "path": path,
+            "raw_path": path.encode(),
+            "query_string": query_string.encode(),
+            "root_path": "",
+            "headers": [(name.lower().encode("latin-1"), str(value).encode("latin-1"))
+                        for name, value in (headers or {}).items()] + [(b"host", b"benchmark")],
+            "client": ("127.0.0.1", 50000),
+            "server": ("benchmark", 80),
+        }
+        request_sent = False
+        response = {"status": None, "headers": {}, "body": []}
+
+        async def receive():
+            nonlocal request_sent
+            if not request_sent:
+                request_sent = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            # The client stays connected until the response is complete (streaming responses listen for this)
+            await asyncio.Event().wait()
+
+        async def send(message):
+            if message["type"] == "http.response.start":
+                response["status"] = message["status"]
+                response["headers"] = {name.decode("latin-1"): value.decode("latin-1")
+                                       for name, value in message.get("headers", [])}
+            elif message["type"] == "http.response.body":
+                response["body"].append(message.get("body", b""))
+
+        await self.app(scope, receive, send)
+        return response["status"], response["headers"], b"".join(response["body"])
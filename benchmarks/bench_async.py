@@ -0,0 +1,149 @@
+"""Load test comparing the thread pool model with the async database path (ASYNC_DATABASE).
+
+Seeds a database, then for each mode starts uvicorn in a subprocess and drives it with
+CONCURRENCY keep-alive clients issuing GET /books pages and authenticated GET /books/{id}
+for DURATION seconds. Reports throughput and latency percentiles per mode as JSON.
+
+Usage (from the repository root):
+    python benchmarks/bench_async.py --concurrency 500 --duration 30 --database-url sqlite:///./bench_async.db
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from http_client import HTTPConnection, form_body, percentile, wait_until_up  # noqa: E402
+
+USERNAME = "bench"
+PASSWORD = "bench-password"
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, default=500)
+    parser.add_argument("--duration", type=float, default=30.0, help="Seconds per mode")
+    parser.add_argument("--scale", type=int, default=100, help="How many times books.json is repeated when seeding")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--database-url", default=os.environ.get("DATABASE_URL", "sqlite:///./bench_async.db"))
+    return parser.parse_args()
+
+
+def seed(args) -> int:
+    os.environ["DATABASE_URL"] = args.database_url
+    os.environ["SQL_ECHO"] = "false"
+    # Compares how both models queue CONCURRENCY requests, admission control would shed most of them
+    os.environ.setdefault("ADMISSION_CONTROL_ENABLED", "false")
+    sys.path.insert(0, ROOT)
+
+    from app.crypto import get_password_hash
+    from app.database import SessionLocal, engine
+    from app.ingest import ingest_books
+    from app.migrations import reset_database
+    from app.models import Book, User
+    from app.schemas import BookCreateSchema
+
+    reset_database(engine)
+    with open(os.path.join(ROOT, "books.json")) as books_file:
+        catalog = json.load(books_file)
+    rows = [
+        BookCreateSchema(title=book["title"], author=book["author"], isbn=f"{book['isbn']}-{copy}", copies=book["copies"])
+        for copy in range(args.scale)
+        for book in catalog
+    ]
+    db = SessionLocal()
+    try:
+        ingest_books(rows, db)
+        db.add(User(username=USERNAME, email="bench@example.com", password=get_password_hash(PASSWORD)))
+        db.commit()
+        return db.query(Book).count()
+    finally:
+        db.close()
+
+
+async def client(args, token: str, num_books: int, deadline: float, latencies: list, errors: list):
+    connection = HTTPConnection("127.0.0.1", args.port)
+    headers = {"Authorization": f"Bearer {token}"}
+    try:
+        while time.perf_counter() < deadline:
+            if random.random() < 0.5:
+                path = f"/books/?page={random.randint(1, max(1, num_books // 10))}&limit=10"
+            else:
+                path = f"/books/{random.randint(1, num_books)}"
+            started = time.perf_counter()
+            try:
+                status, _, _ = await connection.request("GET", path, headers)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                errors.append("connection")
+                await connection.close()
+                continue
+            if status == 200:
+                latencies.append(time.perf_counter() - started)
+            else:
+                errors.append(status)
+    finally:
+        await connection.close()
+
+
+async def drive(args, num_books: int) -> dict:
+    await wait_until_up("127.0.0.1", args.port)
+    login = HTTPConnection("127.0.0.1", args.port)
+    _, _, body = await login.request(
+        "POST", "/login", {"Content-Type": "application/x-www-form-urlencoded"},
+        form_body({"username": USERNAME, "password": PASSWORD})
+    )
+    await login.close()
+    token = json.loads(body)["access_token"]
+
+    latencies, errors = [], []
+    started = time.perf_counter()
+    deadline = started + args.duration
+    await asyncio.gather(*(client(args, token, num_books, deadline, latencies, errors) for _ in range(args.concurrency)))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": len(errors),
+        "throughput_rps": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+    }
+
+
+def run_mode(args, num_books: int, async_database: bool) -> dict:
+    env = dict(os.environ, DATABASE_URL=args.database_url, SQL_ECHO="false", ASYNC_DATABASE=str(async_database).lower())
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.main:app", "--host", "127.0.0.1", "--port", str(args.port),
+         "--log-level", "warning", "--backlog", str(max(2048, args.concurrency * 2))],
+        cwd=ROOT, env=env, stdout=subprocess.DEVNULL,
+    )
+    try:
+        return asyncio.run(drive(args, num_books))
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    args = parse_args()
+    num_books = seed(args)
+    results = {
+        "concurrency": args.concurrency,
+        "duration_s": args.duration,
+        "books": num_books,
+        "thread_pool": run_mode(args, num_books, async_database=False),
+        "async": run_mode(args, num_books, async_database=True),
+    }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""Benchmark for the bulk book ingestion used by POST /books (app/ingest.py).
+
+Loads books.json scaled up SCALE times (every copy of the file gets its own isbns)
+and reports rows/sec and copies/sec as JSON.
+
+Usage (from the repository root):
+    python benchmarks/bench_ingest.py --scale 10000 --database-url sqlite:///./bench_ingest.db
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scale", type=int, default=10000, help="How many times books.json is repeated")
+    parser.add_argument("--chunk-size", type=int, default=None, help="Rows per transaction (INGEST_CHUNK_SIZE)")
+    parser.add_argument("--database-url", default=os.environ.get("DATABASE_URL", "sqlite:///./bench_ingest.db"))
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    # The app reads DATABASE_URL when app.database is imported
+    os.environ["DATABASE_URL"] = args.database_url
+    sys.path.insert(0, ROOT)
+
+    from app.database import SessionLocal, engine
+    from app.ingest import ingest_books
+    from app.migrations import reset_database
+    from app.schemas import BookCreateSchema
+
+    # Statement logging would dominate the measurement
+    engine.echo = False
+    reset_database(engine)
+
+    with open(os.path.join(ROOT, "books.json")) as books_file:
+        catalog = json.load(books_file)
+
+    rows = [
+        BookCreateSchema(title=book["title"], author=book["author"], isbn=f"{book['isbn']}-{copy}", copies=book["copies"])
+        for copy in range(args.scale)
+        for book in catalog
+    ]
+    total_copies = sum(row.copies for row in rows)
+
+    db = SessionLocal()
+    try:
+        started = time.perf_counter()
+        results = ingest_books(rows, db, chunk_size=args.chunk_size)
+        elapsed = time.perf_counter() - started
+    finally:
+        db.close()
+
+    print(json.dumps({
+        "database": engine.dialect.name,
+        "rows": len(rows),
+        "copies": total_copies,
+        "created": sum(1 for result in results if result["status"] == "created"),
+        "seconds": round(elapsed, 3),
+        "rows_per_sec": round(len(rows) / elapsed, 1),
+        "copies_per_sec": round(total_copies / elapsed, 1),
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
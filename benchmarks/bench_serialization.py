@@ -0,0 +1,183 @@
+"""Benchmark of the serialization of the list endpoints: ORM models and pydantic against column projections.
+
+For GET /books pages, GET /users and GET /users/{id}/borrows, measures the rows per second turned into
+the JSON body, database query included, by:
+  - "orm": the previous path, loading ORM objects (the authors lazily for the books, eagerly for the
+    borrows), building the pydantic response models and serializing them as FastAPI does with a
+    response_model (validation, jsonable_encoder, json.dumps).
+  - "projection": the current path, selecting only the needed columns in one joined query and encoding
+    the rows directly (app/serialization.py).
+
+Seeds the database with benchmarks/seed.py and reports the results as JSON.
+
+Usage (from the repository root):
+    python benchmarks/bench_serialization.py --scale 20000 --database-url sqlite:///./bench_serialization.db
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, ROOT)
+
+from seed import seed  # noqa: E402
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scale", type=int, default=20000, help="Books seeded, see benchmarks/seed.py")
+    parser.add_argument("--limit", type=int, default=100, help="Books per GET /books page")
+    parser.add_argument("--duration", type=float, default=3.0, help="Seconds per endpoint and path")
+    parser.add_argument("--database-url", default=os.environ.get("DATABASE_URL", "sqlite:///./bench_serialization.db"))
+    return parser.parse_args()
+
+
+# The response_model handling of FastAPI: validation of the returned value, then jsonable_encoder
+def fastapi_body(field, content) -> bytes:
+    from fastapi.encoders import jsonable_encoder
+    from fastapi.responses import JSONResponse
+
+    value, errors = field.validate(content, {}, loc=("response",))
+    assert not errors, errors
+    return JSONResponse(jsonable_encoder(value)).body
+
+
+def orm_paths(limit: int):
+    from fastapi.utils import create_response_field
+    from typing import List
+    from sqlalchemy import select
+    from sqlalchemy.orm import joinedload
+    from app.models import Author, Book, Borrow, Copy, User
+    from app.routers.borrows import MAX_BORROW_TIME, BORROW_FINE_PER_OVERDUE_DAY
+    from app.routers.utils import encode_cursor
+    from app.schemas import BookBaseSchema, BooksResponseSchema, BorrowResponse, BorrowsListResponse, UserSchema
+
+    books_field = create_response_field("books", BooksResponseSchema)
+    users_field = create_response_field("users", List[UserSchema])
+    borrows_field = create_response_field("borrows", BorrowsListResponse)
+
+    def books_page(db, page: int):
+        books = db.query(Book).order_by(Book.id).offset((page - 1) * limit).limit(limit + 1).all()
+        books = [BookBaseSchema.from_model(book) for book in books]
+        has_more = len(books) > limit
+        if has_more:
+            books = books[:-1]
+        next_cursor = encode_cursor(books[-1].id) if has_more else None
+        content = BooksResponseSchema(books=books, page=page, count=len(books), has_more=has_more, next_cursor=next_cursor)
+        return fastapi_body(books_field, content), len(books)
+
+    def users(db):
+        rows = db.query(User).all()
+        return fastapi_body(users_field, rows), len(rows)
+
+    def borrows(db, user_id: int):
+        statement = (
+            select(Borrow).join(Copy).join(Book).join(Author)
+            .options(joinedload(Borrow.copy).joinedload(Copy.book).joinedload(Book.author))
+            .filter(Borrow.user_id == user_id, Borrow.return_date.is_(None))
+        )
+        borrow_list, total_fine_amount = [], 0
+        for borrow in db.execute(statement).scalars().all():
+            remaining_days = (borrow.borrow_date.date() + timedelta(days=MAX_BORROW_TIME) - datetime.now().date()).days
+            fine_amount = -remaining_days * BORROW_FINE_PER_OVERDUE_DAY if remaining_days < 0 else 0
+            total_fine_amount += fine_amount
+            borrow_list.append(BorrowResponse(
+                book_id=borrow.copy.book.id, book_title=borrow.copy.book.title, author=borrow.copy.book.author.name,
+                borrow_date=borrow.borrow_date, remaining_days=remaining_days, fine_amount=fine_amount,
+            ))
+        content = BorrowsListResponse(borrows=borrow_list, count=len(borrow_list), total_fine_amount=total_fine_amount)
+        return fastapi_body(borrows_field, content), len(borrow_list)
+
+    return books_page, users, borrows
+
+
+def projection_paths(limit: int):
+    from app.routers.books import books_page_response, books_page_statement
+    from app.routers.borrows import borrows_list_response, open_borrows_statement
+    from app.routers.users import users_response, users_statement
+    from app.schemas import BookQueryParams
+
+    query_params = BookQueryParams()
+
+    def books_page(db, page: int):
+        rows = db.execute(books_page_statement(query_params, page, limit, None)).all()
+        return books_page_response(rows, page, limit), min(len(rows), limit)
+
+    def users(db):
+        rows = db.execute(users_statement()).all()
+        return users_response(rows).body, len(rows)
+
+    def borrows(db, user_id: int):
+        rows = db.execute(open_borrows_statement(user_id)).all()
+        return borrows_list_response(rows).body, len(rows)
+
+    return books_page, users, borrows
+
+
+# Calls run(n) for DURATION seconds, returns the rows serialized per second
+def measure(run, duration: float) -> dict:
+    rows, calls = 0, 0
+    started = time.perf_counter()
+    while time.perf_counter() - started < duration:
+        rows += run(calls)[1]
+        calls += 1
+    elapsed = time.perf_counter() - started
+    return {"rows_per_sec": round(rows / elapsed), "requests_per_sec": round(calls / elapsed, 1)}
+
+
+def main():
+    args = parse_args()
+    os.environ["DATABASE_URL"] = args.database_url
+    os.environ["SQL_ECHO"] = "false"
+    sys.path.insert(0, os.path.dirname(ROOT))
+
+    seeded = seed(args.database_url, args.scale, 42)
+
+    from sqlalchemy import func, select
+    from app.database import SessionLocal
+    from app.models import Borrow
+    from app.serialization import orjson
+
+    db = SessionLocal()
+    try:
+        # The users with the most open borrows
+        user_ids = [user_id for user_id, _ in db.execute(
+            select(Borrow.user_id, func.count()).filter(Borrow.return_date.is_(None))
+            .group_by(Borrow.user_id).order_by(func.count().desc()).limit(100))]
+        pages = max(1, seeded["books"] // args.limit)
+
+        results = {}
+        bodies = {}
+        for name, (books_page, users, borrows) in (("orm", orm_paths(args.limit)), ("projection", projection_paths(args.limit))):
+            runs = {
+                "get_books": lambda n: books_page(db, n % pages + 1),
+                "get_all_users": lambda n: users(db),
+                "get_user_borrows": lambda n: borrows(db, user_ids[n % len(user_ids)]),
+            }
+            for endpoint, run in runs.items():
+                bodies[(endpoint, name)] = run(0)[0]
+                results.setdefault(endpoint, {})[name] = measure(run, args.duration)
+                # Nothing is cached between the calls
+                db.expunge_all()
+        for endpoint, paths in results.items():
+            paths["speedup"] = round(paths["projection"]["rows_per_sec"] / paths["orm"]["rows_per_sec"], 2)
+            # Both paths return the same data
+            paths["same_output"] = json.loads(bodies[(endpoint, "orm")]) == json.loads(bodies[(endpoint, "projection")])
+    finally:
+        db.close()
+
+    print(json.dumps({
+        "database": seeded["database"],
+        "books": seeded["books"],
+        "users": seeded["users"],
+        "limit": args.limit,
+        "encoder": "orjson" if orjson is not None else "json",
+        "endpoints": results,
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
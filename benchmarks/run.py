@@ -0,0 +1,280 @@
+"""Load test of the API with a mixed read/write workload, reported per endpoint.
+
+Drives the application either in-process (the ASGI app is called directly, no sockets) or over
+HTTP (uvicorn in a subprocess) with CLIENTS concurrent clients for DURATION seconds. Each client
+acts as its own user and picks its next request from the weighted WORKLOAD mix. The database must
+have been seeded by benchmarks/seed.py.
+
+Reports requests, errors, throughput and p50/p95/p99 latency per endpoint as JSON, optionally saved
+with --output. --baseline compares with a saved report and exits with status 1 when an endpoint's p95
+latency grew, or its throughput dropped, by more than TOLERANCE.
+
+Usage (from the repository root):
+    python benchmarks/seed.py --scale 100000 --database-url sqlite:///./bench.db
+    python benchmarks/run.py --database-url sqlite:///./bench.db --output baseline.json
+    python benchmarks/run.py --database-url sqlite:///./bench.db --baseline baseline.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+from collections import defaultdict
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, ROOT)
+
+from http_client import HTTPConnection, form_body, percentile, wait_until_up  # noqa: E402
+from seed import PASSWORD, WORDS  # noqa: E402
+
+# Relative weights of the endpoints in each workload
+WORKLOADS = {
+    "read": {
+        "list_books": 30, "list_books_filtered": 10, "search_books": 15, "get_book": 35, "my_borrows": 10,
+    },
+    "mixed": {
+        "list_books": 25, "list_books_filtered": 10, "search_books": 10, "get_book": 25, "my_borrows": 10,
+        "borrow_book": 10, "return_book": 9, "login": 1,
+    },
+    "write": {
+        "get_book": 20, "my_borrows": 10, "borrow_book": 35, "return_book": 35,
+    },
+}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--transport", choices=("inprocess", "http"), default="inprocess")
+    parser.add_argument("--workload", choices=sorted(WORKLOADS), default="mixed")
+    parser.add_argument("--clients", type=int, default=50)
+    parser.add_argument("--duration", type=float, default=30.0, help="Seconds")
+    parser.add_argument("--warmup", type=float, default=2.0, help="Seconds run before measuring")
+    parser.add_argument("--random-seed", type=int, default=42)
+    parser.add_argument("--port", type=int, default=8766, help="Port of the uvicorn server with --transport http")
+    parser.add_argument("--database-url", default=os.environ.get("DATABASE_URL", "sqlite:///./bench.db"))
+    parser.add_argument("--output", help="Save the report to this file")
+    parser.add_argument("--baseline", help="Compare with the report saved in this file")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="Allowed relative regression")
+    return parser.parse_args(argv)
+
+
+class Client:
+    """One simulated user with its own connection and the books it currently holds."""
+
+    def __init__(self, connection, username: str, token: str, num_books: int, rnd: random.Random):
+        self.connection = connection
+        self.username = username
+        self.headers = {"Authorization": f"Bearer {token}"}
+        self.num_books = num_books
+        self.rnd = rnd
+        self.borrowed = []
+
+    def next_request(self, endpoint: str):
+        """Return (endpoint, method, path, headers, body) for the chosen endpoint."""
+        rnd = self.rnd
+        if endpoint == "return_book" and not self.borrowed:
+            endpoint = "borrow_book"
+        if endpoint == "list_books":
+            page = rnd.randint(1, max(1, min(self.num_books // 20, 500)))
+            return endpoint, "GET", f"/books/?page={page}&limit=20", {}, b""
+        if endpoint == "list_books_filtered":
+            return endpoint, "GET", f"/books/?title={rnd.choice(WORDS)}&available=true&limit=20", {}, b""
+        if endpoint == "search_books":
+            return endpoint, "GET", f"/books/search?q={rnd.choice(WORDS)}+{rnd.choice(WORDS)}", {}, b""
+        if endpoint == "get_book":
+            return endpoint, "GET", f"/books/{rnd.randint(1, self.num_books)}", self.headers, b""
+        if endpoint == "my_borrows":
+            return endpoint, "GET", "/users/me/borrows", self.headers, b""
+        if endpoint == "borrow_book":
+            return endpoint, "POST", f"/books/{rnd.randint(1, self.num_books)}/borrow", self.headers, b""
+        if endpoint == "return_book":
+            book_id = self.borrowed.pop(rnd.randrange(len(self.borrowed)))
+            return endpoint, "POST", f"/books/{book_id}/return", self.headers, b""
+        if endpoint == "login":
+            body = form_body({"username": self.username, "password": PASSWORD})
+            return endpoint, "POST", "/login", {"Content-Type": "application/x-www-form-urlencoded"}, body
+        raise ValueError(f"Unknown endpoint: {endpoint}")
+
+    def record_outcome(self, endpoint: str, path: str, status: int):
+        if endpoint == "borrow_book" and status == 200:
+            self.borrowed.append(int(path.split("/")[2]))
+
+
+class Results:
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.statuses = defaultdict(lambda: defaultdict(int))
+        self.errors = defaultdict(int)
+        self.recording = False
+
+    def record(self, endpoint: str, elapsed: float, status):
+        if not self.recording:
+            return
+        if status is None or status >= 500:
+            self.errors[endpoint] += 1
+        else:
+            self.latencies[endpoint].append(elapsed)
+        self.statuses[endpoint][str(status or "connection")] += 1
+
+    def report(self, elapsed: float) -> dict:
+        endpoints = {}
+        for endpoint in sorted(set(self.latencies) | set(self.errors)):
+            latencies = sorted(self.latencies[endpoint])
+            endpoints[endpoint] = {
+                "requests": len(latencies),
+                "errors": self.errors[endpoint],
+                "statuses": dict(self.statuses[endpoint]),
+                "throughput_rps": round(len(latencies) / elapsed, 1),
+                "p50_ms": round(percentile(latencies, 0.50) * 1000, 2),
+                "p95_ms": round(percentile(latencies, 0.95) * 1000, 2),
+                "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+            }
+        return endpoints
+
+
+async def run_client(client: Client, weights: dict, results: Results, deadline: float):
+    endpoints, cumulative = list(weights), list(weights.values())
+    try:
+        while time.perf_counter() < deadline:
+            endpoint = client.rnd.choices(endpoints, cumulative)[0]
+            endpoint, method, path, headers, body = client.next_request(endpoint)
+            started = time.perf_counter()
+            try:
+                status, _, _ = await client.connection.request(method, path, headers, body)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                results.record(endpoint, time.perf_counter() - started, None)
+                await client.connection.close()
+                continue
+            results.record(endpoint, time.perf_counter() - started, status)
+            client.record_outcome(endpoint, path, status)
+    finally:
+        await client.connection.close()
+
+
+def dataset_bounds(database_url: str) -> dict:
+    from sqlalchemy import create_engine, func, select
+    from app.models import Book, User
+
+    engine = create_engine(database_url)
+    try:
+        with engine.connect() as conn:
+            num_books = conn.execute(select(func.max(Book.id))).scalar() or 0
+            usernames = [row[0] for row in conn.execute(
+                select(User.username).where(User.is_admin.is_(False)).order_by(User.id))]
+    finally:
+        engine.dispose()
+    if not num_books or not usernames:
+        raise SystemExit("The database is empty, seed it first with benchmarks/seed.py")
+    return {"books": num_books, "usernames": usernames}
+
+
+async def drive(args, connection_factory, bounds: dict) -> dict:
+    from app.auth import create_access_token
+
+    rnd = random.Random(args.random_seed)
+    usernames = bounds["usernames"]
+    clients = [
+        Client(connection_factory(), usernames[n % len(usernames)], create_access_token(usernames[n % len(usernames)]),
+               bounds["books"], random.Random(rnd.random()))
+        for n in range(args.clients)
+    ]
+    weights = WORKLOADS[args.workload]
+    results = Results()
+
+    started = time.perf_counter()
+    deadline = started + args.warmup + args.duration
+    tasks = [asyncio.ensure_future(run_client(client, weights, results, deadline)) for client in clients]
+    await asyncio.sleep(args.warmup)
+    results.recording = True
+    measured_from = time.perf_counter()
+    await asyncio.gather(*tasks)
+    return results.report(time.perf_counter() - measured_from)
+
+
+def run_inprocess(args, bounds: dict) -> dict:
+    from app.main import app
+    from asgi_client import ASGIConnection
+
+    async def main():
+        await app.router.startup()
+        try:
+            return await drive(args, lambda: ASGIConnection(app), bounds)
+        finally:
+            await app.router.shutdown()
+
+    return asyncio.run(main())
+
+
+def run_http(args, bounds: dict) -> dict:
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.main:app", "--host", "127.0.0.1", "--port", str(args.port),
+         "--log-level", "warning", "--backlog", str(max(2048, args.clients * 2))],
+        cwd=os.path.dirname(ROOT), env=dict(os.environ), stdout=subprocess.DEVNULL,
+    )
+
+    async def main():
+        await wait_until_up("127.0.0.1", args.port)
+        return await drive(args, lambda: HTTPConnection("127.0.0.1", args.port), bounds)
+
+    try:
+        return asyncio.run(main())
+    finally:
+        server.terminate()
+        server.wait()
+
+
+# Compare p95 latency and throughput of every endpoint present in both reports
+def compare(report: dict, baseline: dict, tolerance: float) -> list:
+    regressions = []
+    for endpoint, current in report["endpoints"].items():
+        previous = baseline.get("endpoints", {}).get(endpoint)
+        if not previous:
+            continue
+        if previous["p95_ms"] and current["p95_ms"] > previous["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{endpoint}: p95 {previous['p95_ms']}ms -> {current['p95_ms']}ms")
+        if previous["throughput_rps"] and current["throughput_rps"] < previous["throughput_rps"] * (1 - tolerance):
+            regressions.append(
+                f"{endpoint}: throughput {previous['throughput_rps']}/s -> {current['throughput_rps']}/s")
+    return regressions
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    os.environ["DATABASE_URL"] = args.database_url
+    os.environ["SQL_ECHO"] = "false"
+    # The clients send as fast as they can, a per-user rate limit would cap the measurement.
+    # Admission control stays on unless disabled in the environment (ADMISSION_CONTROL_ENABLED=false).
+    os.environ.setdefault("RATE_LIMIT_ENABLED", "false")
+    sys.path.insert(0, os.path.dirname(ROOT))
+
+    bounds = dataset_bounds(args.database_url)
+    endpoints = run_http(args, bounds) if args.transport == "http" else run_inprocess(args, bounds)
+    report = {
+        "transport": args.transport,
+        "workload": args.workload,
+        "clients": args.clients,
+        "duration_s": args.duration,
+        "database": args.database_url.split(":", 1)[0],
+        "books": bounds["books"],
+        "users": len(bounds["usernames"]),
+        "endpoints": endpoints,
+    }
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(report, output_file, indent=2)
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare(report, json.load(baseline_file), args.tolerance)
+        report["regressions"] = regressions
+    print(json.dumps(report, indent=2))
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
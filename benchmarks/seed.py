@@ -0,0 +1,135 @@
+"""Seeds a synthetic library dataset for the benchmarks.
+
+SCALE is the number of books (10^3 to 10^6). The dataset gets SCALE/10 authors and users,
+1-5 copies per book, about 20% of the copies on loan and SCALE returned borrows spread over
+the last two years, moved to borrow_history by the archiver as in production. Every user's password is "password"; "admin" is an admin user.
+The tables are dropped and migrated from scratch: only point it at a database meant for benchmarks.
+
+Usage (from the repository root):
+    python benchmarks/seed.py --scale 100000 --database-url sqlite:///./bench.db
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PASSWORD = "password"
+WORDS = (
+    "time night house river garden winter secret shadow stone city light dark fire water king queen war peace "
+    "love death dream storm road journey island mountain forest sea star moon sun iron glass silver golden lost "
+    "last first little great old new wild silent hidden broken burning frozen distant ancient endless quiet"
+).split()
+BATCH_SIZE = 10000
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scale", type=int, default=1000, help="Number of books")
+    parser.add_argument("--random-seed", type=int, default=42)
+    parser.add_argument("--database-url", default=os.environ.get("DATABASE_URL", "sqlite:///./bench.db"))
+    return parser.parse_args(argv)
+
+
+def _insert(conn, table, rows):
+    for start in range(0, len(rows), BATCH_SIZE):
+        conn.execute(table.insert(), rows[start:start + BATCH_SIZE])
+
+
+def seed(database_url: str, scale: int, random_seed: int = 42) -> dict:
+    os.environ["DATABASE_URL"] = database_url
+    sys.path.insert(0, ROOT)
+
+    from sqlalchemy import text
+    from app.archive import BorrowArchiver
+    from app.crypto import get_password_hash
+    from app.database import engine
+    from app.migrations import reset_database
+    from app.models import Author, Book, Borrow, Copy, User
+    from app.routers.borrows import MAX_BORROWS
+
+    rnd = random.Random(random_seed)
+    now = datetime.now()
+    num_authors = max(1, scale // 10)
+    num_users = max(20, scale // 10)
+
+    authors = [{"id": n, "name": f"{rnd.choice(WORDS).title()} {rnd.choice(WORDS).title()} {n}"} for n in range(1, num_authors + 1)]
+    password = get_password_hash(PASSWORD)
+    users = [{"id": 1, "username": "admin", "email": "admin@example.com", "password": password, "is_admin": True}]
+    users += [{"id": n, "username": f"user{n}", "email": f"user{n}@example.com", "password": password, "is_admin": False}
+              for n in range(2, num_users + 1)]
+
+    books, copies, borrows = [], [], []
+    open_per_user = {}
+    next_user = 0
+    for book_id in range(1, scale + 1):
+        title = " ".join(rnd.choice(WORDS) for _ in range(rnd.randint(2, 5))).capitalize()
+        total = rnd.randint(1, 5)
+        borrowed = 0
+        for _ in range(total):
+            copy_id = len(copies) + 1
+            on_loan = rnd.random() < 0.2
+            user_id = None
+            if on_loan:
+                # Consecutive copies of a book go to different users, and nobody goes over MAX_BORROWS
+                for _ in range(num_users):
+                    next_user = next_user % (num_users - 1) + 1
+                    if open_per_user.get(next_user + 1, 0) < MAX_BORROWS:
+                        user_id = next_user + 1
+                        break
+            if user_id is not None:
+                open_per_user[user_id] = open_per_user.get(user_id, 0) + 1
+                borrowed += 1
+                borrows.append({"copy_id": copy_id, "user_id": user_id,
+                                "borrow_date": now - timedelta(days=rnd.randint(0, 30), minutes=rnd.randint(0, 1440)),
+                                "return_date": None})
+            copies.append({"id": copy_id, "book_id": book_id, "borrowed": user_id is not None})
+        books.append({"id": book_id, "author_id": rnd.randint(1, num_authors), "title": title,
+                      "isbn": str(9780000000000 + book_id), "total_copies": total, "borrowed_copies": borrowed})
+
+    # Loan history: returned borrows over the last two years
+    for _ in range(scale):
+        borrow_date = now - timedelta(days=rnd.randint(31, 730), minutes=rnd.randint(0, 1440))
+        borrows.append({"copy_id": rnd.randint(1, len(copies)), "user_id": rnd.randint(2, num_users),
+                        "borrow_date": borrow_date, "return_date": borrow_date + timedelta(days=rnd.randint(1, 20))})
+    rnd.shuffle(borrows)
+    for borrow_id, borrow in enumerate(borrows, start=1):
+        borrow["id"] = borrow_id
+
+    started = time.perf_counter()
+    reset_database(engine)
+    with engine.begin() as conn:
+        _insert(conn, Author.__table__, authors)
+        _insert(conn, User.__table__, users)
+        _insert(conn, Book.__table__, books)
+        _insert(conn, Copy.__table__, copies)
+        _insert(conn, Borrow.__table__, borrows)
+        if engine.dialect.name == "postgresql":
+            # Ids were set explicitly, move the sequences past them
+            for table in ("authors", "users", "books", "copies", "borrows"):
+                conn.execute(text(f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), (SELECT max(id) FROM {table}))"))
+    BorrowArchiver(engine, batch_size=BATCH_SIZE, max_batches=None, interval_seconds=0).run()
+
+    return {
+        "database": engine.dialect.name,
+        "authors": len(authors),
+        "users": len(users),
+        "books": len(books),
+        "copies": len(copies),
+        "borrows": len(borrows),
+        "open_borrows": sum(open_per_user.values()),
+        "seconds": round(time.perf_counter() - started, 2),
+    }
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    print(json.dumps(seed(args.database_url, args.scale, args.random_seed), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+import os
+import shutil
+import tempfile
+
+# Two SQLite files: the primary, and a copy of it standing in for a replica that doesn't receive the writes
+DATA_DIR = tempfile.mkdtemp()
+PRIMARY = os.path.join(DATA_DIR, "primary.db")
+REPLICA = os.path.join(DATA_DIR, "replica.db")
+os.environ.update(
+    DATABASE_URL=f"sqlite:///{PRIMARY}",
+    DATABASE_REPLICA_URLS=f'["sqlite:///{REPLICA}"]',
+    READ_YOUR_WRITES_SECONDS="60",
+    RESPONSE_CACHE_ENABLED="true",
+    BORROW_ARCHIVE_INTERVAL_SECONDS="0",
+    PROFILING_ENABLED="false",
+)
+
+from starlette.testclient import TestClient  # noqa: E402
+from app.crypto import get_password_hash  # noqa: E402
+from app.database import SessionLocal, engine  # noqa: E402
+from app.migrations import reset_database  # noqa: E402
+from app.models import User  # noqa: E402
+
+# The app checks the schema version on import
+reset_database(engine)
+from app.main import app  # noqa: E402
+
+client = TestClient(app)
+
+
+def login(username: str) -> dict:
+    db = SessionLocal()
+    db.add(User(username=username, email=f"{username}@example.com", password=get_password_hash("password"),
+                is_admin=True))
+    db.commit()
+    db.close()
+    response = client.post("/login", data={"username": username, "password": "password"})
+    return {"Authorization": "Bearer " + response.json()["access_token"]}
+
+
+def teardown_module():
+    engine.dispose()
+    shutil.rmtree(DATA_DIR, ignore_errors=True)
+
+
+def test_replica_read_does_not_cache_stale_book():
+    writer, reader = login("writer"), login("reader")
+    response = client.post("/books/", json=[{"title": "Before", "author": "Author", "isbn": "isbn-1", "copies": 1}],
+                           headers=writer)
+    assert response.status_code == 200
+    book_id = client.get("/books/", headers={**writer, "Cache-Control": "no-store"}).json()["books"][0]["id"]
+
+    # The replica stops receiving the writes here
+    engine.dispose()
+    shutil.copy(PRIMARY, REPLICA)
+
+    assert client.put(f"/books/{book_id}", json={"title": "After"}, headers=writer).status_code == 200
+
+    # The reader is not a recent writer: its read goes to the lagging replica, and must not be cached
+    stale = client.get(f"/books/{book_id}", headers=reader)
+    assert stale.json()["title"] == "Before"
+    assert client.get(f"/books/{book_id}", headers=reader).headers["X-Cache"] == "miss"
+
+    # The writer reads the primary and sees its own write, not the replica's response
+    fresh = client.get(f"/books/{book_id}", headers=writer)
+    assert fresh.json()["title"] == "After"
+
+    pages = [client.get("/books/", headers=headers).json()["books"][0]["title"] for headers in (reader, writer)]
+    assert pages == ["Before", "After"]